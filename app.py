@@ -1,90 +1,162 @@
 # python imports
-import os, sys
+import time
+IMPORT_STARTED = time.perf_counter()
+import os, json, tempfile
 
 # local imports
 from extensions import db, migrate, login_manager
+from startup import timed, record, startup_report, make_pools_fork_safe, mark_ready, is_ready, TemplateBytecodeCache
+from registry import ViewRegistry
+from cache import track_changes, add_app_cache, app_cache
+from http_cache import cached_page
+import metrics
+from pagination import keyset_paginate
+from reference_data import reference_list, reference_get
+from identity import cached_user, user_version_key, remember_identity, forget_identity
+from storage import S3Storage, LocalStorage
+from uploads import UploadQueue, IMAGE_PENDING
+from ingredients import get_or_create_ingredient, get_or_create_ingredients
+from models import normalize_ingredient_name
+from bulk import RecipeImporter, READERS, IMPORT_FORMATS
+from export import export_chunks, EXPORT_FORMATS
+from benchmarks.routes import ROUTE_NAMES
+from indexes import add_missing_indexes
+from schema import upgrade_schema
+from facets import parse_filters, filter_args, filter_clauses, facet_counts, matching_total
+from search import search_recipes, track_search_index, rebuild_search_index, parse_ingredients, find_recipes_by_ingredients
 from models import User
 from forms import RegistrationForm, LoginForm
 
 #flask imports
-from flask import Flask
+from flask import Flask, current_app
+import click
 from flask_dotenv import DotEnv
 from werkzeug.urls import url_parse
-from flask import render_template, redirect, url_for, request, jsonify, flash
+from flask import render_template, redirect, url_for, request, jsonify, flash, Response, stream_with_context, abort
+from markupsafe import Markup
 from flask_login import current_user, login_user, logout_user, login_required
-import boto3
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 
+# grab the folder of the top-level directory of this project
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+TOP_LEVEL_DIR = os.path.abspath(os.curdir)
 
-# create an instance of flask = app variable
-app = Flask(__name__)
-env = DotEnv(app)
-env.init_app(app)
 
+def env_flag(name):
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes')
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL")
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+def default_config():
+    # read when an app is created rather than at import, so the environment of the process creating it is used
+    config = {}
 
-# grab the folder of the top-level directory of this project
-BASEDIR = os.path.abspath(os.path.dirname(__file__))
-TOP_LEVEL_DIR = os.path.abspath(os.curdir)
+    config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL")
 
-app.config['SECRET_KEY'] = 'super secret key'
+    config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+    config['SECRET_KEY'] = 'super secret key'
 
-# Configure the image uploading via AWS S3 boto3
+    # number of rows fetched from the database and written to the response per chunk by streaming endpoints
+    config['RECIPE_STREAM_BATCH_SIZE'] = int(os.environ.get("RECIPE_STREAM_BATCH_SIZE", 500))
 
-S3_BUCKET = os.environ.get("S3_BUCKET")
-S3_KEY = os.environ.get("S3_KEY")
-S3_SECRET = os.environ.get("S3_SECRET")
-S3_LOCATION = 'https://s3-eu-west-1.amazonaws.com/{}/'.format(S3_BUCKET)
+    config['RECIPES_PER_PAGE'] = 10
 
-s3 = boto3.client(
-   "s3",
-   aws_access_key_id = os.environ.get("AWS_ACCESS_KEY_ID"),
-   aws_secret_access_key=S3_SECRET
-)
+    # seconds a cached value is trusted for before it is rebuilt, so writes made by other worker processes show up
+    config['DATA_CACHE_TTL'] = int(os.environ.get("DATA_CACHE_TTL", 60))
+    config['USER_CACHE_SIZE'] = int(os.environ.get("USER_CACHE_SIZE", 1024))
+    config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get("FRAGMENT_CACHE_SIZE", 1024))
+    config['PAGE_CACHE_SIZE'] = int(os.environ.get("PAGE_CACHE_SIZE", 256))
+    # filter states whose facet counts are kept
+    config['FACET_CACHE_SIZE'] = int(os.environ.get("FACET_CACHE_SIZE", 256))
 
-db.init_app(app)
-migrate.init_app(app, db)
-login_manager.init_app(app)
+    # trust the user id and username kept in the signed session cookie instead of reading the user on each request
+    config['SESSION_IDENTITY'] = env_flag("SESSION_IDENTITY")
 
-login_manager.login_view = 'login'
+    # images are spooled here by requests and uploaded to S3 by IMAGE_UPLOAD_WORKERS background threads
+    config['IMAGE_SPOOL_DIR'] = os.environ.get("IMAGE_SPOOL_DIR", os.path.join(tempfile.gettempdir(), 'food-book-uploads'))
+    config['IMAGE_UPLOAD_WORKERS'] = int(os.environ.get("IMAGE_UPLOAD_WORKERS", 4))
+    config['IMAGE_UPLOAD_RETRIES'] = int(os.environ.get("IMAGE_UPLOAD_RETRIES", 3))
+    config['IMAGE_UPLOAD_BACKOFF'] = float(os.environ.get("IMAGE_UPLOAD_BACKOFF", 1))
+    # processes resizing uploaded images into their responsive derivatives, 0 to resize in the uploading thread
+    config['IMAGE_PROCESS_WORKERS'] = int(os.environ.get("IMAGE_PROCESS_WORKERS", 2))
+    # seconds after which a pending upload whose worker has stopped is queued again; longer than any upload with retries
+    config['IMAGE_UPLOAD_STALE_AFTER'] = int(os.environ.get("IMAGE_UPLOAD_STALE_AFTER", 900))
 
-from models import Recipe, Category, Course, Cuisine, Country, Author, Measurement, Quantity, Ingredient, Method, User, SavedRecipe
+    # images are kept in S3 when a bucket is configured and otherwise in IMAGE_STORAGE_DIR, served from /images/
+    config['IMAGE_STORAGE'] = os.environ.get("IMAGE_STORAGE", 's3' if os.environ.get("S3_BUCKET") else 'local')
+    config['IMAGE_STORAGE_DIR'] = os.environ.get("IMAGE_STORAGE_DIR", os.path.join(BASEDIR, 'uploads'))
+    config['IMAGE_MAX_AGE'] = int(os.environ.get("IMAGE_MAX_AGE", 365 * 24 * 3600))
+    # let a fronting proxy send local image files itself
+    config['USE_X_SENDFILE'] = env_flag("USE_X_SENDFILE")
 
-#################AWS_S3_file_upload###########################
-def upload_file_to_s3(file, bucket_name, acl="public-read"):
+    # Configure the image uploading via AWS S3 boto3
+    config['S3_BUCKET'] = os.environ.get("S3_BUCKET")
+    config['S3_KEY'] = os.environ.get("AWS_ACCESS_KEY_ID")
+    config['S3_SECRET'] = os.environ.get("S3_SECRET")
+    config['S3_LOCATION'] = 'https://s3-eu-west-1.amazonaws.com/{}/'.format(config['S3_BUCKET'])
 
-    """
-    Docs: http://boto3.readthedocs.io/en/latest/guide/s3.html
-    """
+    # fill the caches and compile the templates when the app is created, before it serves its first request
+    config['WARM_UP'] = env_flag("WARM_UP")
+    # compiled templates are kept here for every worker to load, empty to compile them in each process instead;
+    # `flask compile-templates` fills it ahead of time
+    config['TEMPLATE_CACHE_DIR'] = os.environ.get("TEMPLATE_CACHE_DIR", os.path.join(BASEDIR, '.template_cache'))
+    return config
 
-    try:
 
-        s3.upload_fileobj(
-            file,
-            bucket_name,
-            file.filename,
-            ExtraArgs={
-                "ACL": acl,
-                "ContentType": file.content_type
-            }
-        )
+from models import Recipe, Category, Course, Cuisine, Country, Author, Measurement, Quantity, Ingredient, Method, User, SavedRecipe
 
-    except Exception as e:
-        print("Something Happened: ", e)
-        return e
+def row_version_keys(obj):
+    # a recipe's detail page depends on the recipe row and on the rows of its quantities and methods,
+    # and a cached user on its own row
+    if isinstance(obj, Recipe):
+        return ['recipe:%s' % obj.id]
+    if isinstance(obj, (Quantity, Method)):
+        return ['recipe:%s' % obj.recipe_id]
+    if isinstance(obj, User):
+        return [user_version_key(obj.id)]
+    return []
+
+track_changes(db.session, db.Model.metadata, row_version_keys)
+track_search_index(db.Model.metadata)
+
+# the routes, error handlers and commands below are added to each app by create_app
+views = ViewRegistry()
+
+# the reference tables recipes are grouped by on the dashboard
+RECIPE_DIMENSIONS = (('category', Category, Category.category_name),
+                     ('course', Course, Course.course_name),
+                     ('cuisine', Cuisine, Cuisine.cuisine_name),
+                     ('author', Author, Author.author_name))
+RECIPE_DIMENSION_TABLES = ('recipe', 'category', 'course', 'cuisine', 'author')
 
-    return "{}{}".format(S3_LOCATION, file.filename)
+#################AWS_S3_file_upload###########################
+def image_uploads():
+    # the upload queue of the current app, made by create_app
+    return current_app.extensions['image_uploads']
+
+def create_image_storage(config):
+    if config['IMAGE_STORAGE'] == 's3':
+        return S3Storage(config['S3_BUCKET'], config['S3_LOCATION'],
+                         aws_access_key_id=config['S3_KEY'], aws_secret_access_key=config['S3_SECRET'])
+    return LocalStorage(config['IMAGE_STORAGE_DIR'], '/images/')
+
+def spool_recipe_image():
+    # returns the key, spooled path and content type of the image sent with the form, or None when no file was chosen
+    file = request.files.get('recipe_image')
+    if file is None or not file.filename:
+        return None
+    key, path = image_uploads().spool(file)
+    return key, path, file.content_type
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.filter(User.id == int(user_id)).first()
+    return cached_user(user_id, current_app.config['SESSION_IDENTITY'])
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@views.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
@@ -98,6 +170,8 @@ def login():
             flash('Invalid password','error')
             return redirect(url_for('login'))
         login_user(user)
+        if current_app.config['SESSION_IDENTITY']:
+            remember_identity(user)
         flash('Success, you are now logged in!')
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
@@ -105,14 +179,15 @@ def login():
         return redirect(next_page)
     return render_template('login.html', title='Sign In', form=form)
 
-@app.route('/logout')
+@views.route('/logout')
 @login_required
 def logout():
     logout_user()
+    forget_identity()
     flash('Logout successful')
     return redirect(url_for('index'))
 
-@app.route('/register', methods=['GET', 'POST'])
+@views.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
@@ -126,140 +201,270 @@ def register():
     return render_template('register.html', title='Register', form=form)
 
 #############################DASHBOARD##########################################
-@app.route('/dashboard')
+@views.route('/dashboard')
 def dashboard():
     
     return render_template('dashboard.html')
 #############################RECIPE JSON DATA ENDPOINT##########################################
-@app.route('/get_recipes')
-def get_recipes_json():
-    recipes = []
-    for r in db.session.query(Recipe).all():
-        print(r, file=sys.stdout)
-        recipes.append({
+def recipe_json_rows(batch_size):
+    """
+    Yield the dashboard fields of every recipe from one joined query, read from the cursor batch_size rows at a time.
+    """
+    query = db.session.query(Recipe.recipe_name,
+        Recipe.recipe_description,
+        Category.category_name,
+        Cuisine.cuisine_name,
+        Course.course_name,
+        Author.author_name) \
+        .join(Category, Recipe.category_id == Category.id) \
+        .join(Cuisine, Recipe.cuisine_id == Cuisine.id) \
+        .join(Course, Recipe.course_id == Course.id) \
+        .join(Author, Recipe.author_id == Author.id) \
+        .order_by(Recipe.id) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+    for r in query:
+        yield {
             'recipe_name': r.recipe_name,
             'recipe_description': r.recipe_description,
-            'category': r.category.category_name,
-            'cuisine': r.cuisine.cuisine_name,
-            'course': r.course.course_name,
-            'author': r.author.author_name
-        })
-
-
-    return jsonify(recipes)
+            'category': r.category_name,
+            'cuisine': r.cuisine_name,
+            'course': r.course_name,
+            'author': r.author_name
+        }
+
+def json_array_chunks(rows, batch_size):
+    # write the rows as a single JSON array, one chunk of batch_size rows at a time
+    separator = ''
+    yield '['
+    batch = []
+    for row in rows:
+        batch.append(json.dumps(row))
+        if len(batch) == batch_size:
+            yield separator + ','.join(batch)
+            separator = ','
+            batch = []
+    if batch:
+        yield separator + ','.join(batch)
+    yield ']'
+
+def ndjson_chunks(rows, batch_size):
+    # write the rows as newline delimited JSON, one chunk of batch_size rows at a time
+    batch = []
+    for row in rows:
+        batch.append(json.dumps(row) + '\n')
+        if len(batch) == batch_size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+def recipe_columns():
+    """
+    Dictionary encode the dashboard data: each dimension is sent once as a lookup table taken from its reference table,
+    and recipes are sent as parallel arrays holding positions in those lookup tables instead of repeating the names.
+    Only the dimensions the charts filter on are sent, so each recipe costs four small integers.
+    """
+    payload = {'dimensions': {}}
+    codes = {}
+    for name, model, column in RECIPE_DIMENSIONS:
+        rows = db.session.query(model.id, column).order_by(model.id).all()
+        payload['dimensions'][name] = [label for id, label in rows]
+        codes[name] = dict((id, position) for position, (id, label) in enumerate(rows))
+
+    for field in ('category', 'course', 'cuisine', 'author'):
+        payload[field] = []
+    query = db.session.query(Recipe.category_id,
+        Recipe.course_id,
+        Recipe.cuisine_id,
+        Recipe.author_id) \
+        .order_by(Recipe.id) \
+        .yield_per(current_app.config['RECIPE_STREAM_BATCH_SIZE'])
+    for r in query:
+        payload['category'].append(codes['category'][r.category_id])
+        payload['course'].append(codes['course'][r.course_id])
+        payload['cuisine'].append(codes['cuisine'][r.cuisine_id])
+        payload['author'].append(codes['author'][r.author_id])
+
+    return json.dumps(payload, separators=(',', ':'))
+
+@views.route('/get_recipes')
+@cached_page(RECIPE_DIMENSION_TABLES)
+def get_recipes_json():
+    if request.args.get('format') == 'columnar':
+        return Response(app_cache('columns').get('columns', RECIPE_DIMENSION_TABLES, recipe_columns), mimetype='application/json')
+
+    batch_size = current_app.config['RECIPE_STREAM_BATCH_SIZE']
+    rows = recipe_json_rows(batch_size)
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_with_context(ndjson_chunks(rows, batch_size)), mimetype='application/x-ndjson')
+    return Response(stream_with_context(json_array_chunks(rows, batch_size)), mimetype='application/json')
+
+#############################RECIPE STATS ENDPOINT##########################################
+def recipe_stats():
+    # recipe counts per category, course, cuisine and author, each as a single GROUP BY query
+    stats = {}
+    for name, model, column in RECIPE_DIMENSIONS:
+        rows = db.session.query(column, func.count(Recipe.id)) \
+            .join(Recipe, getattr(Recipe, name + '_id') == model.id) \
+            .group_by(model.id, column) \
+            .order_by(column) \
+            .all()
+        stats[name] = [{'key': key, 'value': value} for key, value in rows]
+    return stats
+
+@views.route('/get_recipe_stats')
+def get_recipe_stats_json():
+    return jsonify(app_cache('stats').get('stats', RECIPE_DIMENSION_TABLES, recipe_stats))
 
 #############################INDEX##########################################
-@app.route('/')
+@views.route('/')
+@cached_page(('recipe', 'category', 'course', 'cuisine', 'author'))
 def index():
-    recipe_count = Recipe.query.count()
-    categories_list = Category.query.limit(100).all()
-    courses_list = Course.query.limit(100).all()
-    cuisines_list = Cuisine.query.limit(100).all()
-    authors_list = Author.query.limit(100).all()
-
-    page = request.args.get('page', 1, type=int)
-    recipes_list = Recipe.query.order_by(Recipe.id.desc()).paginate(page, 10, False)
-    next_url = url_for('index', page=recipes_list.next_num) \
-        if recipes_list.has_next else None
-    prev_url = url_for('index', page=recipes_list.prev_num) \
-        if recipes_list.has_prev else None
-    return render_template('index.html', recipe_count=str(recipe_count), recipes_list=recipes_list.items, next_url=next_url, prev_url=prev_url, categories_list=categories_list, courses_list=courses_list, cuisines_list=cuisines_list, authors_list=authors_list)
+    recipe_count = app_cache('count').get('recipes', ('recipe',), lambda: Recipe.query.count())
+    categories_list = reference_list(Category)
+    courses_list = reference_list(Course)
+    cuisines_list = reference_list(Cuisine)
+    authors_list = reference_list(Author)
+
+    recipes_page = keyset_paginate(Recipe.query, Recipe.id, request.args.get('cursor'), current_app.config['RECIPES_PER_PAGE'])
+    next_url = url_for('index', cursor=recipes_page.next_cursor) \
+        if recipes_page.has_next else None
+    prev_url = url_for('index', cursor=recipes_page.prev_cursor) \
+        if recipes_page.has_prev else None
+    return render_template('index.html', recipe_count=str(recipe_count), recipes_list=recipes_page.items, next_url=next_url, prev_url=prev_url, categories_list=categories_list, courses_list=courses_list, cuisines_list=cuisines_list, authors_list=authors_list)
 
 #############################MY RECIPES##########################################
-@app.route('/my_recipes')
+@views.route('/my_recipes')
 @login_required
 def my_recipes():
-    recipe_count = Recipe.query.filter_by(user=current_user).count()
-    page = request.args.get('page', 1, type=int)
-    recipes_list = Recipe.query.filter_by(user=current_user).order_by(Recipe.id.desc()).paginate(page, 10, False)
-    next_url = url_for('index', page=recipes_list.next_num) \
-        if recipes_list.has_next else None
-    prev_url = url_for('index', page=recipes_list.prev_num) \
-        if recipes_list.has_prev else None
-    return render_template('my_recipes.html', recipe_count=str(recipe_count), recipes_list=recipes_list.items, next_url=next_url, prev_url=prev_url)
+    recipe_count = app_cache('count').get(('my_recipes', current_user.id), ('recipe',),
+        lambda: Recipe.query.filter_by(user=current_user).count())
+    recipes_page = keyset_paginate(Recipe.query.filter_by(user=current_user), Recipe.id, request.args.get('cursor'), current_app.config['RECIPES_PER_PAGE'])
+    next_url = url_for('my_recipes', cursor=recipes_page.next_cursor) \
+        if recipes_page.has_next else None
+    prev_url = url_for('my_recipes', cursor=recipes_page.prev_cursor) \
+        if recipes_page.has_prev else None
+    return render_template('my_recipes.html', recipe_count=str(recipe_count), recipes_list=recipes_page.items, next_url=next_url, prev_url=prev_url)
 
 #############################RECIPE LIST FILTERED##########################################
-@app.route('/recipe_list_filtered', methods = ['POST'])
+@views.route('/recipe_list_filtered', methods = ['GET', 'POST'])
 def recipe_list_filtered():
-    categories_list = Category.query.limit(100).all()
-    courses_list = Course.query.limit(100).all()
-    cuisines_list = Cuisine.query.limit(100).all()
-    authors_list = Author.query.limit(100).all()
-    
-    recipe_category = Category.query.filter_by(id=request.form.get('recipe_category')).first()
-    recipe_course = Course.query.filter_by(id=request.form.get('recipe_course')).first()
-    recipe_cuisine = Cuisine.query.filter_by(id=request.form.get('recipe_cuisine')).first()
-    recipe_author = Author.query.filter_by(id=request.form.get('recipe_author')).first()
-    queries = []
-    if recipe_category is not None:
-        queries.append(Recipe.category == recipe_category)
-    if recipe_course is not None:
-        queries.append(Recipe.course == recipe_course)
-    if recipe_cuisine is not None:
-        queries.append(Recipe.cuisine == recipe_cuisine)
-    if recipe_author is not None:
-        queries.append(Recipe.author == recipe_author)
-    
-    recipes_list = Recipe.query.filter(*queries).all()
-    recipe_count = Recipe.query.filter(*queries).count()
-    return render_template('index.html', recipe_count=str(recipe_count), recipes_list=recipes_list, categories_list=categories_list, courses_list=courses_list, cuisines_list=cuisines_list, authors_list=authors_list)
-    
+    categories_list = reference_list(Category)
+    courses_list = reference_list(Course)
+    cuisines_list = reference_list(Cuisine)
+    authors_list = reference_list(Author)
+
+    filters = parse_filters(request.values)
+    facets = facet_counts(filters)
+    recipe_count = matching_total(filters, facets)
+    recipes_page = keyset_paginate(Recipe.query.filter(*filter_clauses(filters)), Recipe.id, request.values.get('cursor'), current_app.config['RECIPES_PER_PAGE'])
+    next_url = url_for('recipe_list_filtered', cursor=recipes_page.next_cursor, **filter_args(filters)) \
+        if recipes_page.has_next else None
+    prev_url = url_for('recipe_list_filtered', cursor=recipes_page.prev_cursor, **filter_args(filters)) \
+        if recipes_page.has_prev else None
+    return render_template('index.html', recipe_count=str(recipe_count), recipes_list=recipes_page.items, next_url=next_url, prev_url=prev_url, filters=filters, facets=facets, categories_list=categories_list, courses_list=courses_list, cuisines_list=cuisines_list, authors_list=authors_list)
+
 
 #############################RECIPE SEARCH##########################################
-@app.route('/recipe_search', methods = ['POST'])
-def recipe_search():      
-    recipes_list = Recipe.query.filter(Recipe.recipe_name.ilike("%" + request.form['recipe_name'] + "%")).all()
-    recipe_count = Recipe.query.filter(Recipe.recipe_name.ilike("%" + request.form['recipe_name'] + "%")).count()
-    return render_template('index.html', recipe_count=str(recipe_count), recipes_list=recipes_list)
+@views.route('/recipe_search', methods = ['GET', 'POST'])
+def recipe_search():
+    term = request.values.get('recipe_name', '')
+    page = request.values.get('page', 1, type=int)
+    results = search_recipes(term, page, current_app.config['RECIPES_PER_PAGE'])
+    next_url = url_for('recipe_search', recipe_name=term, page=results.page + 1) \
+        if results.has_next else None
+    prev_url = url_for('recipe_search', recipe_name=term, page=results.page - 1) \
+        if results.has_prev else None
+    return render_template('index.html', recipe_count=str(results.total), recipes_list=results.items, next_url=next_url, prev_url=prev_url)
 
 
 #############################INGREDIENT SEARCH##########################################
-@app.route('/ingredient_search', methods=['POST'])
+@views.route('/ingredient_search', methods=['GET', 'POST'])
 def ingredient_search():
-    recipes = []
-    quantity_list = Quantity.query.filter(Quantity.ingredient.has(Ingredient.ingredient_name.ilike("%" + request.form['ingredient_name'] + "%"))).all()
-    for quantity in quantity_list:
-        recipe_id = quantity.recipe_id
-        recipes.append(recipe_id)
-
-    recipes_list = Recipe.query.join(Quantity).filter(Recipe.id.in_(recipes)).all()
-    recipe_count = Quantity.query.filter(Quantity.ingredient.has(Ingredient.ingredient_name.ilike("%" + request.form['ingredient_name'] + "%"))).count()
-    return render_template('index.html', recipe_count=str(recipe_count), recipes_list=recipes_list)
+    term = request.values.get('ingredient_name', '')
+    match = request.values.get('match', 'all')
+    page = request.values.get('page', 1, type=int)
+    include, exclude = parse_ingredients(term)
+    results = find_recipes_by_ingredients(include, exclude, match, page, current_app.config['RECIPES_PER_PAGE'])
+    next_url = url_for('ingredient_search', ingredient_name=term, match=match, page=results.page + 1) \
+        if results.has_next else None
+    prev_url = url_for('ingredient_search', ingredient_name=term, match=match, page=results.page - 1) \
+        if results.has_prev else None
+    return render_template('index.html', recipe_count=str(results.total), recipes_list=results.items, missing=results.missing, next_url=next_url, prev_url=prev_url)
 
 
 #############################RECIPE DETAIL##########################################
-@app.route('/recipe_detail/<id>')
+# the names shown on a recipe's detail page come from these tables
+RECIPE_DETAIL_TABLES = ('user', 'category', 'course', 'cuisine', 'author', 'measurement', 'ingredient')
+
+class RecipeFragment(object):
+    """The rendered body of a recipe's detail page, as seen by its owner and by everyone else."""
+
+    def __init__(self, recipe):
+        self.owner_id = recipe.user_id
+        quantity_list = sorted(recipe.quantities, key=lambda quantity: quantity.id)
+        method_list = sorted(recipe.methods, key=lambda method: method.sort_key)
+        self.owner_body, self.visitor_body = [
+            Markup(render_template('recipe_detail_body.html', recipe=recipe, quantity_list=quantity_list, method_list=method_list, is_owner=is_owner))
+            for is_owner in (True, False)]
+
+def load_recipe_fragment(id):
+    # the whole recipe graph in a single query
+    recipe = Recipe.query.options(
+        joinedload(Recipe.user),
+        joinedload(Recipe.category),
+        joinedload(Recipe.course),
+        joinedload(Recipe.cuisine),
+        joinedload(Recipe.author),
+        joinedload(Recipe.quantities).joinedload(Quantity.ingredient),
+        joinedload(Recipe.quantities).joinedload(Quantity.measurement),
+        joinedload(Recipe.methods)).filter(Recipe.id == id).first()
+    if recipe is None:
+        return None
+    return RecipeFragment(recipe)
+
+def is_recipe_owner(id):
+    # data versions are counted by each worker, so an owner redirected here after editing the recipe on another one
+    # would be shown the cached page from before the edit; their pages are built afresh instead
+    if not current_user.is_authenticated:
+        return False
+    # a recipe never changes hands, so its owner is kept until the entry expires, whatever is edited meanwhile
+    owner_id = app_cache('fragment').get(('recipe_owner', id), (),
+        lambda: db.session.query(Recipe.user_id).filter(Recipe.id == id).scalar())
+    return owner_id == current_user.id
+
+@views.route('/recipe_detail/<int:id>')
+@cached_page(lambda id: ('recipe:%s' % id,) + RECIPE_DETAIL_TABLES, bypass=is_recipe_owner)
 def recipe_detail(id):
-
-    recipe = Recipe.query.filter_by(id=int(id)).first()
-    quantity_list = Quantity.query.filter_by(recipe_id=id)
-    method_list = Method.query.filter_by(recipe_id=id)
-
-    return render_template('recipe_detail.html', recipe=recipe, quantity_list=quantity_list, method_list=method_list)
+    if is_recipe_owner(id):
+        fragment = load_recipe_fragment(id)
+    else:
+        fragment = app_cache('fragment').get(('recipe_detail', id), ('recipe:%s' % id,) + RECIPE_DETAIL_TABLES,
+            lambda: load_recipe_fragment(id))
+    if fragment is None:
+        abort(404)
+    is_owner = current_user.is_authenticated and current_user.id == fragment.owner_id
+    recipe_body = fragment.owner_body if is_owner else fragment.visitor_body
+    return render_template('recipe_detail.html', recipe_body=recipe_body)
 
 #############################RECIPE##########################################
-@app.route('/add_recipe', methods = ['GET','POST'])
+@views.route('/add_recipe', methods = ['GET','POST'])
 @login_required
 def add_recipe():
-        categories_list = Category.query.limit(100).all()
-        courses_list = Course.query.limit(100).all()
-        cuisines_list = Cuisine.query.limit(100).all()
-        authors_list = Author.query.limit(100).all()
+        categories_list = reference_list(Category)
+        courses_list = reference_list(Course)
+        cuisines_list = reference_list(Cuisine)
+        authors_list = reference_list(Author)
         
         if request.method == 'POST':
-            recipe_category = Category.query.filter_by(id=request.form['recipe_category']).first()
-            recipe_course = Course.query.filter_by(id=request.form['recipe_course']).first()
-            recipe_cuisine = Cuisine.query.filter_by(id=request.form['recipe_cuisine']).first()
-            recipe_author = Author.query.filter_by(id=request.form['recipe_author']).first()
-
-            if 'recipe_image' in request.files:
-                file = request.files["recipe_image"]
-                output  = upload_file_to_s3(file, S3_BUCKET)
-                filename = file.filename
-                url = str(output)
-            else:
-                filename = None
-                url = None
+            recipe_category = reference_get(Category, request.form['recipe_category'])
+            recipe_course = reference_get(Course, request.form['recipe_course'])
+            recipe_cuisine = reference_get(Cuisine, request.form['recipe_cuisine'])
+            recipe_author = reference_get(Author, request.form['recipe_author'])
+
+            image = spool_recipe_image()
+            filename = image[0] if image else None
 
             recipe = Recipe(current_user,
             request.form['recipe_name'],
@@ -272,64 +477,62 @@ def add_recipe():
             recipe_cuisine,
             recipe_author,
             filename,
-            url)
+            None)
+            if image:
+                recipe.image_status = IMAGE_PENDING
 
             db.session.add(recipe)
 
             db.session.commit()
+            if image:
+                image_uploads().submit(recipe.id, *image)
             return redirect(url_for('index'))
         
         return render_template('add_recipe.html', categories_list=categories_list, courses_list=courses_list, cuisines_list=cuisines_list, authors_list=authors_list)
 
-@app.route('/edit_recipe/<id>')
+@views.route('/edit_recipe/<id>')
 @login_required
 def edit_recipe(id):
         recipe = Recipe.query.get(id)
-        categories_list = Category.query.limit(100).all()
-        courses_list = Course.query.limit(100).all()
-        cuisines_list = Cuisine.query.limit(100).all()
-        authors_list = Author.query.limit(100).all()
+        categories_list = reference_list(Category)
+        courses_list = reference_list(Course)
+        cuisines_list = reference_list(Cuisine)
+        authors_list = reference_list(Author)
         if recipe.user != current_user:
             flash('You do not have permission to edit this recipe')
             return redirect(url_for('index'))
         return render_template('edit_recipe.html', recipe=recipe, categories_list=categories_list, courses_list=courses_list, cuisines_list=cuisines_list, authors_list=authors_list)
 
-@app.route('/update_recipe/<id>', methods = ['GET','POST'])
+@views.route('/update_recipe/<id>', methods = ['GET','POST'])
 def update_recipe(id):
         
         if request.method == 'POST':
             recipe = Recipe.query.get(id)
 
-            if 'recipe_image' in request.files:
-                file = request.files["recipe_image"]
-                output  = upload_file_to_s3(file, S3_BUCKET)
-                filename = file.filename
-                url = str(output)
-            elif recipe.image_url is not None:
-                filename = recipe.image_filename
-                url = recipe.image_url              
-            else:
-                filename = None
-                url = None
+            image = spool_recipe_image()
 
             recipe.recipe_name = request.form['recipe_name']
             recipe.recipe_description = request.form['recipe_description']
             recipe.preparation_time = request.form['preparation_time']
             recipe.cooking_time = request.form['cooking_time']
             recipe.servings = request.form['servings']
-            recipe.category = Category.query.filter_by(id=request.form['recipe_category']).first()
-            recipe.course = Course.query.filter_by(id=request.form['recipe_course']).first()
-            recipe.cuisine = Cuisine.query.filter_by(id=request.form['recipe_cuisine']).first()
-            recipe.author = Author.query.filter_by(id=request.form['recipe_author']).first()
-            recipe.image_filename = filename
-            recipe.image_url = url
+            recipe.category = reference_get(Category, request.form['recipe_category'])
+            recipe.course = reference_get(Course, request.form['recipe_course'])
+            recipe.cuisine = reference_get(Cuisine, request.form['recipe_cuisine'])
+            recipe.author = reference_get(Author, request.form['recipe_author'])
+            if image:
+                # the current image stays in place until the new one has been uploaded
+                recipe.image_filename = image[0]
+                recipe.image_status = IMAGE_PENDING
 
             db.session.commit()
+            if image:
+                image_uploads().submit(recipe.id, *image)
             return redirect(url_for('recipe_detail', id=recipe.id))
         
         return redirect(url_for('index'))
 
-@app.route('/delete_recipe/<id>')
+@views.route('/delete_recipe/<id>')
 @login_required
 def delete_recipe(id):
     recipe = Recipe.query.get(id)
@@ -341,10 +544,10 @@ def delete_recipe(id):
     return redirect(url_for('index'))
 
 #############################INGREDIENT##########################################
-@app.route('/add_quantity/<id>', methods = ['GET','POST'])
+@views.route('/add_quantity/<id>', methods = ['GET','POST'])
 @login_required
 def add_quantity(id):
-        measurements_list = Measurement.query.limit(100).all()
+        measurements_list = reference_list(Measurement)
         quantity_recipe = Recipe.query.get(id)
         if quantity_recipe.user != current_user:
             flash('You do not have permission to add ingredients to this recipe')
@@ -352,14 +555,10 @@ def add_quantity(id):
         
         if request.method == 'POST':
             
-            quantity_measurement = Measurement.query.filter_by(id=request.form['quantity_measurement']).first()
+            quantity_measurement = reference_get(Measurement, request.form['quantity_measurement'])
             
-            # check if ingredient has already been created and if so use the existing before creating (same) new ingredient to avoid duplicate data
-            existing_ingredient = Ingredient.query.filter_by(ingredient_name=request.form['quantity_ingredient']).first()
-            if existing_ingredient is not None:
-                quantity_ingredient = existing_ingredient
-            else:
-                quantity_ingredient = Ingredient(request.form['quantity_ingredient'])
+            # use the existing ingredient of the same name if there is one, to avoid duplicate data
+            quantity_ingredient = get_or_create_ingredient(request.form['quantity_ingredient'])
 
             quantity = Quantity(request.form['quantity'], 
             quantity_recipe, 
@@ -373,36 +572,36 @@ def add_quantity(id):
         
         return render_template('add_quantity.html', measurements_list=measurements_list, recipe=quantity_recipe)
 
-@app.route('/edit_quantity/<id>')
+@views.route('/edit_quantity/<id>')
 @login_required
 def edit_quantity(id):
         quantity = Quantity.query.get(id)
         quantity_recipe = Recipe.query.get(quantity.recipe_id)
-        measurements_list = Measurement.query.limit(100).all()
+        measurements_list = reference_list(Measurement)
         if quantity_recipe.user != current_user:
             flash('You do not have permission to edit this ingredient')
             return redirect(url_for('index'))
         return render_template('edit_quantity.html', quantity=quantity, measurements_list=measurements_list, recipe=quantity_recipe)
 
-@app.route('/update_quantity/<id>', methods = ['GET','POST'])
+@views.route('/update_quantity/<id>', methods = ['GET','POST'])
 def update_quantity(id):
         quantity = Quantity.query.get(id)
         quantity_recipe = Recipe.query.get(quantity.recipe_id)
-        measurements_list = Measurement.query.limit(100).all()
         
         if request.method == 'POST':
             quantity = Quantity.query.get(id)
             quantity.quantity = request.form['quantity']
             quantity.recipe = quantity_recipe
-            quantity.measurement = Measurement.query.filter_by(id=request.form['quantity_measurement']).first()
-            quantity.ingredient.ingredient_name = request.form['quantity_ingredient']
+            quantity.measurement = reference_get(Measurement, request.form['quantity_measurement'])
+            # other recipes share the ingredient, so it is swapped for the one named rather than renamed
+            quantity.ingredient = get_or_create_ingredient(request.form['quantity_ingredient'])
 
             db.session.commit()
             return redirect(url_for('recipe_detail', id=quantity_recipe.id))
         
         return redirect(url_for('recipe_detail', id=quantity_recipe.id))
 
-@app.route('/delete_quantity/<id>')
+@views.route('/delete_quantity/<id>')
 @login_required
 def delete_quantity(id):
     quantity = Quantity.query.get(id)
@@ -415,7 +614,7 @@ def delete_quantity(id):
     return redirect(url_for('recipe_detail', id=quantity_recipe.id))
 
 #############################METHOD##########################################
-@app.route('/add_method/<id>', methods = ['GET','POST'])
+@views.route('/add_method/<id>', methods = ['GET','POST'])
 @login_required
 def add_method(id):       
         method_recipe = Recipe.query.get(id)
@@ -431,7 +630,7 @@ def add_method(id):
         
         return render_template('add_method.html', recipe=method_recipe)
 
-@app.route('/edit_method/<id>')
+@views.route('/edit_method/<id>')
 @login_required
 def edit_method(id):
         method = Method.query.get(id)
@@ -441,7 +640,7 @@ def edit_method(id):
             return redirect(url_for('index'))
         return render_template('edit_method.html', method=method, recipe=method_recipe)
 
-@app.route('/update_method/<id>', methods = ['GET','POST'])
+@views.route('/update_method/<id>', methods = ['GET','POST'])
 def update_method(id):
         method = Method.query.get(id)
         method_recipe = Recipe.query.get(method.recipe_id)
@@ -458,7 +657,7 @@ def update_method(id):
         
         return redirect(url_for('recipe_detail', id=method_recipe.id))
 
-@app.route('/delete_method/<id>')
+@views.route('/delete_method/<id>')
 @login_required
 def delete_method(id):
     method = Method.query.get(id)
@@ -470,8 +669,123 @@ def delete_method(id):
     db.session.commit()
     return redirect(url_for('recipe_detail', id=method_recipe.id))
 
+#############################BATCH EDIT##########################################
+# spare rows on the batch form for new ingredients and steps
+BATCH_BLANK_ROWS = 5
+
+class RecipeItemsError(ValueError):
+    """A submitted ingredient or step that cannot be saved, with a message for the user."""
+
+def item_id(value):
+    return int(value) if value not in (None, '') else None
+
+def submitted_recipe_items():
+    # the complete lists of ingredients and method steps, from a JSON body or from the rows of the batch form
+    if request.is_json:
+        data = request.get_json()
+        quantities = [dict(item, ingredient=item['ingredient'].strip()) for item in data.get('quantities', [])]
+        methods = [dict(item, method=item['method'].strip()) if isinstance(item, dict) else {'method': item.strip()}
+                   for item in data.get('methods', [])]
+        # unlike the form, a JSON body has no spare rows, so a blank ingredient or step is a mistake
+        for item in quantities:
+            if not normalize_ingredient_name(item['ingredient']):
+                raise RecipeItemsError('Enter a name for every ingredient')
+        for item in methods:
+            if not item['method']:
+                raise RecipeItemsError('Enter a description for every step of the method')
+        return quantities, methods
+
+    form = request.form
+    # rows left blank are spare rows, or rows whose ingredient or step is to be deleted
+    quantities = [{'id': id, 'quantity': quantity, 'measurement': measurement, 'ingredient': ingredient}
+                  for id, quantity, measurement, ingredient in zip(form.getlist('quantity_id'), form.getlist('quantity'),
+                      form.getlist('quantity_measurement'), form.getlist('quantity_ingredient'))
+                  if ingredient.strip()]
+    rows = [(float(position) if position.strip() else index + 1, index, {'id': id, 'method': method})
+            for index, (id, method, position) in enumerate(zip(form.getlist('method_id'), form.getlist('method'),
+                form.getlist('method_position')))
+            if method.strip()]
+    return quantities, [item for position, index, item in sorted(rows, key=lambda row: row[:2])]
+
+def apply_recipe_items(recipe, quantities, methods):
+    """Add, update and delete the recipe's quantities and method steps so they match the submitted lists."""
+    ingredients = get_or_create_ingredients([item['ingredient'] for item in quantities])
+    existing = dict((quantity.id, quantity) for quantity in recipe.quantities)
+    kept = set()
+    for item in quantities:
+        measurement = reference_get(Measurement, item.get('measurement'))
+        if measurement is None:
+            raise RecipeItemsError('Choose a measurement for %s' % item['ingredient'])
+        try:
+            amount = float(item['quantity'])
+        except (TypeError, ValueError):
+            raise RecipeItemsError('Enter a number for the quantity of %s' % item['ingredient'])
+        ingredient = ingredients[normalize_ingredient_name(item['ingredient'])]
+        quantity = existing.get(item_id(item.get('id')))
+        if quantity is None:
+            db.session.add(Quantity(amount, recipe, ingredient, measurement))
+        else:
+            kept.add(quantity.id)
+            quantity.quantity = amount
+            quantity.ingredient = ingredient
+            quantity.measurement = measurement
+    for id, quantity in existing.items():
+        if id not in kept:
+            db.session.delete(quantity)
+
+    existing = dict((method.id, method) for method in recipe.methods)
+    kept = set()
+    for position, item in enumerate(methods):
+        description = item['method'].strip()
+        method = existing.get(item_id(item.get('id')))
+        if method is None:
+            db.session.add(Method(recipe, description, position))
+        else:
+            kept.add(method.id)
+            method.method_description = description
+            method.position = position
+    for id, method in existing.items():
+        if id not in kept:
+            db.session.delete(method)
+
+@views.route('/edit_recipe_items/<int:id>', methods = ['GET','POST'])
+@login_required
+def edit_recipe_items(id):
+    recipe = Recipe.query.options(
+        joinedload(Recipe.quantities).joinedload(Quantity.ingredient),
+        joinedload(Recipe.methods)).filter(Recipe.id == id).first()
+    if recipe is None:
+        abort(404)
+    if recipe.user != current_user:
+        if request.is_json:
+            return jsonify(error='You do not have permission to edit this recipe'), 403
+        flash('You do not have permission to edit this recipe')
+        return redirect(url_for('index'))
+
+    if request.method == 'POST':
+        # every change is made in one transaction, or none at all
+        try:
+            quantities, methods = submitted_recipe_items()
+            apply_recipe_items(recipe, quantities, methods)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            db.session.rollback()
+            message = str(e) if isinstance(e, RecipeItemsError) else 'The ingredients and method could not be saved, please check them'
+            if request.is_json:
+                return jsonify(error=message), 400
+            flash(message)
+            return redirect(url_for('edit_recipe_items', id=id))
+        db.session.commit()
+        if request.is_json:
+            return jsonify(quantities=len(recipe.quantities), methods=len(recipe.methods))
+        return redirect(url_for('recipe_detail', id=id))
+
+    return render_template('edit_recipe_items.html', recipe=recipe,
+        quantity_list=sorted(recipe.quantities, key=lambda quantity: quantity.id),
+        method_list=sorted(recipe.methods, key=lambda method: method.sort_key),
+        measurements_list=reference_list(Measurement), blank_rows=range(BATCH_BLANK_ROWS))
+
 #############################SAVEDRECIPE##########################################
-@app.route('/save_recipe/<id>')
+@views.route('/save_recipe/<id>')
 @login_required
 def save_recipe(id):
     recipe = Recipe.query.get(id)
@@ -479,13 +793,18 @@ def save_recipe(id):
     if existing_saved_recipe is None:
         savedrecipe = SavedRecipe(current_user, recipe)
         db.session.add(savedrecipe)
-        db.session.commit()
-        flash('Recipe added to Saved Recipes')
+        try:
+            db.session.commit()
+            flash('Recipe added to Saved Recipes')
+        except IntegrityError:
+            # saved by another request of the same user in the meantime
+            db.session.rollback()
+            flash('Recipe already added to Saved Recipes')
     else:
         flash('Recipe already added to Saved Recipes')
     return redirect(url_for('recipe_detail', id=id))
 
-@app.route('/delete_saved_recipe/<id>')
+@views.route('/delete_saved_recipe/<id>')
 @login_required
 def delete_saved_recipe(id):
     savedrecipe = SavedRecipe.query.get(id)
@@ -494,39 +813,39 @@ def delete_saved_recipe(id):
     flash('Recipe deleted from My Saved Recipes')
     return redirect(url_for('my_saved_recipes'))
 
-@app.route('/my_saved_recipes')
+@views.route('/my_saved_recipes')
 @login_required
 def my_saved_recipes():
-    recipe_count = SavedRecipe.query.filter_by(user=current_user).count()
-    page = request.args.get('page', 1, type=int)
-    recipes_list = SavedRecipe.query.filter_by(user=current_user).order_by(SavedRecipe.id.desc()).paginate(page, 10, False)
-    next_url = url_for('index', page=recipes_list.next_num) \
-        if recipes_list.has_next else None
-    prev_url = url_for('index', page=recipes_list.prev_num) \
-        if recipes_list.has_prev else None
-    return render_template('my_saved_recipes.html', recipe_count=str(recipe_count), recipes_list=recipes_list.items, next_url=next_url, prev_url=prev_url)
+    recipe_count = app_cache('count').get(('my_saved_recipes', current_user.id), ('saved_recipe',),
+        lambda: SavedRecipe.query.filter_by(user=current_user).count())
+    recipes_page = keyset_paginate(SavedRecipe.query.filter_by(user=current_user).options(joinedload(SavedRecipe.recipe)), SavedRecipe.id, request.args.get('cursor'), current_app.config['RECIPES_PER_PAGE'])
+    next_url = url_for('my_saved_recipes', cursor=recipes_page.next_cursor) \
+        if recipes_page.has_next else None
+    prev_url = url_for('my_saved_recipes', cursor=recipes_page.prev_cursor) \
+        if recipes_page.has_prev else None
+    return render_template('my_saved_recipes.html', recipe_count=str(recipe_count), recipes_list=recipes_page.items, next_url=next_url, prev_url=prev_url)
 
 #############################MANAGE STATIC DATA##########################################
-@app.route('/manage_static_data')
+@views.route('/manage_static_data')
 @login_required
 def manage_static_data():
-    categories_list = Category.query.limit(100).all()
-    courses_list = Course.query.limit(100).all()
-    cuisines_list = Cuisine.query.limit(100).all()
-    countries_list = Country.query.limit(250).all()
-    authors_list = Author.query.limit(100).all()
-    measurements_list = Measurement.query.limit(100).all()
+    categories_list = reference_list(Category)
+    courses_list = reference_list(Course)
+    cuisines_list = reference_list(Cuisine)
+    countries_list = reference_list(Country)
+    authors_list = reference_list(Author)
+    measurements_list = reference_list(Measurement)
     return render_template('manage_static_data.html', categories_list=categories_list, courses_list=courses_list, cuisines_list=cuisines_list, countries_list=countries_list, authors_list=authors_list, measurements_list=measurements_list)
 
 #############################CATEGORY##########################################
-@app.route('/add_category', methods = ['POST'])
+@views.route('/add_category', methods = ['POST'])
 def add_category():
     category = Category(request.form['category'])
     db.session.add(category)
     db.session.commit()
     return redirect(url_for('manage_static_data'))
 
-@app.route('/update_category/<id>', methods = ['POST'])
+@views.route('/update_category/<id>', methods = ['POST'])
 def update_category(id):
     category = Category.query.get(id)
     category.category_name = request.form['category']
@@ -534,14 +853,14 @@ def update_category(id):
     return redirect(url_for('manage_static_data'))
 
 #############################COURSE##########################################
-@app.route('/add_course', methods = ['POST'])
+@views.route('/add_course', methods = ['POST'])
 def add_course():
     course = Course(request.form['course'])
     db.session.add(course)
     db.session.commit()
     return redirect(url_for('manage_static_data'))
 
-@app.route('/update_course/<id>', methods = ['POST'])
+@views.route('/update_course/<id>', methods = ['POST'])
 def update_course(id):
     course = Course.query.get(id)
     course.course_name = request.form['course']
@@ -549,14 +868,14 @@ def update_course(id):
     return redirect(url_for('manage_static_data'))
 
 #############################CUISINE##########################################
-@app.route('/add_cuisine', methods = ['POST'])
+@views.route('/add_cuisine', methods = ['POST'])
 def add_cuisine():
     cuisine = Cuisine(request.form['cuisine'])
     db.session.add(cuisine)
     db.session.commit()
     return redirect(url_for('manage_static_data'))
 
-@app.route('/update_cuisine/<id>', methods = ['POST'])
+@views.route('/update_cuisine/<id>', methods = ['POST'])
 def update_cuisine(id):
     cuisine = Cuisine.query.get(id)
     cuisine.cuisine_name = request.form['cuisine']
@@ -564,14 +883,14 @@ def update_cuisine(id):
     return redirect(url_for('manage_static_data'))
 
 #############################COUNTRY##########################################
-@app.route('/add_country', methods = ['POST'])
+@views.route('/add_country', methods = ['POST'])
 def add_country():
     country = Country(request.form['country'])
     db.session.add(country)
     db.session.commit()
     return redirect(url_for('manage_static_data'))
 
-@app.route('/update_country/<id>', methods = ['POST'])
+@views.route('/update_country/<id>', methods = ['POST'])
 def update_country(id):
     country = Country.query.get(id)
     country.country_name = request.form['country']
@@ -579,48 +898,320 @@ def update_country(id):
     return redirect(url_for('manage_static_data'))
 
 #############################AUTHOR##########################################
-@app.route('/add_author', methods = ['POST'])
+@views.route('/add_author', methods = ['POST'])
 def add_author():
-    author_country = Country.query.filter_by(id=request.form['author_country']).first()
+    author_country = reference_get(Country, request.form['author_country'])
     author = Author(request.form['author'])
-    author_country.authors.append(author)
-    db.session.add(author_country)
+    author.country = author_country
+    db.session.add(author)
     db.session.commit()
     return redirect(url_for('manage_static_data'))
 
-@app.route('/update_author/<id>', methods = ['POST'])
+@views.route('/update_author/<id>', methods = ['POST'])
 def update_author(id):
     author = Author.query.get(id)
     author.author_name = request.form['author']
-    author.country = Country.query.filter_by(id=request.form['author_country']).first()
+    author.country = reference_get(Country, request.form['author_country'])
     db.session.commit()
     return redirect(url_for('manage_static_data'))
 
 #############################MEASUREMENT##########################################
-@app.route('/add_measurement', methods = ['POST'])
+@views.route('/add_measurement', methods = ['POST'])
 def add_measurement():
     measurement = Measurement(request.form['measurement'])
     db.session.add(measurement)
     db.session.commit()
     return redirect(url_for('manage_static_data'))
 
-@app.route('/update_measurement/<id>', methods = ['POST'])
+@views.route('/update_measurement/<id>', methods = ['POST'])
 def update_measurement(id):
     measurement = Measurement.query.get(id)
     measurement.measurement_name = request.form['measurement']
     db.session.commit()
     return redirect(url_for('manage_static_data'))
 
+#############################EXPORT##########################################
+@views.route('/export')
+@login_required
+def export_recipes_file():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+    compress = request.args.get('gzip') == '1'
+    filename = 'recipes.' + export_format + ('.gz' if compress else '')
+    mimetype = 'application/gzip' if compress else ('text/csv' if export_format == 'csv' else 'application/x-ndjson')
+    chunks = export_chunks(db.session, export_format, current_app.config['RECIPE_STREAM_BATCH_SIZE'], compress)
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=' + filename
+    return response
+
+#############################IMAGES##########################################
+@views.route('/images/<path:key>')
+def image_file(key):
+    return image_uploads().storage.send(key, current_app.config['IMAGE_MAX_AGE'])
+
+#############################HEALTH CHECKS##########################################
+@views.route('/healthz')
+def healthz():
+    # liveness: the worker is up and answering requests
+    return jsonify(status='ok')
+
+@views.route('/readyz')
+def readyz():
+    # readiness: this worker has warmed up its caches and can reach the database
+    try:
+        if not is_ready():
+            warm_up(current_app._get_current_object())
+        db.session.execute('SELECT 1')
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.warning('Not ready: %s', e)
+        return jsonify(status='unavailable'), 503
+    return jsonify(status='ready')
+
+@views.route('/metrics')
+def metrics_text():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+#############################CLI COMMANDS##########################################
+@views.cli.command('reindex-search')
+def reindex_search():
+    """Create the recipe search index if needed and index every recipe."""
+    with db.engine.begin() as connection:
+        rebuild_search_index(connection)
+
+@views.cli.command('create-indexes')
+def create_indexes():
+    """Add the indexes of the models to an existing database, dropping duplicate saved recipes first."""
+    with db.engine.begin() as connection:
+        created = add_missing_indexes(connection, db.Model.metadata)
+    click.echo('Created %d indexes%s' % (len(created), ': ' + ', '.join(created) if created else ''))
+
+@views.cli.command('upgrade-db')
+def upgrade_db():
+    """Add the columns and indexes of the models to an existing database, filling in and merging ingredients."""
+    with db.engine.begin() as connection:
+        changes = upgrade_schema(connection, db.Model.metadata)
+    for change in changes:
+        click.echo(change)
+    click.echo('Database is up to date' if changes else 'Nothing to upgrade')
+
+@views.cli.command('recover-uploads')
+def recover_uploads():
+    """Queue the images left pending by stopped workers again, or mark them failed when their file is gone."""
+    queue = current_app.extensions['image_uploads']
+    queued, failed = queue.recover()
+    queue.wait()
+    click.echo('%d images uploaded again, %d marked failed' % (queued, failed))
+
+@views.cli.command('import-recipes')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'input_format', type=click.Choice(IMPORT_FORMATS), help='Defaults to the file extension.')
+@click.option('--batch-size', default=1000, show_default=True, help='Recipes written per transaction.')
+def import_recipes(path, input_format, batch_size):
+    """Import recipes from a JSON array, NDJSON or CSV file, skipping those already present."""
+    if input_format is None:
+        extension = os.path.splitext(path)[1].lstrip('.').lower()
+        input_format = {'jsonl': 'ndjson'}.get(extension, extension)
+        if input_format not in IMPORT_FORMATS:
+            raise click.UsageError('Cannot tell the format of %s, use --format' % path)
+
+    def progress(stats):
+        click.echo('%d recipes imported, %d skipped, %d invalid, %.0f rows/s' % (stats.recipes, stats.skipped, stats.invalid, stats.rate))
+
+    importer = RecipeImporter(db.engine, batch_size, progress)
+    with click.open_file(path, encoding='utf-8') as stream:
+        stats = importer.run(READERS[input_format](stream))
+    click.echo('Done: %d recipes imported, %d skipped, %d invalid, %.0f rows/s' % (stats.recipes, stats.skipped, stats.invalid, stats.rate))
+
+@views.cli.command('export-recipes')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option('--format', 'export_format', type=click.Choice(EXPORT_FORMATS), help='Defaults to the file extension.')
+@click.option('--gzip', 'compress', is_flag=True, default=None, help='Compress the output, the default for .gz files.')
+@click.option('--batch-size', default=1000, show_default=True, help='Recipes read per query.')
+def export_recipes(path, export_format, compress, batch_size):
+    """Export every recipe, with its ingredients and methods, as NDJSON or CSV."""
+    name = path.lower()
+    if compress is None:
+        compress = name.endswith('.gz')
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if export_format is None:
+        extension = os.path.splitext(name)[1].lstrip('.')
+        export_format = {'jsonl': 'ndjson'}.get(extension, extension)
+        if export_format not in EXPORT_FORMATS:
+            raise click.UsageError('Cannot tell the format of %s, use --format' % path)
+
+    written = 0
+    with click.open_file(path, 'wb') as stream:
+        for chunk in export_chunks(db.session, export_format, batch_size, compress):
+            stream.write(chunk)
+            written += len(chunk)
+    click.echo('Exported %d bytes to %s' % (written, path), err=True)
+
+@views.cli.command('serve')
+@click.option('--bind', help='Address to listen on, by default 0.0.0.0:$PORT.')
+@click.option('--workers', type=int, help='Worker processes, by default derived from the number of CPUs.')
+@click.option('--threads', type=int, help='Threads per gthread worker.')
+@click.option('--worker-class', type=click.Choice(['sync', 'gthread', 'gevent']), help='Worker model, gthread by default.')
+def serve(bind, workers, threads, worker_class):
+    """Serve the app with gunicorn, configured by gunicorn.conf.py and the options given."""
+    args = ['gunicorn', '--config', os.path.join(BASEDIR, 'gunicorn.conf.py'), '--chdir', BASEDIR]
+    for option, value in (('--bind', bind), ('--workers', workers), ('--threads', threads), ('--worker-class', worker_class)):
+        if value is not None:
+            args.extend([option, str(value)])
+    args.append('wsgi:app')
+    if worker_class is not None:
+        # gunicorn.conf.py sizes the workers and patches for gevent from this as well
+        os.environ['GUNICORN_WORKER_CLASS'] = worker_class
+    os.execvp(args[0], args)
+
+@views.cli.command('generate-data')
+@click.option('--recipes', default=10000, show_default=True, help='Recipes to add.')
+@click.option('--users', default=100, show_default=True, help='Users the recipes are shared between.')
+@click.option('--saved', default=10, show_default=True, help='Recipes saved by each user.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--batch-size', default=1000, show_default=True, help='Recipes written per transaction.')
+def generate_data(recipes, users, saved, seed, batch_size):
+    """Fill the database with a synthetic recipe book for benchmarks."""
+    # imported here rather than by every web worker
+    from benchmarks import datagen
+
+    def progress(stats):
+        click.echo('%d recipes generated, %.0f rows/s' % (stats.recipes, stats.rate))
+
+    stats = datagen.populate(db.engine, recipes, users, saved, seed, batch_size, progress)
+    click.echo('Done: %d recipes generated, %d skipped, %.0f rows/s' % (stats.recipes, stats.skipped, stats.rate))
+
+@views.cli.command('benchmark')
+@click.option('--url', default='http://localhost:5000', show_default=True, help='Server to drive, using this database.')
+@click.option('--requests', 'request_count', default=500, show_default=True, help='Requests sent to each route.')
+@click.option('--concurrency', default=8, show_default=True, help='Requests in flight at once.')
+@click.option('--route', 'routes', multiple=True, type=click.Choice(ROUTE_NAMES), help='Routes to drive, all by default.')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='Save the results to this JSON file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Results of an earlier run to compare with.')
+@click.option('--tolerance', default=0.1, show_default=True, help='Change from the baseline counted as a regression.')
+@click.option('--logged-in', default=0.25, show_default=True, help='Share of the connections logged in as a generated user.')
+@click.option('--follow', default=0.5, show_default=True, help='Share of the requests going to the next page of the last response.')
+@click.option('--bypass-page-cache', is_flag=True, help='Give every request its own URL, so none is answered by the page cache.')
+def benchmark(url, request_count, concurrency, routes, output, baseline, tolerance, logged_in, follow, bypass_page_cache):
+    """Load test the routes of a running server and report throughput and latency percentiles for each."""
+    from benchmarks import loadgen
+
+    with db.engine.connect() as connection:
+        samples = loadgen.Samples(connection)
+    dataset = dict((table, db.session.query(func.count(model.id)).scalar())
+                   for table, model in (('recipe', Recipe), ('user', User), ('ingredient', Ingredient)))
+
+    def progress(name, result):
+        click.echo('%-22s %8.1f req/s  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  %d errors' % (
+            name, result['throughput'] or 0, (result['p50'] or 0) * 1000, (result['p95'] or 0) * 1000,
+            (result['p99'] or 0) * 1000, result['errors']))
+
+    options = {'logged_in': logged_in, 'follow': follow, 'bypass_cache': bypass_page_cache}
+    results = {
+        'url': url,
+        'requests': request_count,
+        'concurrency': concurrency,
+        'options': options,
+        'dataset': dataset,
+        'routes': loadgen.run(url, samples, request_count, concurrency, routes or ROUTE_NAMES, progress, **options),
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline) as f:
+            regressions = loadgen.compare(results['routes'], json.load(f)['routes'], tolerance)
+        for line in regressions:
+            click.echo('Regression: ' + line, err=True)
+        if regressions:
+            raise click.ClickException('%d regressions against %s' % (len(regressions), baseline))
+
+@views.cli.command('compile-templates')
+def compile_templates():
+    """Compile every template into the template bytecode cache, as a build step before workers start."""
+    env = current_app.jinja_env
+    if env.bytecode_cache is None:
+        raise click.UsageError('TEMPLATE_CACHE_DIR is not set')
+    names = env.list_templates()
+    for name in names:
+        # load through the loader rather than get_template, which would not reach the cache for templates it holds
+        env.loader.load(env, name)
+    click.echo('Compiled %d templates into %s' % (len(names), current_app.config['TEMPLATE_CACHE_DIR']))
+
+@views.cli.command('startup-report')
+def startup_report_command():
+    """Warm the app up and print how long each start up step took."""
+    warm_up(current_app)
+    click.echo(startup_report())
+
 #############################HTTP ERRORS##########################################
-@app.errorhandler(404)
+@views.errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
 
-@app.errorhandler(500)
+@views.errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
 
+#############################APP FACTORY##########################################
+def warm_up(app):
+    """
+    Fill the reference, dashboard and count caches and compile every template, the work a worker would otherwise do
+    in its first requests, and take up the image uploads a stopped worker left pending. Meant to run in each worker
+    once it has forked, as it opens database connections and starts the upload threads.
+    """
+    with timed('warm_up'), app.app_context():
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+        for model in (Category, Course, Cuisine, Country, Author, Measurement):
+            reference_list(model)
+        app_cache('stats').get('stats', RECIPE_DIMENSION_TABLES, recipe_stats)
+        app_cache('count').get('recipes', ('recipe',), lambda: Recipe.query.count())
+    app.extensions['image_uploads'].recover()
+    mark_ready()
+
+def create_app(config=None):
+    """
+    Create the app, configured from the .env file and the environment and then from config. Nothing here connects to
+    the database or S3 or starts a thread: connections, the S3 client and the upload workers are all made by the
+    process that first needs them, so an app created in a preloading master process can be forked into workers.
+    """
+    with timed('create_app'):
+        app = Flask(__name__)
+        DotEnv(app)
+        app.config.update(default_config())
+        if config:
+            app.config.update(config)
+
+        make_pools_fork_safe()
+        db.init_app(app)
+        migrate.init_app(app, db)
+        login_manager.init_app(app)
+        login_manager.login_view = 'login'
+
+        # caches and the upload queue belong to the app, so apps made in one process never share them
+        for name, maxsize in (('stats', 1), ('columns', 1), ('count', 1024), ('reference', 16),
+                              ('user', app.config['USER_CACHE_SIZE']), ('fragment', app.config['FRAGMENT_CACHE_SIZE']),
+                              ('page', app.config['PAGE_CACHE_SIZE']), ('facet', app.config['FACET_CACHE_SIZE'])):
+            add_app_cache(app, name, maxsize)
+        UploadQueue(app, create_image_storage(app.config))
+        views.init_app(app)
+        metrics.init_app(app)
+
+        if app.config['TEMPLATE_CACHE_DIR']:
+            os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+            app.jinja_env.bytecode_cache = TemplateBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+
+    if app.config['WARM_UP']:
+        warm_up(app)
+    app.logger.info('Started up: %s', startup_report())
+    return app
+
+record('import', IMPORT_STARTED)
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=port)
\ No newline at end of file
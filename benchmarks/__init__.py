@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""Load benchmarks. datagen fills a database with a synthetic recipe book of any size, and loadgen drives the routes of
+a running server with concurrent requests and reports throughput and latency percentiles per route. Both are run
+through the flask CLI:
+
+    flask generate-data --recipes 100000 --users 1000
+    flask serve
+    flask benchmark --requests 2000 --concurrency 16 --output results.json --baseline baseline.json
+    flask benchmark --bypass-page-cache --logged-in 0 --follow 0   # anonymous first pages, none from the page cache
+"""
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Synthetic recipe books. Recipes are generated as import records and written in batches by the bulk importer, and
+users and their saved recipes are added around the import. The same seed always gives the same data, and running
+again adds recipes after those already there instead of repeating them."""
+import random
+
+from sqlalchemy import func, select
+
+import cache
+from bulk import RecipeImporter
+from models import Recipe, User, SavedRecipe
+
+CATEGORIES = ('Vegetarian', 'Vegan', 'Meat', 'Fish', 'Gluten Free', 'Dairy Free', 'Low Carb', 'Quick')
+COURSES = ('Breakfast', 'Starter', 'Soup', 'Salad', 'Main', 'Side', 'Dessert', 'Snack', 'Drink')
+CUISINES = ('Italian', 'French', 'Indian', 'Chinese', 'Japanese', 'Mexican', 'Lebanese', 'Greek', 'Thai', 'Spanish',
+            'Moroccan', 'Irish', 'American', 'Korean', 'Turkish')
+COUNTRIES = ('Ireland', 'United Kingdom', 'France', 'Italy', 'Spain', 'India', 'Japan', 'Mexico', 'Lebanon',
+             'United States', 'Greece', 'Thailand', 'Morocco', 'Korea', 'Turkey')
+MEASUREMENTS = ('g', 'kg', 'ml', 'l', 'tsp', 'tbsp', 'cup', 'pinch', 'clove', 'slice', 'piece', 'bunch', 'can')
+FIRST_NAMES = ('Aoife', 'Sean', 'Maria', 'Luca', 'Priya', 'Kenji', 'Sofia', 'Omar', 'Chloe', 'Mateo', 'Yasmin',
+               'Dimitri', 'Nadia', 'Tom', 'Mei', 'Carlos', 'Fatima', 'Hugo', 'Ines', 'Ravi')
+LAST_NAMES = ('Murphy', 'Rossi', 'Dubois', 'Sharma', 'Tanaka', 'Garcia', 'Haddad', 'Papadopoulos', 'Smith', 'Kim',
+              'Yilmaz', 'Benali', 'Novak', 'Walsh', 'Chen', 'Lopez', 'Silva', 'Okafor', 'Nguyen', 'Ali')
+INGREDIENTS = ('chicken', 'beef', 'pork', 'lamb', 'salmon', 'cod', 'prawns', 'tofu', 'egg', 'milk', 'butter', 'cream',
+               'cheddar', 'parmesan', 'feta', 'yogurt', 'flour', 'rice', 'pasta', 'noodles', 'bread', 'oats',
+               'potato', 'sweet potato', 'carrot', 'onion', 'red onion', 'garlic', 'ginger', 'tomato', 'pepper',
+               'chilli', 'courgette', 'aubergine', 'spinach', 'kale', 'broccoli', 'cauliflower', 'mushroom', 'peas',
+               'chickpeas', 'lentils', 'black beans', 'lemon', 'lime', 'orange', 'apple', 'banana', 'strawberries',
+               'sugar', 'honey', 'olive oil', 'sesame oil', 'soy sauce', 'vinegar', 'salt', 'black pepper', 'cumin',
+               'paprika', 'turmeric', 'cinnamon', 'basil', 'coriander', 'parsley', 'mint', 'thyme', 'rosemary',
+               'coconut milk', 'stock', 'almonds', 'walnuts', 'chocolate', 'vanilla')
+ADJECTIVES = ('Smoky', 'Spicy', 'Creamy', 'Crispy', 'Roasted', 'Grilled', 'Slow Cooked', 'Zesty', 'Hearty', 'Simple',
+              'Sticky', 'Golden', 'Herby', 'Rustic', 'Summer', 'Winter', 'Sweet', 'Tangy', 'Baked', 'Fresh')
+DISHES = ('Stew', 'Curry', 'Salad', 'Soup', 'Pie', 'Risotto', 'Tart', 'Stir Fry', 'Bake', 'Burger', 'Tacos', 'Bowl',
+          'Skewers', 'Pancakes', 'Cake', 'Gratin', 'Noodles', 'Wraps', 'Frittata', 'Crumble')
+STEPS = ('Preheat the oven to {n}0 degrees.', 'Chop the {i} finely.', 'Fry the {i} in a little oil for {n} minutes.',
+         'Add the {i} and stir well.', 'Simmer gently for {n}5 minutes.', 'Season with salt and pepper.',
+         'Whisk the {i} until smooth.', 'Bake for {n}0 minutes until golden.', 'Leave to rest for {n} minutes.',
+         'Serve with the {i} on the side.')
+
+# every pairing of a first and a last name
+AUTHORS = len(FIRST_NAMES) * len(LAST_NAMES)
+USER_PASSWORD = 'password'
+
+
+def username(number):
+    return 'user{}@example.com'.format(number)
+
+
+def recipe_record(rng, number, users):
+    ingredients = rng.sample(INGREDIENTS, rng.randint(3, 12))
+    author = rng.randrange(AUTHORS)
+    return {
+        # the number keeps names unique, which the importer relies on
+        'recipe_name': '{} {} {} {}'.format(rng.choice(ADJECTIVES), ingredients[0].title(), rng.choice(DISHES), number),
+        'recipe_description': 'A {} dish of {} and {}.'.format(rng.choice(ADJECTIVES).lower(), ingredients[0],
+                                                              ingredients[1]),
+        'preparation_time': rng.choice((5, 10, 15, 20, 30, 45)),
+        'cooking_time': rng.choice((0, 10, 20, 30, 45, 60, 90, 120)),
+        'servings': rng.randint(1, 8),
+        'category': rng.choice(CATEGORIES),
+        'course': rng.choice(COURSES),
+        'cuisine': rng.choice(CUISINES),
+        'author': '{} {}'.format(FIRST_NAMES[author % len(FIRST_NAMES)], LAST_NAMES[author // len(FIRST_NAMES)]),
+        'author_country': COUNTRIES[author % len(COUNTRIES)],
+        'username': username(rng.randrange(users)) if users and rng.random() < 0.8 else None,
+        'ingredients': [{'quantity': rng.choice((0.5, 1, 2, 3, 100, 200, 250, 500)),
+                         'measurement': rng.choice(MEASUREMENTS), 'ingredient': ingredient}
+                        for ingredient in ingredients],
+        'methods': [rng.choice(STEPS).format(i=rng.choice(ingredients), n=rng.randint(1, 9))
+                    for _ in range(rng.randint(3, 8))],
+    }
+
+
+def generate_records(count, users, seed=0, start=0):
+    """Yield count recipe records numbered from start; the same seed and start give the same records."""
+    rng = random.Random('{}:{}'.format(seed, start))
+    for number in range(start, start + count):
+        yield recipe_record(rng, number, users)
+
+
+def add_users(connection, count):
+    existing = set(name for name, in connection.execute(select([User.username])))
+    rows = [{'username': username(number), 'password': USER_PASSWORD} for number in range(count)
+            if username(number) not in existing]
+    if rows:
+        connection.execute(User.__table__.insert(), rows)
+    return len(rows)
+
+
+def add_saved_recipes(connection, per_user, seed=0):
+    """Have each user without saved recipes save up to per_user random ones."""
+    rng = random.Random(seed)
+    recipe_ids = [id for id, in connection.execute(select([Recipe.id]))]
+    savers = set(id for id, in connection.execute(select([SavedRecipe.user_id]).distinct()))
+    rows = []
+    for user_id, in connection.execute(select([User.id]).order_by(User.id)):
+        if user_id not in savers:
+            rows.extend({'user_id': user_id, 'recipe_id': recipe_id}
+                        for recipe_id in rng.sample(recipe_ids, min(per_user, len(recipe_ids))))
+    if rows:
+        connection.execute(SavedRecipe.__table__.insert(), rows)
+    return len(rows)
+
+
+def populate(engine, recipes, users, saved_per_user=10, seed=0, batch_size=1000, progress=None):
+    """Add users, then recipes, then saved recipes to the database, and return the import stats."""
+    with engine.begin() as connection:
+        add_users(connection, users)
+        start = connection.execute(select([func.count(Recipe.id)])).scalar()
+    stats = RecipeImporter(engine, batch_size, progress).run(generate_records(recipes, users, seed, start))
+    with engine.begin() as connection:
+        add_saved_recipes(connection, saved_per_user, seed)
+    cache.bump('user', 'saved_recipe')
+    return stats
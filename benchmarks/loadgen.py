@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""A local load generator. Each route is driven in turn by a pool of threads that each keep one HTTP connection open,
+sending requests built from samples of the data in the database, and the latency of every request is recorded.
+Some threads log in as a generated user first, and some requests follow the next page link of the thread's last
+response, so logged in pages and deeper keyset pages are measured as well as the anonymous first pages the page
+cache answers. With bypass_cache every request gets a query argument of its own, so none is served from that cache.
+Any response other than a 2xx or 3xx counts as an error.
+Results are plain dicts, saved as JSON and compared against an earlier run to catch regressions."""
+import html
+import http.client
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+from sqlalchemy import func, select
+
+from benchmarks.datagen import ADJECTIVES, DISHES, INGREDIENTS, USER_PASSWORD, username
+from benchmarks.routes import ROUTE_NAMES
+from models import Recipe, Category, Course, Cuisine, Author, User
+
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+CSRF_TOKEN = re.compile(rb'name="csrf_token"[^>]*value="([^"]+)"')
+NEXT_PAGE = re.compile(rb'href="([^"]+)">Next page')
+
+
+class Samples(object):
+    """Ids and words to build requests from, read once from the database the server uses."""
+
+    def __init__(self, connection, seed=0, size=1000):
+        self.rng = random.Random(seed)
+        low, high = connection.execute(select([func.min(Recipe.id), func.max(Recipe.id)])).first()
+        candidates = [self.rng.randint(low, high) for _ in range(size)] if low is not None else []
+        # ids may have gaps, so only those that exist are kept
+        self.recipe_ids = [id for id, in connection.execute(select([Recipe.id]).where(Recipe.id.in_(candidates)))]
+        self.reference_ids = dict(
+            (field, [id for id, in connection.execute(select([model.id]).limit(size))])
+            for field, model in (('recipe_category', Category), ('recipe_course', Course),
+                                 ('recipe_cuisine', Cuisine), ('recipe_author', Author)))
+        # generated users, who all share one password
+        self.usernames = [name for name, in connection.execute(
+            select([User.username]).where(User.username.like(username('%'))).limit(size))]
+
+    def choice(self, values):
+        return self.rng.choice(values) if values else ''
+
+
+class Client(object):
+    """One HTTP connection of one thread, sending back the cookies the server set on it."""
+
+    def __init__(self, url, timeout=30):
+        self.parts = urlsplit(url)
+        self.timeout = timeout
+        self.cookies = {}
+        self.connection = None
+        # the next page link of the last response, if it had one
+        self.next_path = None
+
+    def request(self, method, path, body=None):
+        """Send a request and return its status and body; the connection is closed again if it fails."""
+        if self.connection is None:
+            connection_class = http.client.HTTPSConnection if self.parts.scheme == 'https' else http.client.HTTPConnection
+            self.connection = connection_class(self.parts.hostname, self.parts.port, timeout=self.timeout)
+        headers = dict(FORM_HEADERS) if body is not None else {}
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % cookie for cookie in sorted(self.cookies.items()))
+        try:
+            self.connection.request(method, self.parts.path.rstrip('/') + path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+        for cookie in response.headers.get_all('Set-Cookie') or []:
+            name, _, value = cookie.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value
+        link = NEXT_PAGE.search(data)
+        self.next_path = html.unescape(link.group(1).decode('utf-8')) if link else None
+        return response.status, data
+
+    def login(self, name, password=USER_PASSWORD):
+        """Log in through the login form, and return whether the server accepted it."""
+        status, page = self.request('GET', '/login')
+        form = {'username': name, 'password': password}
+        token = CSRF_TOKEN.search(page)
+        if token:
+            form['csrf_token'] = html.unescape(token.group(1).decode('utf-8'))
+        status, page = self.request('POST', '/login', urlencode(form))
+        return status == 302
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def _index(samples):
+    return 'GET', '/', None
+
+
+def _recipe_detail(samples):
+    return 'GET', '/recipe_detail/{}'.format(samples.choice(samples.recipe_ids) or 0), None
+
+
+def _recipe_search(samples):
+    term = samples.choice((samples.choice(ADJECTIVES), samples.choice(DISHES), samples.choice(INGREDIENTS)))
+    return 'GET', '/recipe_search?' + urlencode({'recipe_name': term}), None
+
+
+def _ingredient_search(samples):
+    names = samples.rng.sample(INGREDIENTS, samples.rng.randint(1, 3))
+    return 'GET', '/ingredient_search?' + urlencode({'ingredient_name': ', '.join(names)}), None
+
+
+def _recipe_list_filtered(samples):
+    # filter on one or two of the dimensions, as a visitor would
+    fields = samples.rng.sample(sorted(samples.reference_ids), samples.rng.randint(1, 2))
+    return 'POST', '/recipe_list_filtered', urlencode(dict((field, samples.choice(samples.reference_ids[field]))
+                                                           for field in fields))
+
+
+def _get_recipes(samples):
+    return 'GET', '/get_recipes', None
+
+
+def _get_recipes_columnar(samples):
+    return 'GET', '/get_recipes?format=columnar', None
+
+
+ROUTES = (('index', _index),
+          ('recipe_detail', _recipe_detail),
+          ('recipe_search', _recipe_search),
+          ('ingredient_search', _ingredient_search),
+          ('recipe_list_filtered', _recipe_list_filtered),
+          ('get_recipes', _get_recipes),
+          ('get_recipes_columnar', _get_recipes_columnar))
+
+
+def percentile(ordered, fraction):
+    # nearest rank of a sorted list
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def summarize(latencies, errors, seconds):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput': round(len(latencies) / seconds, 2) if seconds else None,
+        'mean': round(sum(ordered) / len(ordered), 6) if ordered else None,
+        'p50': percentile(ordered, 0.50),
+        'p95': percentile(ordered, 0.95),
+        'p99': percentile(ordered, 0.99),
+    }
+
+
+def drive(url, build, samples, requests, concurrency, logged_in=0.25, follow=0.5, bypass_cache=False, timeout=30):
+    """
+    Send requests built by build(samples) from concurrency threads and return the route's summary. A logged_in share of
+    the threads log in first, and a follow share of the requests go to the next page of the thread's last response.
+    """
+    local = threading.local()
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    clients = []
+    sessions = int(concurrency * logged_in + 0.5) if samples.usernames else 0
+    followed = [0]
+
+    def client():
+        # each thread makes its client, and logs it in if it is one of the first threads, before its first request
+        if getattr(local, 'client', None) is None:
+            local.client = Client(url, timeout)
+            with lock:
+                clients.append(local.client)
+                name = samples.choice(samples.usernames) if len(clients) <= sessions else None
+            if name is not None and not local.client.login(name):
+                raise http.client.HTTPException('%s could not log in' % name)
+        return local.client
+
+    def send(_):
+        with lock:
+            method, path, body = build(samples)
+            deeper = samples.rng.random() < follow
+        try:
+            connection = client()
+        except (OSError, http.client.HTTPException):
+            with lock:
+                errors[0] += 1
+            return
+        if deeper and connection.next_path:
+            method, path, body = 'GET', connection.next_path, None
+            with lock:
+                followed[0] += 1
+        if bypass_cache and method == 'GET':
+            path += ('&' if '?' in path else '?') + '_=' + uuid.uuid4().hex
+        started = time.perf_counter()
+        try:
+            status, _ = connection.request(method, path, body)
+            failed = not 200 <= status < 400
+        except (OSError, http.client.HTTPException):
+            failed = True
+        elapsed = time.perf_counter() - started
+        with lock:
+            if failed:
+                errors[0] += 1
+            else:
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(requests)))
+    seconds = time.perf_counter() - started
+    for connection in clients:
+        connection.close()
+    result = summarize(latencies, errors[0], seconds)
+    result.update(sessions=min(sessions, len(clients)), followed=followed[0])
+    return result
+
+
+def run(url, samples, requests, concurrency, routes=ROUTE_NAMES, progress=None, **options):
+    results = {}
+    for name, build in ROUTES:
+        if name in routes:
+            results[name] = drive(url, build, samples, requests, concurrency, **options)
+            if progress is not None:
+                progress(name, results[name])
+    return results
+
+
+def compare(routes, baseline, tolerance=0.1):
+    """
+    Return a line for each route whose p95 latency grew, or whose throughput fell, by more than tolerance compared
+    with the baseline run. Routes missing from either run are left out.
+    """
+    regressions = []
+    for name, result in sorted(routes.items()):
+        before = baseline.get(name)
+        if not before:
+            continue
+        if result['p95'] is not None and before['p95'] and result['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.1f}ms, was {:.1f}ms'.format(name, result['p95'] * 1000, before['p95'] * 1000))
+        if result['throughput'] is not None and before['throughput'] and \
+                result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append('{}: {:.1f} requests/s, was {:.1f}'.format(name, result['throughput'], before['throughput']))
+    return regressions
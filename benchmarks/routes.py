@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""The names of the routes loadgen drives, apart from it so that the benchmark command can offer them as choices
+without the web app importing the load generator."""
+
+ROUTE_NAMES = ('index', 'recipe_detail', 'recipe_search', 'ingredient_search', 'recipe_list_filtered', 'get_recipes',
+               'get_recipes_columnar')
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Bulk import of recipe catalogues. Records are streamed from JSON, NDJSON or CSV and written with batched Core
+inserts, one transaction per batch, instead of one ORM commit per recipe, ingredient and step. Reference rows are
+looked up in name to id maps that are read once up front. Recipes whose name is already in the database are skipped,
+so an import that stopped part way can simply be run again."""
+import csv
+import json
+import logging
+import time
+
+from sqlalchemy import select
+
+import cache
+from models import Recipe, Category, Course, Cuisine, Country, Author, Measurement, Ingredient, Quantity, Method, User, \
+    normalize_ingredient_name
+
+log = logging.getLogger(__name__)
+
+IMPORT_FORMATS = ('json', 'ndjson', 'csv')
+DEFAULT_COUNTRY = 'Unknown'
+READ_SIZE = 64 * 1024
+
+# every table an import may write to, whose cached data goes stale once a batch is committed
+IMPORT_TABLES = ('recipe', 'quantity', 'method', 'ingredient', 'measurement', 'category', 'course', 'cuisine',
+                 'author', 'country')
+
+
+#############################READERS##########################################
+def read_ndjson(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_json(stream):
+    """Yield the objects of a top level JSON array one at a time, without reading the whole file."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    while True:
+        # skip the separators between array items
+        while position < len(buffer) and buffer[position] in ' \t\r\n[,]':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                return
+            buffer, position = stream.read(READ_SIZE), 0
+            eof = not buffer
+            continue
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                raise
+            # the next item is cut off by the end of the buffer, so read on
+            chunk = stream.read(READ_SIZE)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield record
+        position = end
+
+
+def read_csv(stream):
+    """Yield the rows of a CSV file, whose ingredients and methods cells hold JSON lists."""
+    for row in csv.DictReader(stream):
+        for field in ('ingredients', 'methods'):
+            row[field] = json.loads(row[field]) if row.get(field) else []
+        yield row
+
+
+READERS = {'json': read_json, 'ndjson': read_ndjson, 'csv': read_csv}
+
+
+#############################IMPORT##########################################
+class NameMap(object):
+    """Ids of the rows of a reference table by name, adding a row the first time a new name is seen."""
+
+    def __init__(self, connection, model, column):
+        self.table = model.__table__
+        self.column = column
+        self.ids = {}
+        for id, name in connection.execute(select([self.table.c.id, column]).order_by(self.table.c.id)):
+            self.ids.setdefault(name, id)
+
+    def get(self, connection, name, **values):
+        id = self.ids.get(name)
+        if id is None:
+            values[self.column.key] = name
+            id = connection.execute(self.table.insert().values(**values)).inserted_primary_key[0]
+            self.ids[name] = id
+        return id
+
+
+class IngredientMap(NameMap):
+    """Ingredient ids by normalized name, so differently spelled names of one ingredient share a row."""
+
+    def __init__(self, connection):
+        NameMap.__init__(self, connection, Ingredient, Ingredient.normalized_name)
+
+    def get(self, connection, name, **values):
+        return NameMap.get(self, connection, normalize_ingredient_name(name), ingredient_name=name, **values)
+
+
+class ImportStats(object):
+
+    def __init__(self):
+        self.recipes = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.rows = 0
+        self.started = time.time()
+
+    @property
+    def rate(self):
+        return self.rows / max(time.time() - self.started, 1e-6)
+
+
+def _text(record, field):
+    value = record.get(field)
+    return value.strip() if isinstance(value, str) and value.strip() else None
+
+
+def _number(record, field, type=int):
+    value = record.get(field)
+    return type(value) if value not in (None, '') else None
+
+
+class RecipeImporter(object):
+
+    def __init__(self, engine, batch_size=1000, progress=None):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.progress = progress
+        self.stats = ImportStats()
+        with engine.connect() as connection:
+            self.maps = dict((model, NameMap(connection, model, column)) for model, column in (
+                (Category, Category.category_name),
+                (Course, Course.course_name),
+                (Cuisine, Cuisine.cuisine_name),
+                (Country, Country.country_name),
+                (Author, Author.author_name),
+                (Measurement, Measurement.measurement_name),
+                (User, User.username)))
+            self.maps[Ingredient] = IngredientMap(connection)
+            self.existing = set(name for name, in connection.execute(select([Recipe.recipe_name])))
+
+    def run(self, records):
+        batch = []
+        for record in records:
+            name = _text(record, 'recipe_name')
+            if name is None or name in self.existing:
+                self.stats.skipped += 1
+                continue
+            self.existing.add(name)
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+        return self.stats
+
+    def _lookup(self, connection, model, name, **values):
+        return self.maps[model].get(connection, name, **values)
+
+    def _parse(self, record):
+        # check and clean a whole record before any of its reference rows are added
+        parsed = dict((field, _text(record, field)) for field in (
+            'recipe_name', 'category', 'course', 'cuisine', 'author', 'author_country', 'username'))
+        for field in ('category', 'course', 'cuisine', 'author'):
+            if parsed[field] is None:
+                raise ValueError('no %s' % field)
+        parsed['recipe_description'] = record.get('recipe_description')
+        for field in ('preparation_time', 'cooking_time', 'servings'):
+            parsed[field] = _number(record, field)
+        parsed['quantities'] = []
+        for item in record.get('ingredients') or []:
+            ingredient, measurement = _text(item, 'ingredient'), _text(item, 'measurement')
+            if ingredient is None or measurement is None:
+                raise ValueError('ingredient without a name or measurement')
+            parsed['quantities'].append((_number(item, 'quantity', float), ingredient, measurement))
+        parsed['methods'] = [str(method) for method in record.get('methods') or []]
+        return parsed
+
+    def _recipe_row(self, connection, parsed):
+        author_id = self.maps[Author].ids.get(parsed['author'])
+        if author_id is None:
+            country_id = self._lookup(connection, Country, parsed['author_country'] or DEFAULT_COUNTRY)
+            author_id = self._lookup(connection, Author, parsed['author'], country_id=country_id)
+        return {
+            'recipe_name': parsed['recipe_name'],
+            'recipe_description': parsed['recipe_description'],
+            'preparation_time': parsed['preparation_time'],
+            'cooking_time': parsed['cooking_time'],
+            'servings': parsed['servings'],
+            'category_id': self._lookup(connection, Category, parsed['category']),
+            'course_id': self._lookup(connection, Course, parsed['course']),
+            'cuisine_id': self._lookup(connection, Cuisine, parsed['cuisine']),
+            'author_id': author_id,
+            # users are never created by an import, unknown ones are left out
+            'user_id': self.maps[User].ids.get(parsed['username']) if parsed['username'] else None,
+        }
+
+    def _write(self, batch):
+        with self.engine.begin() as connection:
+            recipes = []
+            details = []
+            for record in batch:
+                try:
+                    parsed = self._parse(record)
+                except (TypeError, ValueError, AttributeError) as e:
+                    log.warning('Skipping recipe %r: %s', record.get('recipe_name'), e)
+                    self.stats.invalid += 1
+                    continue
+                recipes.append(self._recipe_row(connection, parsed))
+                details.append((parsed['recipe_name'],
+                                [(quantity, self._lookup(connection, Ingredient, ingredient),
+                                  self._lookup(connection, Measurement, measurement))
+                                 for quantity, ingredient, measurement in parsed['quantities']],
+                                parsed['methods']))
+            if not recipes:
+                return
+
+            connection.execute(Recipe.__table__.insert(), recipes)
+            # executemany does not return the new ids, so they are read back by the unique recipe names
+            ids = dict((name, id) for id, name in connection.execute(
+                select([Recipe.id, Recipe.recipe_name]).where(Recipe.recipe_name.in_([r['recipe_name'] for r in recipes]))))
+            quantity_rows = []
+            method_rows = []
+            for name, quantities, methods in details:
+                quantity_rows.extend({'recipe_id': ids[name], 'quantity': quantity, 'ingredient_id': ingredient_id,
+                                      'measurement_id': measurement_id}
+                                     for quantity, ingredient_id, measurement_id in quantities)
+                method_rows.extend({'recipe_id': ids[name], 'method_description': method, 'position': position}
+                                   for position, method in enumerate(methods))
+            if quantity_rows:
+                connection.execute(Quantity.__table__.insert(), quantity_rows)
+            if method_rows:
+                connection.execute(Method.__table__.insert(), method_rows)
+
+        # Core inserts are not seen by the session listeners that keep the caches current
+        cache.bump(*IMPORT_TABLES)
+        self.stats.recipes += len(recipes)
+        self.stats.rows += len(recipes) + len(quantity_rows) + len(method_rows)
+        if self.progress is not None:
+            self.progress(self.stats)
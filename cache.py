@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""In-process caches. Every table has a data version which is bumped when a commit changes rows in it,
+cached values remember the versions they were built from and are rebuilt as soon as those move on.
+Each app has caches of its own, kept in app.extensions, so apps made in the same process never serve each other's data."""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import event
+
+_versions = {}
+_changed_at = {}
+_started_at = time.time()
+_lock = threading.Lock()
+_row_keys = []
+
+
+def data_version(*tables):
+    """Return the current versions of the given tables as a tuple."""
+    return tuple(_versions.get(table, 0) for table in tables)
+
+
+def last_changed(*tables):
+    """Return the time the given tables were last changed by this process, or the time it started."""
+    return max([_changed_at.get(table, _started_at) for table in tables] or [_started_at])
+
+
+def bump(*tables):
+    """Invalidate everything cached from the given tables, e.g. after writing to them without the ORM."""
+    now = time.time()
+    with _lock:
+        for table in tables:
+            _versions[table] = _versions.get(table, 0) + 1
+            _changed_at[table] = now
+
+
+def mark_changed(session, *tables):
+    """Record tables written to outside the ORM in the session's transaction, to be bumped once it commits."""
+    session.info.setdefault('changed_tables', set()).update(tables)
+
+
+def _collect_changes(session, flush_context):
+    changed = session.info.setdefault('changed_tables', set())
+    for obj in session.new | session.dirty | session.deleted:
+        changed.add(obj.__table__.name)
+        for row_keys in _row_keys:
+            changed.update(row_keys(obj))
+
+
+def _publish_changes(session):
+    changed = session.info.pop('changed_tables', None)
+    if changed:
+        bump(*changed)
+
+
+def _discard_changes(session):
+    session.info.pop('changed_tables', None)
+
+
+def _schema_changed(target, connection, tables=(), **kw):
+    bump(*[table.name for table in tables])
+
+
+def track_changes(session, metadata, row_keys=None):
+    """Bump the versions of the tables touched by a session once its transaction commits,
+    and of every table that is created or dropped.
+    row_keys(obj) may return further version keys for a changed row, for caches that follow single records."""
+    if row_keys is not None:
+        _row_keys.append(row_keys)
+    event.listen(session, 'after_flush', _collect_changes)
+    event.listen(session, 'after_commit', _publish_changes)
+    event.listen(session, 'after_rollback', _discard_changes)
+    event.listen(metadata, 'after_create', _schema_changed)
+    event.listen(metadata, 'after_drop', _schema_changed)
+
+
+class VersionedCache(object):
+    """A bounded LRU cache whose entries are rebuilt once the tables they depend on change,
+    or after ttl seconds so that other worker processes' writes are picked up as well."""
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, tables, loader):
+        version = data_version(*tables)
+        found, value = self.lookup(key, version)
+        if not found:
+            value = loader()
+            self.store(key, version, value)
+        return value
+
+    def lookup(self, key, version):
+        """Return (True, value) if key is cached for exactly this version, else (False, None)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version and (entry[1] is None or entry[1] > time.time()):
+                self._entries.move_to_end(key)
+                return True, entry[2]
+        return False, None
+
+    def store(self, key, version, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (version, expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def add_app_cache(app, name, maxsize):
+    """Give app a cache of its own under name, whose entries are also rebuilt after DATA_CACHE_TTL seconds."""
+    app.extensions.setdefault('data_caches', {})[name] = VersionedCache(maxsize, app.config.get('DATA_CACHE_TTL'))
+
+
+def app_cache(name):
+    """Return the cache the current app was given under name."""
+    return current_app.extensions['data_caches'][name]
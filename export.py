@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Export of the whole recipe book as NDJSON or CSV, in the record layout the import command reads. Recipes are read
+in keyset batches, each with its quantities and methods in two more queries, and written out batch by batch, so memory
+use does not grow with the size of the catalogue."""
+import csv
+import io
+import json
+import zlib
+from collections import defaultdict
+
+from models import Recipe, Category, Course, Cuisine, Country, Author, Measurement, Ingredient, Quantity, Method, User
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+CSV_FIELDS = ('recipe_name', 'recipe_description', 'preparation_time', 'cooking_time', 'servings', 'category',
+              'course', 'cuisine', 'author', 'author_country', 'username', 'image_url', 'ingredients', 'methods')
+
+
+def recipe_batches(session, batch_size):
+    """Yield lists of up to batch_size recipe records, in id order."""
+    last_id = 0
+    while True:
+        rows = session.query(Recipe.id, Recipe.recipe_name, Recipe.recipe_description, Recipe.preparation_time,
+                             Recipe.cooking_time, Recipe.servings, Recipe.image_url,
+                             Category.category_name, Course.course_name, Cuisine.cuisine_name,
+                             Author.author_name, Country.country_name, User.username) \
+            .join(Category, Recipe.category_id == Category.id) \
+            .join(Course, Recipe.course_id == Course.id) \
+            .join(Cuisine, Recipe.cuisine_id == Cuisine.id) \
+            .join(Author, Recipe.author_id == Author.id) \
+            .join(Country, Author.country_id == Country.id) \
+            .outerjoin(User, Recipe.user_id == User.id) \
+            .filter(Recipe.id > last_id) \
+            .order_by(Recipe.id) \
+            .limit(batch_size) \
+            .all()
+        if not rows:
+            return
+        ids = [row.id for row in rows]
+
+        ingredients = defaultdict(list)
+        for recipe_id, quantity, measurement, ingredient in session.query(
+                Quantity.recipe_id, Quantity.quantity, Measurement.measurement_name, Ingredient.ingredient_name) \
+                .join(Measurement, Quantity.measurement_id == Measurement.id) \
+                .join(Ingredient, Quantity.ingredient_id == Ingredient.id) \
+                .filter(Quantity.recipe_id.in_(ids)) \
+                .order_by(Quantity.id):
+            ingredients[recipe_id].append({'quantity': quantity, 'measurement': measurement, 'ingredient': ingredient})
+        methods = defaultdict(list)
+        for recipe_id, description in session.query(Method.recipe_id, Method.method_description) \
+                .filter(Method.recipe_id.in_(ids)) \
+                .order_by(Method.position.is_(None), Method.position, Method.id):
+            methods[recipe_id].append(description)
+
+        yield [{
+            'recipe_name': row.recipe_name,
+            'recipe_description': row.recipe_description,
+            'preparation_time': row.preparation_time,
+            'cooking_time': row.cooking_time,
+            'servings': row.servings,
+            'category': row.category_name,
+            'course': row.course_name,
+            'cuisine': row.cuisine_name,
+            'author': row.author_name,
+            'author_country': row.country_name,
+            'username': row.username,
+            'image_url': row.image_url,
+            'ingredients': ingredients[row.id],
+            'methods': methods[row.id],
+        } for row in rows]
+        last_id = ids[-1]
+
+
+def ndjson_chunks(batches):
+    for records in batches:
+        yield ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS)
+    writer.writeheader()
+    for records in batches:
+        for record in records:
+            writer.writerow(dict(record, ingredients=json.dumps(record['ingredients']), methods=json.dumps(record['methods'])))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # only the header is left when there are no recipes
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress a stream of bytes into a gzip file as it is written."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(session, export_format, batch_size, compress=False):
+    """Yield the encoded export one batch of recipes at a time, as bytes."""
+    writer = ndjson_chunks if export_format == 'ndjson' else csv_chunks
+    chunks = (chunk.encode('utf-8') for chunk in writer(recipe_batches(session, batch_size)))
+    return gzip_chunks(chunks) if compress else chunks
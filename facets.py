@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Faceted filtering of recipes by category, course, cuisine and author. Besides the page of matching recipes, each
+filter state comes with the number of recipes every option of every facet would match, counted in a single round trip
+by one grouped query per facet joined with UNION ALL, and cached until the recipe table changes. A facet's counts
+apply every filter but its own, so its options show what choosing them instead would give."""
+from sqlalchemy import and_, func, literal, select, union_all
+
+from cache import app_cache
+from extensions import db
+from models import Recipe
+
+# facet name, form field and recipe column
+FACETS = (('category', 'recipe_category', Recipe.category_id),
+          ('course', 'recipe_course', Recipe.course_id),
+          ('cuisine', 'recipe_cuisine', Recipe.cuisine_id),
+          ('author', 'recipe_author', Recipe.author_id))
+
+
+def parse_filters(values):
+    """Return the chosen option of each facet in the submitted values by facet name, leaving out blank and bad ones."""
+    filters = {}
+    for name, field, column in FACETS:
+        try:
+            filters[name] = int(values.get(field))
+        except (TypeError, ValueError):
+            pass
+    return filters
+
+
+def filter_args(filters):
+    """The request arguments that give the same filters, for links to further pages."""
+    return dict((field, filters[name]) for name, field, column in FACETS if name in filters)
+
+
+def filter_clauses(filters, leave_out=None):
+    return [column == filters[name] for name, field, column in FACETS if name in filters and name != leave_out]
+
+
+def _count(filters):
+    selects = []
+    for name, field, column in FACETS:
+        query = select([literal(name).label('facet'), column.label('value'), func.count(Recipe.id).label('recipes')]) \
+            .group_by(column)
+        clauses = filter_clauses(filters, leave_out=name)
+        if clauses:
+            query = query.where(and_(*clauses))
+        selects.append(query)
+    counts = dict((name, {}) for name, field, column in FACETS)
+    for facet, value, recipes in db.session.execute(union_all(*selects)):
+        counts[facet][value] = recipes
+    return counts
+
+
+def facet_counts(filters):
+    """Return {facet: {option id: number of recipes}} for the filter state; options matching no recipe are left out."""
+    key = tuple(sorted(filters.items()))
+    return app_cache('facet').get(key, ('recipe',), lambda: _count(filters))
+
+
+def matching_total(filters, counts):
+    # every recipe has one option of each facet, so the first facet's counts add up to the recipes matching all filters
+    name = FACETS[0][0]
+    if name in filters:
+        return counts[name].get(filters[name], 0)
+    return sum(counts[name].values())
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Gunicorn settings, each of which can be overridden from the environment or on the command line.
+
+The app is imported once in the master and forked into the workers, which then warm up their own caches and open
+their own connections. Workers are gthread by default: requests mostly wait on the database and S3, so a few threads
+per process serve more of them than sync workers would in the same memory. gevent workers can be chosen instead when
+gevent (and psycogreen, for PostgreSQL) are installed."""
+import multiprocessing
+import os
+import shlex
+import sys
+
+
+def _option(name):
+    # GUNICORN_CMD_ARGS and then the command line override this file, so an option the settings below depend on is
+    # read from them first
+    from gunicorn.config import Config
+    parser = Config().parser()
+    value = None
+    for argv in (shlex.split(os.environ.get('GUNICORN_CMD_ARGS', '')), sys.argv[1:]):
+        try:
+            args, _ = parser.parse_known_args(argv)
+        except SystemExit:
+            continue
+        value = getattr(args, name, None) or value
+    return value
+
+
+cpus = multiprocessing.cpu_count()
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:%s' % os.environ.get('PORT', 5000))
+worker_class = _option('worker_class') or os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+gevent_workers = 'gevent' in worker_class.lower()
+# sync workers handle one request at a time, so there are more of them
+workers = int(os.environ.get('WEB_CONCURRENCY', cpus * 2 + 1 if worker_class == 'sync' else cpus + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1').lower() in ('1', 'true', 'yes')
+# seconds an idle keep-alive connection is held open; behind a load balancer this should exceed its idle timeout
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+accesslog = os.environ.get('GUNICORN_ACCESSLOG', '-')
+
+
+def _patch_for_gevent():
+    from gevent import monkey
+    if not monkey.is_module_patched('socket'):
+        monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        pass
+
+
+if gevent_workers:
+    # patch before the app is preloaded, so the locks and sockets it creates are cooperative
+    _patch_for_gevent()
+
+
+def post_fork(server, worker):
+    if 'gevent' in server.cfg.worker_class_str.lower():
+        # in case the worker class was set in a way not read above; psycopg2 would otherwise block the whole worker
+        _patch_for_gevent()
+    # fill this worker's caches before it is sent requests; a failure is retried by /readyz
+    from app import warm_up
+    from wsgi import app
+    try:
+        warm_up(app)
+    except Exception as e:
+        server.log.warning('Worker %s did not warm up: %s', worker.pid, e)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Conditional GET and response caching for public pages.
+
+Responses to anonymous visitors are kept in a bounded LRU and served again without rendering until the data changes.
+Their ETag is a hash of the body, so every worker process gives the same page the same ETag, and a stored page is
+revalidated with a 304 without running the view. Other pages get an ETag derived from the data versions they are built
+from; those versions are counted by each process, so it also carries an id of the process, which keeps a version one
+process has seen from validating a page built by another, and the time it was issued, so that it only validates for
+DATA_CACHE_TTL seconds like any other cached value. Only the ETag is used to answer with a 304, since Last-Modified
+comes from the clock of the process that saw the change."""
+import hashlib
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import current_app, request, session, make_response, Response
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+from cache import app_cache, data_version, last_changed
+
+_process_ids = {}
+
+
+def _process_id():
+    # made after the fork, so that workers of a preloaded app do not share it, and new on every restart
+    pid = os.getpid()
+    if pid not in _process_ids:
+        _process_ids[pid] = uuid.uuid4().hex
+    return _process_ids[pid]
+
+
+def _version_etag(versions, user_id, issued):
+    digest = hashlib.sha1(repr((request.full_path, versions, user_id, issued, _process_id())).encode('utf-8')).hexdigest()
+    return '%s.%d' % (digest, issued)
+
+
+def _valid_version_etag(versions, user_id, ttl):
+    """Return the version ETag the request was sent with if it still matches and is not older than ttl, else None."""
+    now = time.time()
+    for etag in request.if_none_match.as_set():
+        issued = etag.rpartition('.')[2]
+        if issued.isdigit() and (not ttl or now - int(issued) < ttl) \
+                and etag == _version_etag(versions, user_id, int(issued)):
+            return etag
+    return None
+
+
+def _set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def cached_page(tables, store=True, bypass=None):
+    """
+    Decorate a GET view built only from the given tables, a tuple of data version keys or a function taking the view's
+    arguments and returning one. With store=False anonymous responses are only validated, not kept. bypass may be a
+    function taking the view's arguments and returning True for a visitor whose page is always built afresh, such as
+    one who may just have changed its data through another worker process, whose versions this one has not seen.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # flashed messages belong to one visitor and are shown once, so pages carrying them are never reused
+            if request.method != 'GET' or '_flashes' in session or (bypass is not None and bypass(**kwargs)):
+                return view(*args, **kwargs)
+
+            keys = tables(**kwargs) if callable(tables) else tables
+            versions = data_version(*keys)
+            user_id = current_user.get_id() if current_user.is_authenticated else None
+            last_modified = datetime.fromtimestamp(int(last_changed(*keys)), timezone.utc)
+
+            etag = _valid_version_etag(versions, user_id, current_app.config.get('DATA_CACHE_TTL'))
+            if etag is not None:
+                return _set_validators(Response(status=304), etag, last_modified)
+            etag = _version_etag(versions, user_id, int(time.time()))
+
+            # stored pages expire with the page cache's entries, after DATA_CACHE_TTL seconds each
+            anonymous = user_id is None and store
+            if anonymous:
+                found, cached = app_cache('page').lookup(request.full_path, versions)
+                if found:
+                    body, status, mimetype, etag = cached
+                    if not is_resource_modified(request.environ, etag=etag):
+                        return _set_validators(Response(status=304), etag, last_modified)
+                    return _set_validators(Response(body, status=status, mimetype=mimetype), etag, last_modified)
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            # streamed bodies are not known before they are sent, so those keep the ETag derived from the versions
+            if anonymous and not response.is_streamed:
+                body = response.get_data()
+                etag = hashlib.sha1(body).hexdigest()
+                app_cache('page').store(request.full_path, versions, (body, response.status_code, response.mimetype, etag))
+                if not is_resource_modified(request.environ, etag=etag):
+                    return _set_validators(Response(status=304), etag, last_modified)
+            return _set_validators(response, etag, last_modified)
+        return wrapper
+    return decorator
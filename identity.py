@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Identifying the logged in user without a database round trip on every request. Users are kept in a short lived LRU
+keyed by id and dropped as soon as their row changes; optionally the id and username are also carried in the signed
+session cookie, so even a cold cache needs no query until another attribute of the user is read."""
+from flask import session
+from sqlalchemy.orm import make_transient_to_detached
+
+from cache import app_cache
+from extensions import db
+from models import User
+
+
+def user_version_key(user_id):
+    return 'user:%s' % user_id
+
+
+def _load(user_id):
+    # read through a session of its own, so the cached user is detached from every request's session
+    own_session = db.session.session_factory()
+    try:
+        return own_session.query(User).filter(User.id == user_id).first()
+    finally:
+        own_session.close()
+
+
+def _from_identity(user_id):
+    identity = session.get('_identity')
+    if not identity or identity[0] != user_id:
+        return None
+    # a bare user with only the carried columns loaded; the others are read on first use
+    user = User.__mapper__.class_manager.new_instance()
+    user.id, user.username = identity
+    make_transient_to_detached(user)
+    return user
+
+
+def remember_identity(user):
+    """Carry the user's id and username in the session, for load_user to trust while the cookie is valid."""
+    session['_identity'] = [user.id, user.username]
+
+
+def forget_identity():
+    session.pop('_identity', None)
+
+
+def cached_user(user_id, use_session=False):
+    """Return the user with the given id attached to the current session, or None if there is no such user."""
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    user = _from_identity(user_id) if use_session else None
+    if user is None:
+        user = app_cache('user').get(user_id, (user_version_key(user_id),), lambda: _load(user_id))
+    if user is None:
+        return None
+    return db.session.merge(user, load=False)
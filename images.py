@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Responsive derivatives of recipe images. Each upload is resized to a few widths and saved as both WebP and JPEG,
+so pages can offer browsers a srcset and let them fetch the smallest copy that fits instead of the original photo.
+This module is run in worker processes and so only depends on Pillow."""
+import os
+
+from PIL import Image, ImageOps
+
+# widths in pixels of the derivatives; an image is never scaled up past its own width
+IMAGE_WIDTHS = (320, 640, 1280)
+# derivative formats by name: content type and Pillow format
+IMAGE_FORMATS = (('webp', 'image/webp', 'WEBP'),
+                 ('jpeg', 'image/jpeg', 'JPEG'))
+IMAGE_QUALITY = 80
+
+
+def make_derivatives(path, key, widths=IMAGE_WIDTHS):
+    """
+    Write resized copies of the image at path beside it, named after key. Returns a list of
+    (format, width, key, path, content type) tuples, which is empty when the file is not an image Pillow can read.
+    """
+    try:
+        image = Image.open(path)
+        image.load()
+    except (IOError, Image.DecompressionBombError):
+        return []
+    # camera photos are often stored sideways with an EXIF orientation, which is lost once the image is re-encoded
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    stem = os.path.splitext(key)[0]
+    directory = os.path.dirname(path)
+    derivatives = []
+    for width in sorted(set(min(width, image.width) for width in widths)):
+        if width == image.width:
+            resized = image
+        else:
+            resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        for name, content_type, pillow_format in IMAGE_FORMATS:
+            derivative_key = '{}-{}w.{}'.format(stem, width, name)
+            derivative_path = os.path.join(directory, derivative_key)
+            resized.save(derivative_path, pillow_format, quality=IMAGE_QUALITY)
+            derivatives.append((name, width, derivative_key, derivative_path, content_type))
+    return derivatives
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Indexes on the foreign key and lookup columns. New databases get them from create_all; add_missing_indexes brings
+an existing database up to date, and query_plan_scans tells which tables a query reads in full, so tests can check
+that the queries of the busiest pages are served from an index."""
+import re
+
+from sqlalchemy import inspect, select, func
+
+from models import SavedRecipe
+
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+POSTGRES_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+
+def _remove_duplicate_saved_recipes(connection):
+    # keep the first time a user saved a recipe, so the unique index can be built
+    saved = SavedRecipe.__table__
+    first = select([func.min(saved.c.id)]).group_by(saved.c.user_id, saved.c.recipe_id)
+    return connection.execute(saved.delete().where(~saved.c.id.in_(first))).rowcount
+
+
+def add_missing_indexes(connection, metadata):
+    """Create the indexes declared in metadata that the database does not have yet, and return their names."""
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    created = []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing:
+                continue
+            if table is SavedRecipe.__table__ and index.unique:
+                _remove_duplicate_saved_recipes(connection)
+            index.create(connection)
+            created.append(index.name)
+    return created
+
+
+def query_plan_scans(connection, statement, parameters=()):
+    """
+    Return the names of the tables the database would read in full to run statement, as it was sent to the driver
+    with parameters. Only SQLite and PostgreSQL plans are read; on other databases the list is always empty.
+    """
+    prefix = {'sqlite': 'EXPLAIN QUERY PLAN ', 'postgresql': 'EXPLAIN '}.get(connection.dialect.name)
+    if prefix is None:
+        return []
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    if connection.dialect.name == 'sqlite':
+        # the last column of each row describes one step, e.g. "SCAN recipe" or "SEARCH recipe USING INDEX ..."
+        return [match.group(1) for match in (SQLITE_SCAN.match(row[-1]) for row in rows) if match]
+    return POSTGRES_SCAN.findall('\n'.join(row[0] for row in rows))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Ingredients are shared by every recipe that uses them and identified by their normalized name, which has a unique
+index. Getting or creating one is an index probe, and when the name is new an insert that leaves the row alone if
+another request added it first, so concurrent requests can never create duplicates."""
+from sqlalchemy.dialects import postgresql
+
+from cache import mark_changed
+from extensions import db
+from models import Ingredient, normalize_ingredient_name
+
+
+def _insert_ignoring_duplicates(dialect, values):
+    table = Ingredient.__table__
+    if dialect == 'postgresql':
+        return postgresql.insert(table).values(**values).on_conflict_do_nothing(index_elements=[table.c.normalized_name])
+    # SQLite; MySQL spells it INSERT IGNORE
+    return table.insert().values(**values).prefix_with('OR IGNORE' if dialect == 'sqlite' else 'IGNORE')
+
+
+def get_or_create_ingredient(ingredient_name):
+    """Return the ingredient with the given name, ignoring case and spacing, adding it if there is none."""
+    normalized = normalize_ingredient_name(ingredient_name)
+    ingredient = Ingredient.query.filter_by(normalized_name=normalized).first()
+    if ingredient is None:
+        dialect = db.session.get_bind().dialect.name
+        db.session.execute(_insert_ignoring_duplicates(dialect,
+            {'ingredient_name': ' '.join(ingredient_name.split()), 'normalized_name': normalized}))
+        mark_changed(db.session, 'ingredient')
+        ingredient = Ingredient.query.filter_by(normalized_name=normalized).one()
+    return ingredient
+
+
+def get_or_create_ingredients(ingredient_names):
+    """Return the ingredients with the given names by normalized name, reading those that exist with one query."""
+    wanted = {}
+    for ingredient_name in ingredient_names:
+        wanted.setdefault(normalize_ingredient_name(ingredient_name), ingredient_name)
+    if not wanted:
+        return {}
+    ingredients = dict((ingredient.normalized_name, ingredient)
+                       for ingredient in Ingredient.query.filter(Ingredient.normalized_name.in_(list(wanted))))
+    for normalized, ingredient_name in wanted.items():
+        if normalized not in ingredients:
+            ingredients[normalized] = get_or_create_ingredient(ingredient_name)
+    return ingredients
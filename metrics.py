@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Request instrumentation exposed in the Prometheus text format on /metrics. For every endpoint it records the
+latency of requests, how many SQL statements each ran and how long they took; it also times template rendering and
+image storage calls. Recording is a few additions under a lock, cheap enough to leave on in production. Counts are
+kept per process, so each gunicorn worker reports its own."""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _label_text(names, values):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                    for name, value in zip(names, values))
+
+
+class Counter(object):
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append('{}{{{}}} {}'.format(self.name, _label_text(self.labels, labels), value))
+        return lines
+
+
+class Histogram(object):
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # per label values: a count for each bucket and one for +Inf, then the sum of the observed values
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(labels, time.perf_counter() - started)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            label_text = _label_text(self.labels, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label_text, bound, cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, label_text, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, label_text, cumulative))
+        return lines
+
+
+request_seconds = Histogram('http_request_duration_seconds', 'Time taken to handle a request.',
+                            ('endpoint', 'method'))
+requests_total = Counter('http_requests_total', 'Requests handled.', ('endpoint', 'method', 'status'))
+request_statements = Histogram('http_request_sql_statements', 'SQL statements run while handling a request.',
+                               ('endpoint',), STATEMENT_BUCKETS)
+request_sql_seconds = Histogram('http_request_sql_duration_seconds', 'Time spent in SQL statements during a request.',
+                                ('endpoint',))
+template_seconds = Histogram('template_render_duration_seconds', 'Time taken to render a template.', ('template',))
+storage_seconds = Histogram('image_storage_duration_seconds', 'Time taken by calls to the image storage.',
+                            ('backend', 'operation'))
+
+METRICS = (request_seconds, requests_total, request_statements, request_sql_seconds, template_seconds, storage_seconds)
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+#############################REQUESTS##########################################
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+# checks run on the SQL statement count of each finished request, pushed by query_budget
+_budget_checks = []
+
+
+@contextmanager
+def query_budget(**budgets):
+    """
+    Count the SQL statements run by each request handled in the block, and raise QueryBudgetExceeded when it ends if
+    one ran more than the budget given for its endpoint, or reached an endpoint without a budget. Meant for tests, so
+    that N+1 queries fail the build like any other regression; it also works as a decorator.
+    """
+    exceeded = []
+
+    def check(endpoint, statements):
+        budget = budgets.get(endpoint)
+        if budget is None or statements > budget:
+            exceeded.append('{} ran {} statements, its budget is {}'.format(endpoint, statements, budget))
+
+    _budget_checks.append(check)
+    try:
+        yield
+    finally:
+        _budget_checks.remove(check)
+    if exceeded:
+        raise QueryBudgetExceeded('; '.join(exceeded))
+
+
+class RequestStats(object):
+    """What the request handled by the current thread has done so far."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.status = 500
+
+
+_local = threading.local()
+
+
+def current_request_stats():
+    return getattr(_local, 'stats', None)
+
+
+def _start_request():
+    _local.stats = RequestStats()
+
+
+def _record_status(response):
+    stats = current_request_stats()
+    if stats is not None:
+        stats.status = response.status_code
+    return response
+
+
+def _finish_request(error=None):
+    # runs once a streamed response has been sent as well, so its queries and time are counted too
+    stats = current_request_stats()
+    if stats is None:
+        return
+    _local.stats = None
+    endpoint = request.url_rule.endpoint if request.url_rule is not None else 'unmatched'
+    request_seconds.observe((endpoint, request.method), time.perf_counter() - stats.started)
+    requests_total.inc((endpoint, request.method, stats.status))
+    request_statements.observe((endpoint,), stats.statements)
+    request_sql_seconds.observe((endpoint,), stats.sql_seconds)
+    for check in _budget_checks:
+        check(endpoint, stats.statements)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # a connection runs one statement at a time; one that fails is simply overwritten by the next
+    conn.info['metrics_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_started', None)
+    stats = current_request_stats()
+    if stats is not None and started is not None:
+        stats.statements += 1
+        stats.sql_seconds += time.perf_counter() - started
+
+
+class TimedTemplate(Template):
+
+    def render(self, *args, **kwargs):
+        with template_seconds.time((self.name,)):
+            return Template.render(self, *args, **kwargs)
+
+
+_engines_instrumented = False
+
+
+def init_app(app):
+    global _engines_instrumented
+    if not _engines_instrumented:
+        _engines_instrumented = True
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(_record_status)
+    app.teardown_request(_finish_request)
+    # layouts and includes are rendered as part of the template that extends them
+    app.jinja_env.template_class = TimedTemplate
@@ -56,7 +56,7 @@ class Cuisine(db.Model):
 class Author(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     author_name = db.Column(String(150), nullable=False, unique=True)
-    country_id = db.Column(db.Integer, db.ForeignKey('country.id'), nullable=False)
+    country_id = db.Column(db.Integer, db.ForeignKey('country.id'), nullable=False, index=True)
     country = db.relationship('Country', backref=db.backref('authors', lazy=True))
 
     def __init__(self, author_name):
@@ -77,18 +77,30 @@ class Country(db.Model):
 
 class Method(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id', ondelete="CASCADE"), nullable=False)
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id', ondelete="CASCADE"), nullable=False, index=True)
     recipe = db.relationship('Recipe', backref=db.backref('methods', cascade="all,delete", lazy=True))
     method_description = db.Column(Text)
+    # step number set when a recipe's steps are edited together; steps added one at a time have none and follow them
+    position = db.Column(db.Integer, nullable=True)
 
-    def __init__(self, recipe, method_description):
+    def __init__(self, recipe, method_description, position=None):
         self.recipe = recipe
         self.method_description = method_description
+        self.position = position
+
+    @property
+    def sort_key(self):
+        return (self.position is None, self.position or 0, self.id)
         
     def __repr__(self):
         return '<Method %r>' % self.method_description
 
 class Recipe(db.Model):
+    __table_args__ = (
+        # a user's recipes are listed in id order, a page at a time
+        db.Index('ix_recipe_user_id_id', 'user_id', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
@@ -100,20 +112,24 @@ class Recipe(db.Model):
     cooking_time = db.Column(db.Integer)
     servings = db.Column(db.Integer)
     
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False, index=True)
     category = db.relationship('Category', backref=db.backref('recipes', lazy=True))
     
-    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False, index=True)
     course = db.relationship('Course', backref=db.backref('recipes', lazy=True))
     
-    cuisine_id = db.Column(db.Integer, db.ForeignKey('cuisine.id'), nullable=False)
+    cuisine_id = db.Column(db.Integer, db.ForeignKey('cuisine.id'), nullable=False, index=True)
     cuisine = db.relationship('Cuisine', backref=db.backref('recipes', lazy=True))
 
-    author_id = db.Column(db.Integer, db.ForeignKey('author.id'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('author.id'), nullable=False, index=True)
     author = db.relationship('Author', backref=db.backref('recipes', lazy=True))
 
     image_filename = db.Column(db.String, default=None, nullable=True)
     image_url = db.Column(db.String, default=None, nullable=True)
+    # pending while the image is uploaded in the background, then ready or failed
+    image_status = db.Column(String(10), default=None, nullable=True)
+    # resized copies of the image as {format: [[width, url], ...]}, narrowest first
+    image_variants = db.Column(db.JSON, default=None, nullable=True)
 
     def __init__(self, user, recipe_name, recipe_description, preparation_time, cooking_time, servings, category, course, cuisine, author, image_filename, image_url):
         self.user = user
@@ -129,16 +145,26 @@ class Recipe(db.Model):
         self.image_filename = image_filename
         self.image_url = image_url
 
+    def image_srcset(self, format):
+        return ', '.join('%s %dw' % (url, width) for width, url in (self.image_variants or {}).get(format, []))
+
     def __repr__(self):
         return '<Recipe %r>' % self.recipe_name
 
 
+def normalize_ingredient_name(ingredient_name):
+    # "Tomato", "tomato " and " TOMATO" are all the same ingredient
+    return ' '.join(ingredient_name.split()).lower()
+
+
 class Ingredient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     ingredient_name = db.Column(String(150), nullable=False)
+    normalized_name = db.Column(String(150), nullable=False, unique=True)
 
     def __init__(self, ingredient_name):
         self.ingredient_name = ingredient_name
+        self.normalized_name = normalize_ingredient_name(ingredient_name)
     
     def __repr__(self):
         return '<Ingredient %r>' % self.ingredient_name
@@ -156,16 +182,21 @@ class Measurement(db.Model):
 
 
 class Quantity(db.Model):
+    __table_args__ = (
+        # recipes are found by the ingredients they use
+        db.Index('ix_quantity_ingredient_id_recipe_id', 'ingredient_id', 'recipe_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     quantity = db.Column(db.Float)
     
-    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id', ondelete="CASCADE"), nullable=False)
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id', ondelete="CASCADE"), nullable=False, index=True)
     recipe = db.relationship('Recipe', backref=db.backref('quantities', cascade="all,delete", lazy=True))
     
     ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredient.id'), nullable=False)
     ingredient = db.relationship('Ingredient', backref=db.backref('quantities', lazy=True))
     
-    measurement_id = db.Column(db.Integer, db.ForeignKey('measurement.id'), nullable=False)
+    measurement_id = db.Column(db.Integer, db.ForeignKey('measurement.id'), nullable=False, index=True)
     measurement = db.relationship('Measurement', backref=db.backref('quantities', lazy=True))
 
     def __init__(self, quantity, recipe, ingredient, measurement):
@@ -179,16 +210,20 @@ class Quantity(db.Model):
 
 
 class SavedRecipe(db.Model):
+    __table_args__ = (
+        # a unique index rather than a constraint, as one can be added to an existing table on every database;
+        # it also serves the lookups of a user's saved recipes
+        db.Index('savedrecipe_user_recipe_uc', 'user_id', 'recipe_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('savedrecipes', lazy=True))
 
-    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id', ondelete="CASCADE"), nullable=False)
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id', ondelete="CASCADE"), nullable=False, index=True)
     recipe = db.relationship('Recipe', backref=db.backref('savedrecipes', lazy=True))
 
-    UniqueConstraint('user_id', 'recipe_id', name='savedrecipe_user_recipe_uc')
-
     def __init__(self, user, recipe):
         self.user = user
         self.recipe = recipe
\ No newline at end of file
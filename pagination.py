@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Keyset (cursor) pagination. A page is read with `WHERE id < last_seen ORDER BY id DESC LIMIT n` rather than an OFFSET,
+so every page costs the same however deep it is. The position is passed between requests as an opaque signed token."""
+from flask import current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+
+
+class KeysetPage(object):
+
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='page-cursor')
+
+
+def encode_cursor(direction, key):
+    return _serializer().dumps([direction, key])
+
+
+def decode_cursor(cursor):
+    """Return the (direction, key) held by a cursor, or (None, None) when it is missing or has been tampered with."""
+    if not cursor:
+        return None, None
+    try:
+        direction, key = _serializer().loads(cursor)
+        return direction, int(key)
+    except (BadSignature, TypeError, ValueError):
+        return None, None
+
+
+def keyset_paginate(query, column, cursor=None, per_page=10):
+    """Return the page of query, ordered by column descending, that follows or precedes the cursor."""
+    direction, key = decode_cursor(cursor)
+    # one extra row is read to find out whether there is another page beyond this one
+    if direction == 'before':
+        rows = query.filter(column > key).order_by(column.asc()).limit(per_page + 1).all()
+        items = list(reversed(rows[:per_page]))
+        has_next = True
+        has_prev = len(rows) > per_page
+    else:
+        if direction == 'after':
+            query = query.filter(column < key)
+        rows = query.order_by(column.desc()).limit(per_page + 1).all()
+        items = rows[:per_page]
+        has_next = len(rows) > per_page
+        has_prev = direction == 'after'
+
+    if not items:
+        return KeysetPage(items, None, None)
+    next_cursor = encode_cursor('after', getattr(items[-1], column.key)) if has_next else None
+    prev_cursor = encode_cursor('before', getattr(items[0], column.key)) if has_prev else None
+    return KeysetPage(items, next_cursor, prev_cursor)
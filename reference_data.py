@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Per app cache of the small reference tables: categories, courses, cuisines, authors, countries and measurements.
+Each table is read once and then serves both the dropdown lists and id lookups, until a commit changes it and so
+bumps its data version."""
+from sqlalchemy.orm import joinedload
+
+from cache import app_cache
+from extensions import db
+from models import Author, Country
+
+# dropdowns never list more rows than this
+LIST_LIMITS = {Country: 250}
+DEFAULT_LIST_LIMIT = 100
+
+
+class ReferenceTable(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.by_id = dict((row.id, row) for row in rows)
+
+
+def _load(model):
+    # read through a session of its own, so the cached rows are detached from every request's session
+    session = db.session.session_factory()
+    try:
+        query = session.query(model).order_by(model.id)
+        if model is Author:
+            query = query.options(joinedload(Author.country))
+        return ReferenceTable(query.all())
+    finally:
+        session.close()
+
+
+def _reference_table(model):
+    table = model.__table__.name
+    tables = (table, 'country') if model is Author else (table,)
+    return app_cache('reference').get(table, tables, lambda: _load(model))
+
+
+def reference_list(model):
+    """Return the rows of model for a dropdown list."""
+    return _reference_table(model).rows[:LIST_LIMITS.get(model, DEFAULT_LIST_LIMIT)]
+
+
+def reference_get(model, id):
+    """Return the row of model with the given id attached to the current session, without querying the database,
+    or None when there is no such row."""
+    try:
+        row = _reference_table(model).by_id.get(int(id))
+    except (TypeError, ValueError):
+        return None
+    if row is None:
+        return None
+    return db.session.merge(row, load=False)
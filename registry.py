@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""Routes, error handlers and CLI commands declared at import time, before there is an app to attach them to. The app
+factory adds them to each app it creates. Unlike a blueprint's, the endpoints keep their plain names, so
+url_for('index') and login_manager.login_view work as before."""
+from flask.cli import AppGroup
+
+
+class ViewRegistry(object):
+
+    def __init__(self):
+        self.routes = []
+        self.error_handlers = []
+        self.cli = AppGroup()
+
+    def route(self, rule, **options):
+        def decorator(view):
+            endpoint = options.pop('endpoint', None) or view.__name__
+            self.routes.append((rule, endpoint, view, options))
+            return view
+        return decorator
+
+    def errorhandler(self, code):
+        def decorator(handler):
+            self.error_handlers.append((code, handler))
+            return handler
+        return decorator
+
+    def init_app(self, app):
+        for rule, endpoint, view, options in self.routes:
+            app.add_url_rule(rule, endpoint, view, **options)
+        for code, handler in self.error_handlers:
+            app.register_error_handler(code, handler)
+        for command in self.cli.commands.values():
+            app.cli.add_command(command)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Bringing a database created by an earlier version up to date with the models. create_all only creates missing
+tables, so the columns added to existing tables since are added here and filled in where the models need a value:
+ingredients get their normalized name, and those that turn out to be the same ingredient are merged before its
+unique index is built. The other indexes are then added by add_missing_indexes. Each step looks at the database
+first, so upgrade_schema can be run again safely."""
+from sqlalchemy import bindparam, inspect, select
+
+from indexes import add_missing_indexes
+from models import Ingredient, Quantity, normalize_ingredient_name
+
+NORMALIZED_NAME_INDEX = 'ix_ingredient_normalized_name'
+
+
+def add_missing_columns(connection, metadata):
+    """
+    Add the columns declared in metadata that the existing tables lack, and return them as 'table.column' names.
+    They are added without NOT NULL, since the rows already there have no value for them yet.
+    """
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    preparer = connection.dialect.identifier_preparer
+    added = []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (preparer.format_table(table),
+                preparer.format_column(column), column.type.compile(dialect=connection.dialect)))
+            added.append('%s.%s' % (table.name, column.name))
+    return added
+
+
+def _has_unique_normalized_name(inspector):
+    columns = ['normalized_name']
+    return any(constraint['column_names'] == columns for constraint in inspector.get_unique_constraints('ingredient')) \
+        or any(index['unique'] and index['column_names'] == columns for index in inspector.get_indexes('ingredient'))
+
+
+def merge_duplicate_ingredients(connection):
+    """
+    Give every ingredient its normalized name and merge those sharing one into the first of them, pointing their
+    quantities at it. Returns the number of ingredients merged away.
+    """
+    ingredients = Ingredient.__table__
+    quantities = Quantity.__table__
+    first = {}
+    renamed, repointed = [], []
+    for id, name, normalized in connection.execute(select([ingredients.c.id, ingredients.c.ingredient_name,
+            ingredients.c.normalized_name]).order_by(ingredients.c.id)):
+        key = normalize_ingredient_name(name)
+        kept = first.setdefault(key, id)
+        if kept != id:
+            repointed.append({'duplicate': id, 'kept': kept})
+        elif normalized != key:
+            renamed.append({'kept': id, 'key': key})
+    if repointed:
+        connection.execute(quantities.update().where(quantities.c.ingredient_id == bindparam('duplicate'))
+                           .values(ingredient_id=bindparam('kept')), repointed)
+        connection.execute(ingredients.delete().where(ingredients.c.id.in_([row['duplicate'] for row in repointed])))
+    if renamed:
+        connection.execute(ingredients.update().where(ingredients.c.id == bindparam('kept'))
+                           .values(normalized_name=bindparam('key')), renamed)
+    return len(repointed)
+
+
+def upgrade_schema(connection, metadata):
+    """Bring the database up to date with metadata and return a line describing each change made."""
+    changes = ['Added column %s' % name for name in add_missing_columns(connection, metadata)]
+
+    inspector = inspect(connection)
+    if 'ingredient' in inspector.get_table_names() and not _has_unique_normalized_name(inspector):
+        merged = merge_duplicate_ingredients(connection)
+        if merged:
+            changes.append('Merged %d duplicate ingredients' % merged)
+        connection.execute('CREATE UNIQUE INDEX %s ON ingredient (normalized_name)' % NORMALIZED_NAME_INDEX)
+        changes.append('Created index %s' % NORMALIZED_NAME_INDEX)
+        # SQLite cannot add NOT NULL to an existing column; the models always give a normalized name there
+        if connection.dialect.name == 'postgresql':
+            connection.execute('ALTER TABLE ingredient ALTER COLUMN normalized_name SET NOT NULL')
+
+    changes.extend('Created index %s' % name for name in add_missing_indexes(connection, metadata))
+    return changes
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""Recipe search: full text search over the recipe name, description and method text, and set queries over ingredients.
+
+SQLite keeps an FTS5 index, Postgres a weighted tsvector index plus a trigram index for misspelt words. Both are kept up
+to date by triggers, so every way of writing recipes (forms, bulk imports, plain SQL) is covered. Other databases fall
+back to a LIKE scan."""
+import re
+import difflib
+
+from sqlalchemy import Float, Integer, and_, case, column, event, func, literal, or_, text
+
+from extensions import db
+from models import Recipe, Quantity, Ingredient, normalize_ingredient_name
+
+SQLITE_INDEX = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS recipe_fts USING fts5("
+    "recipe_name, recipe_description, method_text, tokenize='unicode61 remove_diacritics 2')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS recipe_fts_vocab USING fts5vocab(recipe_fts, row)",
+    "CREATE TRIGGER IF NOT EXISTS recipe_fts_insert AFTER INSERT ON recipe BEGIN "
+    "INSERT INTO recipe_fts (rowid, recipe_name, recipe_description, method_text) "
+    "VALUES (new.id, new.recipe_name, new.recipe_description, ''); END",
+    "CREATE TRIGGER IF NOT EXISTS recipe_fts_update AFTER UPDATE OF recipe_name, recipe_description ON recipe BEGIN "
+    "UPDATE recipe_fts SET recipe_name = new.recipe_name, recipe_description = new.recipe_description "
+    "WHERE rowid = new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS recipe_fts_delete AFTER DELETE ON recipe BEGIN "
+    "DELETE FROM recipe_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS method_fts_insert AFTER INSERT ON method BEGIN "
+    "UPDATE recipe_fts SET method_text = (SELECT group_concat(method_description, ' ') FROM method "
+    "WHERE recipe_id = new.recipe_id) WHERE rowid = new.recipe_id; END",
+    "CREATE TRIGGER IF NOT EXISTS method_fts_update AFTER UPDATE ON method BEGIN "
+    "UPDATE recipe_fts SET method_text = (SELECT group_concat(method_description, ' ') FROM method "
+    "WHERE recipe_id = old.recipe_id) WHERE rowid = old.recipe_id; "
+    "UPDATE recipe_fts SET method_text = (SELECT group_concat(method_description, ' ') FROM method "
+    "WHERE recipe_id = new.recipe_id) WHERE rowid = new.recipe_id; END",
+    "CREATE TRIGGER IF NOT EXISTS method_fts_delete AFTER DELETE ON method BEGIN "
+    "UPDATE recipe_fts SET method_text = coalesce((SELECT group_concat(method_description, ' ') FROM method "
+    "WHERE recipe_id = old.recipe_id), '') WHERE rowid = old.recipe_id; END",
+)
+
+SQLITE_REBUILD = (
+    "DELETE FROM recipe_fts",
+    "INSERT INTO recipe_fts (rowid, recipe_name, recipe_description, method_text) "
+    "SELECT recipe.id, recipe.recipe_name, recipe.recipe_description, "
+    "coalesce((SELECT group_concat(method_description, ' ') FROM method WHERE recipe_id = recipe.id), '') "
+    "FROM recipe",
+)
+
+SQLITE_DROP = (
+    "DROP TABLE IF EXISTS recipe_fts_vocab",
+    "DROP TABLE IF EXISTS recipe_fts",
+)
+
+POSTGRES_INDEX = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE TABLE IF NOT EXISTS recipe_search ("
+    "recipe_id integer PRIMARY KEY REFERENCES recipe (id) ON DELETE CASCADE, "
+    "body text NOT NULL, document tsvector NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS recipe_search_document_idx ON recipe_search USING gin (document)",
+    "CREATE INDEX IF NOT EXISTS recipe_search_body_trgm_idx ON recipe_search USING gin (body gin_trgm_ops)",
+    "CREATE OR REPLACE FUNCTION recipe_search_refresh(target integer) RETURNS void AS $$ "
+    "INSERT INTO recipe_search (recipe_id, body, document) "
+    "SELECT r.id, concat_ws(' ', r.recipe_name, r.recipe_description, m.method_text), "
+    "setweight(to_tsvector('english', coalesce(r.recipe_name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(r.recipe_description, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(m.method_text, '')), 'C') "
+    "FROM recipe r LEFT JOIN (SELECT recipe_id, string_agg(method_description, ' ') AS method_text "
+    "FROM method WHERE recipe_id = target GROUP BY recipe_id) m ON m.recipe_id = r.id "
+    "WHERE r.id = target "
+    "ON CONFLICT (recipe_id) DO UPDATE SET body = excluded.body, document = excluded.document; "
+    "$$ LANGUAGE sql",
+    "CREATE OR REPLACE FUNCTION recipe_search_trigger() RETURNS trigger AS $$ BEGIN "
+    "IF TG_TABLE_NAME = 'recipe' THEN PERFORM recipe_search_refresh(NEW.id); "
+    "ELSE "
+    "IF TG_OP <> 'INSERT' THEN PERFORM recipe_search_refresh(OLD.recipe_id); END IF; "
+    "IF TG_OP <> 'DELETE' THEN PERFORM recipe_search_refresh(NEW.recipe_id); END IF; "
+    "END IF; RETURN NULL; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS recipe_search_recipe ON recipe",
+    "CREATE TRIGGER recipe_search_recipe AFTER INSERT OR UPDATE ON recipe "
+    "FOR EACH ROW EXECUTE PROCEDURE recipe_search_trigger()",
+    "DROP TRIGGER IF EXISTS recipe_search_method ON method",
+    "CREATE TRIGGER recipe_search_method AFTER INSERT OR UPDATE OR DELETE ON method "
+    "FOR EACH ROW EXECUTE PROCEDURE recipe_search_trigger()",
+)
+
+POSTGRES_REBUILD = (
+    "SELECT recipe_search_refresh(id) FROM recipe",
+)
+
+POSTGRES_DROP = (
+    "DROP TABLE IF EXISTS recipe_search CASCADE",
+)
+
+# words shorter than this are never corrected, too many other words are within one typo of them
+MIN_CORRECTED_LENGTH = 4
+
+_backends = {}
+
+
+class SearchResults(object):
+
+    def __init__(self, items, total, page, per_page, missing=None):
+        self.items = items
+        self.total = total
+        self.missing = missing or {}
+        self.page = page
+        self.has_next = page * per_page < total
+        self.has_prev = page > 1
+
+
+def _sqlite_has_fts5(connection):
+    return connection.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar() == 1
+
+
+def install_search_index(connection):
+    """Create the search index and the triggers keeping it up to date, if the database supports one."""
+    dialect = connection.dialect.name
+    if dialect == 'sqlite' and _sqlite_has_fts5(connection):
+        statements = SQLITE_INDEX
+    elif dialect == 'postgresql':
+        statements = POSTGRES_INDEX
+    else:
+        return
+    for statement in statements:
+        connection.execute(text(statement))
+    _backends.clear()
+
+
+def rebuild_search_index(connection):
+    """Index every recipe from scratch, e.g. for a database that existed before the index did."""
+    install_search_index(connection)
+    statements = {'sqlite': SQLITE_REBUILD, 'postgresql': POSTGRES_REBUILD}.get(connection.dialect.name, ())
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def drop_search_index(connection):
+    statements = {'sqlite': SQLITE_DROP, 'postgresql': POSTGRES_DROP}.get(connection.dialect.name, ())
+    for statement in statements:
+        connection.execute(text(statement))
+    _backends.clear()
+
+
+def track_search_index(metadata):
+    """Create and drop the search index together with the tables it indexes."""
+    event.listen(metadata, 'after_create', lambda target, connection, **kw: install_search_index(connection))
+    event.listen(metadata, 'before_drop', lambda target, connection, **kw: drop_search_index(connection))
+
+
+def _backend():
+    engine = db.engine
+    if engine not in _backends:
+        backend = 'like'
+        if engine.dialect.name == 'sqlite':
+            found = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'recipe_fts'")).scalar()
+            backend = 'sqlite' if found else 'like'
+        elif engine.dialect.name == 'postgresql':
+            found = db.session.execute(text("SELECT to_regclass('recipe_search')")).scalar()
+            backend = 'postgresql' if found else 'like'
+        _backends[engine] = backend
+    return _backends[engine]
+
+
+def _words(term):
+    return re.findall(r'\w+', term.lower(), re.UNICODE)
+
+
+def _sqlite_corrections(word):
+    # indexed words of about the same length sharing the first letter, since typos rarely hit it
+    candidates = db.session.execute(text(
+        "SELECT term FROM recipe_fts_vocab WHERE term >= :first AND term < :after "
+        "AND length(term) BETWEEN :shortest AND :longest"),
+        {'first': word[0], 'after': chr(ord(word[0]) + 1),
+         'shortest': len(word) - 2, 'longest': len(word) + 2}).fetchall()
+    return difflib.get_close_matches(word, [c[0] for c in candidates], n=3, cutoff=0.7)
+
+
+def _sqlite_match_expression(words):
+    # every word must match, either as a prefix of an indexed word or, if nothing starts with it, as a close spelling
+    clauses = []
+    for word in words:
+        options = ['"%s"*' % word]
+        if len(word) >= MIN_CORRECTED_LENGTH:
+            known = db.session.execute(text(
+                "SELECT 1 FROM recipe_fts_vocab WHERE term >= :word AND term < :after LIMIT 1"),
+                {'word': word, 'after': word + u'\U0010ffff'}).scalar()
+            if not known:
+                options.extend('"%s"' % correction for correction in _sqlite_corrections(word))
+        clauses.append('(' + ' OR '.join(options) + ')')
+    return ' AND '.join(clauses)
+
+
+def _matches(words, term):
+    """A (recipe_id, rank) selectable of the matching recipes, lower ranks are better."""
+    backend = _backend()
+    if backend == 'sqlite':
+        # bm25 weights: a hit in the name counts more than one in the description, which counts more than the method
+        return text(
+            "SELECT rowid AS recipe_id, bm25(recipe_fts, 10.0, 4.0, 1.0) AS rank "
+            "FROM recipe_fts WHERE recipe_fts MATCH :match") \
+            .bindparams(match=_sqlite_match_expression(words)) \
+            .columns(column('recipe_id', Integer), column('rank', Float)) \
+            .alias('matches')
+    if backend == 'postgresql':
+        return text(
+            "SELECT recipe_id, -(ts_rank_cd(document, query) + word_similarity(:term, body)) AS rank "
+            "FROM recipe_search, plainto_tsquery('english', :term) query "
+            "WHERE document @@ query OR :term <% body") \
+            .bindparams(term=term) \
+            .columns(column('recipe_id', Integer), column('rank', Float)) \
+            .alias('matches')
+    return None
+
+
+def search_recipes(term, page=1, per_page=10):
+    """Return one page of the recipes matching term, best match first, with the total number of matches."""
+    words = _words(term)
+    page = max(page, 1)
+    if not words:
+        return SearchResults([], 0, page, per_page)
+
+    matches = _matches(words, term)
+    total = func.count().over().label('total')
+    if matches is not None:
+        query = db.session.query(Recipe, total) \
+            .join(matches, matches.c.recipe_id == Recipe.id) \
+            .order_by(matches.c.rank, Recipe.id)
+    else:
+        pattern = '%' + term.strip() + '%'
+        query = db.session.query(Recipe, total) \
+            .filter(or_(Recipe.recipe_name.ilike(pattern), Recipe.recipe_description.ilike(pattern))) \
+            .order_by(Recipe.recipe_name)
+    rows = query.limit(per_page).offset((page - 1) * per_page).all()
+    # the total comes with every row from the window function, so the page and its count are one query
+    total = rows[0][1] if rows else 0
+    return SearchResults([recipe for recipe, _ in rows], total, page, per_page)
+
+
+INGREDIENT_MATCH_MODES = ('all', 'any', 'pantry')
+
+
+def parse_ingredients(term):
+    """Split 'tomato, basil, -garlic' into the ingredients wanted and the ingredients to avoid."""
+    include, exclude = [], []
+    for name in re.split(r'[,;\n]', term):
+        name = name.strip()
+        if name.startswith('-'):
+            name = name[1:].strip()
+            if name:
+                exclude.append(name)
+        elif name:
+            include.append(name)
+    return include, exclude
+
+
+def _ingredient_like(names):
+    # whole words only, so "egg" finds "free range egg" but not "eggplant", and "salt" does not find "unsalted butter"
+    padded = literal(' ') + Ingredient.normalized_name + ' '
+    return or_(*[padded.contains(' %s ' % normalize_ingredient_name(name), autoescape=True) for name in names])
+
+
+def find_recipes_by_ingredients(include, exclude=(), mode='all', page=1, per_page=10):
+    """
+    Return one page of the recipes using the included ingredients (all of them, or any of them) and none of the excluded
+    ones. In pantry mode include is what is at hand: recipes using any of it are returned, those missing the fewest
+    other ingredients first, and results.missing holds the number missing per recipe id.
+    Everything is worked out by a single grouped query over the quantities of each recipe.
+    """
+    page = max(page, 1)
+    if mode not in INGREDIENT_MATCH_MODES:
+        mode = 'all'
+    if not include and (mode == 'pantry' or not exclude):
+        return SearchResults([], 0, page, per_page)
+
+    total = func.count().over().label('total')
+    query = db.session.query(Recipe, total)
+    if include and mode != 'pantry':
+        # only the quantities of wanted ingredients are looked at, so with inner joins the database can start from
+        # the matching ingredients and reach their recipes through the quantity index
+        query = query.join(Quantity, Quantity.recipe_id == Recipe.id) \
+            .join(Ingredient, Ingredient.id == Quantity.ingredient_id)
+    else:
+        query = query.outerjoin(Quantity, Quantity.recipe_id == Recipe.id) \
+            .outerjoin(Ingredient, Ingredient.id == Quantity.ingredient_id)
+    query = query.group_by(Recipe.id)
+    if exclude:
+        query = query.filter(~Recipe.quantities.any(Quantity.ingredient.has(_ingredient_like(exclude))))
+
+    if mode == 'pantry':
+        have = func.sum(case([(_ingredient_like(include), 1)], else_=0))
+        missing = (func.count(Quantity.id) - have).label('missing')
+        query = query.add_columns(missing) \
+            .having(have > 0) \
+            .order_by(missing, have.desc(), Recipe.id.desc())
+    elif include:
+        # one flag per wanted ingredient, set when any of the recipe's quantities uses it
+        found = [func.max(case([(_ingredient_like([name]), 1)], else_=0)) for name in include]
+        query = query.filter(_ingredient_like(include))
+        if mode == 'all':
+            query = query.having(and_(*[flag == 1 for flag in found]))
+        query = query.order_by(sum(found).desc(), Recipe.id.desc())
+    else:
+        query = query.order_by(Recipe.id.desc())
+
+    rows = query.limit(per_page).offset((page - 1) * per_page).all()
+    total = rows[0][1] if rows else 0
+    missing = dict((row[0].id, row[2]) for row in rows) if mode == 'pantry' else None
+    return SearchResults([row[0] for row in rows], total, page, per_page, missing)
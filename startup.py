@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Worker start up. Times how long importing the app, creating it and warming it up take, keeps compiled templates on
+disk for every worker to share, and makes pooled database connections safe to use across a fork, so the app can be
+created once in a preloading master process and forked into workers that each open their own connections."""
+import os
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+
+# seconds taken by each start up step of this process, in the order they ran
+timings = OrderedDict()
+
+
+@contextmanager
+def timed(step):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = time.perf_counter() - started
+
+
+def record(step, started):
+    timings[step] = time.perf_counter() - started
+
+
+_ready_pid = None
+
+
+def mark_ready():
+    """Record that this process has warmed up, and so is ready for traffic."""
+    global _ready_pid
+    _ready_pid = os.getpid()
+
+
+def is_ready():
+    # a forked worker does not inherit the readiness of its master
+    return _ready_pid == os.getpid()
+
+
+def startup_report():
+    return ', '.join('{} {:.1f}ms'.format(step, seconds * 1000) for step, seconds in timings.items())
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """
+    Compiled templates kept on disk, so a new worker unmarshals the bytecode of a template instead of parsing and
+    compiling its source. Entries are written under a temporary name and renamed into place, as several workers may
+    write the same template at once and must never read a half written file.
+    """
+
+    def dump_bytecode(self, bucket):
+        name = self._get_cache_filename(bucket)
+        part = '{}.{}.part'.format(name, uuid.uuid4().hex)
+        try:
+            with open(part, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(part, name)
+        except OSError:
+            # the cache only saves time, a template is still rendered without it
+            if os.path.exists(part):
+                os.remove(part)
+
+
+_fork_safe = False
+
+
+def make_pools_fork_safe():
+    """
+    Discard pooled connections that were opened by another process. A forked worker inherits the master's pool and
+    its sockets, which must not be used by two processes at once; checking one out in the child makes the pool
+    drop it and connect anew. See "Using Connection Pools with Multiprocessing" in the SQLAlchemy docs.
+    """
+    global _fork_safe
+    if _fork_safe:
+        return
+    _fork_safe = True
+
+    @event.listens_for(Pool, 'connect')
+    def remember_pid(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(Pool, 'checkout')
+    def check_pid(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info.setdefault('pid', pid) != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError('Connection record belongs to pid %s, attempting to check out in pid %s'
+                                         % (connection_record.info['pid'], pid))
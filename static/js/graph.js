@@ -1,40 +1,109 @@
 d3.queue()
-    .defer(d3.json, "/get_recipes")
+    .defer(d3.json, "/get_recipe_stats")
     .await(makeGraphs);
 
 
-function makeGraphs(error, recipeData) {
-    var ndx = crossfilter(recipeData);
-    show_category_selector(ndx);
-    show_category_graph(ndx);
+function makeGraphs(error, recipeStats) {
+    showGraphs({
+        category: countsGroup(recipeStats.category),
+        course: countsGroup(recipeStats.course),
+        cuisine: countsGroup(recipeStats.cuisine),
+        author: countsGroup(recipeStats.author)
+    });
 
-    show_course_graph(ndx);
-    show_cuisine_graph(ndx);
-    show_author_graph(ndx);
+    // row level data is only needed to filter the charts by each other, so it is fetched the first time one is filtered
+    dc.chartRegistry.list().forEach(function(chart) {
+        chart.on("filtered.rows", loadRows);
+    });
+}
+
+var rowsRequested = false;
+
+function loadRows() {
+    if (rowsRequested) {
+        return;
+    }
+    rowsRequested = true;
+    d3.json("/get_recipes?format=columnar", function(error, recipeColumns) {
+        if (error) {
+            rowsRequested = false;
+            return;
+        }
+        // keep what was chosen on the count charts while the rows were loading
+        var filters = {};
+        dc.chartRegistry.list().forEach(function(chart) {
+            chart.on("filtered.rows", null);
+            filters[chart.anchorName()] = chart.filters();
+        });
+        var ndx = crossfilter(decodeColumns(recipeColumns));
+        dc.deregisterAllCharts();
+        showGraphs({
+            category: rowsGroup(ndx, "category"),
+            course: rowsGroup(ndx, "course"),
+            cuisine: rowsGroup(ndx, "cuisine"),
+            author: rowsGroup(ndx, "author")
+        });
+        dc.chartRegistry.list().forEach(function(chart) {
+            (filters[chart.anchorName()] || []).forEach(function(filter) {
+                chart.filter(filter);
+            });
+        });
+        dc.redrawAll();
+    });
+}
+
+function showGraphs(groups) {
+    show_category_graph(groups.category);
+    show_course_graph(groups.course);
+    show_cuisine_graph(groups.cuisine);
+    show_author_graph(groups.author);
 
     dc.renderAll();
 }
 
 
-function show_category_selector(ndx) {
-    var categorySelectorDim = ndx.dimension(dc.pluck("category"));
-    var categorySelectorSelect = categorySelectorDim.group();
+// the server sends counts that are already grouped, as [{key: name, value: count}],
+// so each chart only needs a dimension on the name and a group summing the counts
+function countsGroup(counts) {
+    var ndx = crossfilter(counts);
+    var dim = ndx.dimension(dc.pluck("key"));
+    return {
+        dimension: dim,
+        group: dim.group().reduceSum(dc.pluck("value"))
+    };
+}
 
-    dc.selectMenu("#category-selector")
-        .dimension(categorySelectorDim)
-        .group(categorySelectorSelect);
+function rowsGroup(ndx, field) {
+    var dim = ndx.dimension(dc.pluck(field));
+    return {
+        dimension: dim,
+        group: dim.group()
+    };
 }
 
-function show_category_graph(ndx) {
-    var categoryDim = ndx.dimension(dc.pluck("category"));
-    var categoryMix = categoryDim.group();
+// turn the columnar payload back into one object per recipe: every dimension column
+// holds positions in the matching lookup table of recipeColumns.dimensions
+function decodeColumns(recipeColumns) {
+    var dimensions = recipeColumns.dimensions;
+    var recipes = [];
+    for (var i = 0; i < recipeColumns.category.length; i++) {
+        recipes.push({
+            category: dimensions.category[recipeColumns.category[i]],
+            course: dimensions.course[recipeColumns.course[i]],
+            cuisine: dimensions.cuisine[recipeColumns.cuisine[i]],
+            author: dimensions.author[recipeColumns.author[i]]
+        });
+    }
+    return recipes;
+}
 
+function show_category_graph(counts) {
     dc.barChart("#category-graph")
         .width(350)
         .height(250)
         .margins({top: 20, right: 20, bottom: 30, left: 10})
-        .dimension(categoryDim)
-        .group(categoryMix)
+        .dimension(counts.dimension)
+        .group(counts.group)
         .transitionDuration(500)
         .x(d3.scale.ordinal())
         .xUnits(dc.units.ordinal)
@@ -44,16 +113,13 @@ function show_category_graph(ndx) {
 
 }
 
-function show_cuisine_graph(ndx) {
-    var cuisineDim = ndx.dimension(dc.pluck("cuisine"));
-    var cuisineMix = cuisineDim.group();
-
+function show_cuisine_graph(counts) {
     dc.rowChart("#cuisine-graph")
         .width(350)
         .height(250)
         .margins({top: 20, right: 20, bottom: 20, left: 10})
-        .dimension(cuisineDim)
-        .group(cuisineMix)
+        .dimension(counts.dimension)
+        .group(counts.group)
 //        .transitionDuration(500)
         .rowsCap(20)
         .elasticX(true)
@@ -64,17 +130,14 @@ function show_cuisine_graph(ndx) {
 
 }
 
-function show_course_graph(ndx) {
-    var courseDim = ndx.dimension(dc.pluck("course"));
-    var courseMix = courseDim.group();
-
+function show_course_graph(counts) {
     var coursePieChart = dc.pieChart("#course-graph");
 
     coursePieChart
         .width(350)
         .height(250)
-        .dimension(courseDim)
-        .group(courseMix)
+        .dimension(counts.dimension)
+        .group(counts.group)
         .innerRadius(50)
         .transitionDuration(1500)
         .legend(dc.legend());
@@ -93,33 +156,13 @@ function show_course_graph(ndx) {
 
 }
 
-function show_category_graph(ndx) {
-    var categoryDim = ndx.dimension(dc.pluck("category"));
-    var categoryMix = categoryDim.group();
-
-    dc.barChart("#category-graph")
-        .width(350)
-        .height(250)
-        .margins({top: 20, right: 20, bottom: 30, left: 10})
-        .dimension(categoryDim)
-        .group(categoryMix)
-        .transitionDuration(500)
-        .x(d3.scale.ordinal())
-        .xUnits(dc.units.ordinal)
-        .elasticY(true)
-        .xAxisLabel("Category")
-        .yAxis().tickFormat(d3.format("d"));
-
-}function show_author_graph(ndx) {
-    var authorDim = ndx.dimension(dc.pluck("author"));
-    var authorMix = authorDim.group();
-
+function show_author_graph(counts) {
     dc.barChart("#author-graph")
         .width(400)
         .height(250)
         .margins({top: 20, right: 20, bottom: 30, left: 10})
-        .dimension(authorDim)
-        .group(authorMix)
+        .dimension(counts.dimension)
+        .group(counts.group)
         .transitionDuration(500)
         .x(d3.scale.ordinal())
         .xUnits(dc.units.ordinal)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Where recipe images are kept. Both backends store a local file under a key and give back the url it is served from:
+S3Storage puts it in a bucket, LocalStorage copies it into a directory that the app itself serves."""
+import os
+import shutil
+import threading
+
+from flask import redirect, send_from_directory
+
+from metrics import storage_seconds
+
+
+class S3Storage(object):
+    """
+    The boto3 client is made on first use rather than when the app is created: importing boto3 and building a client
+    are slow, and a client must not be shared with processes forked after it was made, so each process makes its own.
+    """
+
+    def __init__(self, bucket, location, **client_options):
+        self.bucket = bucket
+        self.location = location
+        self.client_options = client_options
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                import boto3
+                self._client = boto3.client("s3", **self.client_options)
+                self._pid = os.getpid()
+            return self._client
+
+    def url(self, key):
+        return "{}{}".format(self.location, key)
+
+    def save(self, path, key, content_type):
+        """Docs: http://boto3.readthedocs.io/en/latest/guide/s3.html"""
+        with storage_seconds.time(('s3', 'upload_file')):
+            self.client.upload_file(path, self.bucket, key,
+                ExtraArgs={"ACL": "public-read", "ContentType": content_type})
+        return self.url(key)
+
+    def send(self, key, max_age):
+        return redirect(self.url(key))
+
+
+class LocalStorage(object):
+
+    def __init__(self, root, url_prefix):
+        self.root = root
+        self.url_prefix = url_prefix
+
+    def url(self, key):
+        return "{}{}".format(self.url_prefix, key)
+
+    def save(self, path, key, content_type):
+        target = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # copy under a temporary name first so a half written file is never served
+        with storage_seconds.time(('local', 'save')):
+            shutil.copyfile(path, target + '.part')
+            os.replace(target + '.part', target)
+        return self.url(key)
+
+    def send(self, key, max_age):
+        # the file is handed to the server's sendfile (or to the proxy with USE_X_SENDFILE) rather than read in
+        # Python, and conditional requests and byte ranges are answered from it directly
+        response = send_from_directory(self.root, key, max_age=max_age, conditional=True)
+        # keys are never reused for other content, so browsers need not revalidate
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
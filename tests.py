@@ -1,8 +1,44 @@
+import io
 import os
+import hashlib
+import csv
+import glob
+import gzip
+import re
+import json
+import shutil
+import tempfile
+import runpy
+import subprocess
+import sys
+import threading
+import time
 import unittest
+from concurrent.futures import Future
+from contextlib import contextmanager
+from unittest import mock
+
+from PIL import Image
+from sqlalchemy import event, create_engine, MetaData, Table
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from werkzeug.serving import make_server
  
-from app import app, db, BASEDIR
-from models import User, Recipe, Category, Course, Cuisine, Author, Country, Measurement, Quantity, Ingredient, Method
+from app import db, BASEDIR, create_app, warm_up
+from storage import LocalStorage
+import cache
+import http_cache
+import startup
+from startup import TemplateBytecodeCache
+from metrics import query_budget, QueryBudgetExceeded
+from indexes import query_plan_scans
+from benchmarks import loadgen
+from benchmarks.routes import ROUTE_NAMES
+from schema import upgrade_schema
+from models import User, Recipe, Category, Course, Cuisine, Author, Country, Measurement, Quantity, Ingredient, Method, SavedRecipe
+
+app = create_app()
+image_uploads = app.extensions['image_uploads']
  
  
 class TestCase(unittest.TestCase):
@@ -151,40 +187,70 @@ class TestCase(unittest.TestCase):
             
             db.session.commit()
 
+    def add_more_recipes(self, count):
+        with app.app_context():
+            user1 = User.query.filter_by(username='user@email.com').first()
+            category = Category.query.first()
+            course = Course.query.first()
+            cuisine = Cuisine.query.first()
+            author = Author.query.first()
+            for i in range(count):
+                db.session.add(Recipe(user1, 'Paged Recipe %d' % i, 'Paged Recipe Description %d' % i, 10, 20, 2, category, course, cuisine, author, None, None))
+            db.session.commit()
+
+    @contextmanager
+    def record_queries(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
  
     ###############
     #### test views ####
     ###############
  
+    @query_budget(index=6)
     def test_index_page(self):
         response = self.app.get('/', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    @query_budget(register=0)
     def test_register_page(self):
         response = self.app.get('/register', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    @query_budget(login=0)
     def test_login_page(self):
         response = self.app.get('/login', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    @query_budget(login=0, my_recipes=0)
     def test_my_recipes_page(self):
         response = self.app.get('/my_recipes', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    @query_budget(login=0, my_saved_recipes=0)
     def test_my_saved_recipes_page(self):
         response = self.app.get('/my_saved_recipes', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    @query_budget(login=0, manage_static_data=0)
     def test_manage_categories_page(self):
         response = self.app.get('/manage_static_data', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'Manage Categories', response.data)
     
+    @query_budget(dashboard=0)
     def test_dashboard_page(self):
         response = self.app.get('/dashboard', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    @query_budget(add_recipe=0, login=0)
     def test_add_recipe_page(self):
         response = self.app.get('/add_recipe', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
@@ -193,6 +259,7 @@ class TestCase(unittest.TestCase):
     #### test user auth ####
     ###############
     
+    @query_budget(login=0, register=2)
     def test_valid_user_registration(self):
         response = self.register('user@email.com', 'FlaskIsAmazing', 'FlaskIsAmazing')
         self.assertEqual(response.status_code, 200)
@@ -202,30 +269,71 @@ class TestCase(unittest.TestCase):
             user = User.query.filter_by(username='user@email.com').first()
             self.assertTrue(user is not None)
 
+    @query_budget(register=1)
     def test_invalid_user_registration_different_passwords(self):
         response = self.register('user@email.com', 'FlaskIsAmazing', 'FlaskIsNotAmazing')
         self.assertIn(b'Field must be equal to password.', response.data)
 
+    @query_budget(login=0, register=2)
     def test_invalid_user_registration_duplicate_username(self):
         self.register_user()
         response = self.register('user@email.com', 'FlaskIsReallyAmazing', 'FlaskIsReallyAmazing')
         self.assertIn(b'Username already taken, please use a different username.', response.data)
 
+    @query_budget(index=7, login=1, register=2)
     def test_valid_user_login(self):
         self.register_user()
         response = self.login('user@email.com', 'FlaskIsAmazing')
         self.assertIn(b'Success, you are now logged in!', response.data)
 
+    @query_budget(index=7, login=1, my_recipes=2, register=2)
+    def test_user_loader_cache(self):
+        self.add_test_data()
+        self.login_user()
+        self.app.get('/my_recipes')
+        # the logged in user is identified without reading the user table
+        with self.record_queries() as statements:
+            response = self.app.get('/my_recipes')
+        self.assertIn(b'Test Recipe Name 1', response.data)
+        self.assertFalse([s for s in statements if 'FROM user' in s])
+        # check a change to the user is picked up
+        with app.app_context():
+            User.query.filter_by(username='user@email.com').first().username = 'renamed@email.com'
+            db.session.commit()
+        with self.record_queries() as statements:
+            self.app.get('/my_recipes')
+        self.assertEqual(len([s for s in statements if 'FROM user' in s]), 1)
+
+    @query_budget(index=6, login=1, logout=0, my_recipes=2, register=2)
+    def test_session_identity(self):
+        self.addCleanup(app.config.update, SESSION_IDENTITY=False)
+        app.config['SESSION_IDENTITY'] = True
+        self.add_test_data()
+        self.login_user()
+        app.extensions['data_caches']['user'].clear()
+        with self.record_queries() as statements:
+            response = self.app.get('/my_recipes')
+        self.assertIn(b'Test Recipe Name 1', response.data)
+        self.assertFalse([s for s in statements if 'FROM user' in s])
+        with self.app.session_transaction() as session:
+            self.assertEqual(session['_identity'], [1, 'user@email.com'])
+        self.logout()
+        with self.app.session_transaction() as session:
+            self.assertNotIn('_identity', session)
+
+    @query_budget(login=1, register=2)
     def test_invalid_user_login_incorrect_username(self):
         self.register_user()
         response = self.login('person@gmail.com', 'FlaskIsAmazing')
         self.assertIn(b'Invalid username', response.data)
 
+    @query_budget(login=1, register=2)
     def test_invalid_user_login_incorrect_password(self):
         self.register_user()
         response = self.login('user@email.com', 'FlaskIsOK')
         self.assertIn(b'Invalid password', response.data)
 
+    @query_budget(index=7, login=1, logout=0, register=2)
     def test_user_logout(self):
         self.register_user()
         self.login_user()
@@ -237,6 +345,7 @@ class TestCase(unittest.TestCase):
     #### test CRUD functions (database integration tests)####
     ###############
 
+    @query_budget(index=7, login=1, register=2)
     def test_recipe_list(self):
         self.add_test_data()
         self.login_user()
@@ -245,6 +354,7 @@ class TestCase(unittest.TestCase):
         self.assertIn(b'Test Recipe Name 1', response.data)
         self.assertIn(b'Test Recipe Description 1', response.data)
 
+    @query_budget(index=7, login=1, recipe_detail=2, register=2)
     def test_recipe_detail(self):
         self.add_test_data()
         self.login_user()
@@ -263,6 +373,112 @@ class TestCase(unittest.TestCase):
         self.assertIn(b'1.0 Test Measurement 1 Test Ingredient 1', response.data)
         self.assertIn(b'Test Method 1', response.data)
 
+    @query_budget(index=7, login=1, logout=0, recipe_detail=2, register=2)
+    def test_recipe_detail_edited_by_another_worker(self):
+        self.add_test_data()
+        self.app.get('/recipe_detail/1')
+        self.login_user()
+        response = self.app.get('/recipe_detail/1')
+        self.assertIn(b'Test Recipe Name 1', response.data)
+        # another worker process edits the recipe, and bumps the data versions it counts itself
+        subprocess.run([sys.executable, '-c', 'import sys\n'
+                        'from app import create_app, db\n'
+                        'from models import Recipe\n'
+                        'worker = create_app({"SQLALCHEMY_DATABASE_URI": sys.argv[1], "WARM_UP": False})\n'
+                        'with worker.app_context():\n'
+                        '    Recipe.query.get(1).recipe_name = "Test Recipe Name 1 Edited"\n'
+                        '    db.session.commit()\n',
+                        app.config['SQLALCHEMY_DATABASE_URI']], cwd=BASEDIR, check=True)
+        # check the owner is shown the edit at once
+        response = self.app.get('/recipe_detail/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Test Recipe Name 1 Edited', response.data)
+        # while other visitors may be shown the cached page until it expires
+        self.logout()
+        response = self.app.get('/recipe_detail/1')
+        self.assertNotIn(b'Test Recipe Name 1 Edited', response.data)
+
+    @query_budget(add_method=2, delete_method=4, index=7, login=1, recipe_detail=2, register=2)
+    def test_recipe_detail_cache(self):
+        self.add_test_data()
+        # the whole recipe is read with one query, and not at all once its page is cached
+        with self.record_queries() as statements:
+            response = self.app.get('/recipe_detail/1')
+        self.assertEqual(len(statements), 1)
+        self.assertIn(b'1.0 Test Measurement 1 Test Ingredient 1', response.data)
+        with self.record_queries() as statements:
+            response = self.app.get('/recipe_detail/1')
+        self.assertEqual(statements, [])
+        self.assertIn(b'Test Method 1', response.data)
+        # only the owner sees the edit buttons
+        self.assertNotIn(b'/edit_recipe/1', response.data)
+        self.login_user()
+        response = self.app.get('/recipe_detail/1')
+        self.assertIn(b'/edit_recipe/1', response.data)
+        # check the cached page follows changes to the recipe
+        self.app.post('/add_method/1', data={'method': 'Test Method A'})
+        response = self.app.get('/recipe_detail/1')
+        self.assertIn(b'Test Method A', response.data)
+        self.app.get('/delete_method/1')
+        response = self.app.get('/recipe_detail/1')
+        self.assertNotIn(b'Test Method 1', response.data)
+        response = self.app.get('/recipe_detail/3')
+        self.assertEqual(response.status_code, 404)
+
+    @query_budget(add_category=1, index=6, login=1, register=2)
+    @mock.patch('http_cache.time')
+    def test_conditional_get(self, clock):
+        clock.time.return_value = time.time()
+        self.add_test_data()
+        response = self.app.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertIn('Last-Modified', response.headers)
+        etag = response.headers['ETag']
+        # an unchanged page is revalidated, and an anonymous one served again, without reading the database
+        with self.record_queries() as statements:
+            response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(statements, [])
+        with self.record_queries() as statements:
+            response = self.app.get('/')
+        self.assertEqual(statements, [])
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertIn(b'Test Recipe Name 1', response.data)
+        # check another worker, whose data versions differ, gives the same anonymous page the same ETag
+        self.assertEqual(response.get_etag()[0], hashlib.sha1(response.data).hexdigest())
+        app.extensions['data_caches']['page'].clear()
+        cache.bump('recipe')
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        # each visitor gets their own validators
+        self.login_user()
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        user_etag = response.headers['ETag']
+        self.assertNotEqual(user_etag, etag)
+        # and those of a restarted process, whose versions count from 0 again, never match
+        http_cache._process_ids.clear()
+        response = self.app.get('/', headers={'If-None-Match': user_etag})
+        self.assertEqual(response.status_code, 200)
+        user_etag = response.headers['ETag']
+        response = self.app.get('/', headers={'If-None-Match': user_etag})
+        self.assertEqual(response.status_code, 304)
+        # check they stop validating once they are as old as the data caches' entries, since other workers may have
+        # changed the data meanwhile
+        clock.time.return_value += app.config['DATA_CACHE_TTL']
+        response = self.app.get('/', headers={'If-None-Match': user_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], user_etag)
+        user_etag = response.headers['ETag']
+        # check the validators move on once the data changes
+        self.app.post('/add_category', data={'category': 'Test Category A'})
+        response = self.app.get('/', headers={'If-None-Match': user_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Test Category A', response.data)
+
+    @query_budget(index=7, login=1, my_recipes=2, register=2)
     def test_my_recipes(self):
         self.add_test_data()
         self.login_user()
@@ -273,6 +489,47 @@ class TestCase(unittest.TestCase):
         self.assertIn(b'Test Recipe Name 1', response.data)
         self.assertIn(b'Test Recipe Description 1', response.data)
 
+    @query_budget(index=6, login=0, register=2)
+    def test_recipe_list_pagination(self):
+        self.add_test_data()
+        self.add_more_recipes(10)
+        # newest first, ten recipes per page
+        response = self.app.get('/')
+        self.assertIn(b'Recipe count: 12', response.data)
+        self.assertIn(b'Paged Recipe 9', response.data)
+        self.assertIn(b'Paged Recipe 0', response.data)
+        self.assertNotIn(b'Test Recipe Name 2', response.data)
+        self.assertNotIn(b'Previous page of recipes', response.data)
+        next_url = re.search(b'href="([^"]+)">Next page of recipes', response.data).group(1).decode()
+        response = self.app.get(next_url)
+        self.assertIn(b'Test Recipe Name 2', response.data)
+        self.assertIn(b'Test Recipe Name 1', response.data)
+        self.assertNotIn(b'Paged Recipe 0', response.data)
+        self.assertNotIn(b'Next page of recipes', response.data)
+        prev_url = re.search(b'href="([^"]+)">Previous page of recipes', response.data).group(1).decode()
+        response = self.app.get(prev_url)
+        self.assertIn(b'Paged Recipe 9', response.data)
+        self.assertIn(b'Paged Recipe 0', response.data)
+        self.assertNotIn(b'Test Recipe Name 2', response.data)
+        # check a tampered cursor falls back to the first page
+        response = self.app.get('/?cursor=tampered')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Paged Recipe 9', response.data)
+
+    @query_budget(index=7, login=1, my_recipes=2, register=2)
+    def test_my_recipes_pagination(self):
+        self.add_test_data()
+        self.add_more_recipes(10)
+        self.login_user()
+        response = self.app.get('/my_recipes')
+        self.assertIn(b'Recipe count: 11', response.data)
+        next_url = re.search(b'href="([^"]+)">Next page of recipes', response.data).group(1).decode()
+        self.assertTrue(next_url.startswith('/my_recipes?cursor='))
+        response = self.app.get(next_url)
+        self.assertIn(b'Test Recipe Name 1', response.data)
+        self.assertNotIn(b'Paged Recipe', response.data)
+
+    @query_budget(index=7, login=1, logout=0, my_saved_recipes=3, recipe_detail=3, register=2, save_recipe=3)
     def test_save_recipe(self):
         self.add_test_data()
         self.login_user()
@@ -304,6 +561,7 @@ class TestCase(unittest.TestCase):
         self.assertIn(b'Test Recipe Name 2', response.data)
         self.assertNotIn(b'Test Recipe Name 1', response.data)
 
+    @query_budget(delete_saved_recipe=2, index=7, login=1, my_saved_recipes=3, recipe_detail=3, register=2, save_recipe=3)
     def test_delete_saved_recipe(self):
         self.add_test_data()
         self.login_user2()
@@ -326,6 +584,26 @@ class TestCase(unittest.TestCase):
         self.assertNotIn(b'Test Recipe Name 1', response.data)
         self.assertNotIn(b'Test Recipe Description 1', response.data)
 
+    @query_budget(index=7, login=1, my_saved_recipes=3, register=2)
+    def test_my_saved_recipes_pagination(self):
+        self.add_test_data()
+        self.add_more_recipes(10)
+        with app.app_context():
+            user1 = User.query.filter_by(username='user@email.com').first()
+            for recipe in Recipe.query.all():
+                db.session.add(SavedRecipe(user1, recipe))
+            db.session.commit()
+        self.login_user()
+        # a full page of saved recipes runs as many statements as a single one
+        response = self.app.get('/my_saved_recipes')
+        self.assertIn(b'Recipe count: 12', response.data)
+        self.assertEqual(response.data.count(b'collapsible-header'), 10)
+        next_url = re.search(b'href="([^"]+)">Next page of recipes', response.data).group(1).decode()
+        response = self.app.get(next_url)
+        self.assertEqual(response.data.count(b'collapsible-header'), 2)
+        self.assertIn(b'Previous page of recipes', response.data)
+
+    @query_budget(login=0, recipe_search=4, register=2)
     def test_recipe_search(self):
         self.add_test_data()
         # check for partial match only one result
@@ -359,6 +637,55 @@ class TestCase(unittest.TestCase):
         self.assertNotIn(b'Test Recipe Name 1', response.data)
         self.assertNotIn(b'Test Recipe Name 2', response.data)
 
+    @query_budget(login=0, recipe_search=4, register=2)
+    def test_recipe_search_ranking(self):
+        with app.app_context():
+            self.add_test_data()
+            user1 = User.query.filter_by(username='user@email.com').first()
+            category = Category.query.first()
+            course = Course.query.first()
+            cuisine = Cuisine.query.first()
+            author = Author.query.first()
+            db.session.add(Recipe(user1, 'Garden Salad', 'Goes well with lemon tart', 10, 0, 2, category, course, cuisine, author, None, None))
+            db.session.add(Recipe(user1, 'Lemon Tart', 'A sharp dessert', 30, 40, 6, category, course, cuisine, author, None, None))
+            db.session.commit()
+            # check a match on the name ranks above a match on the description
+            response = self.app.post('/recipe_search', data={'recipe_name': 'lemon'})
+            self.assertIn(b'Recipe count: 2', response.data)
+            self.assertLess(response.data.index(b'Lemon Tart'), response.data.index(b'Garden Salad'))
+            # check the method text is searched
+            response = self.app.post('/recipe_search', data={'recipe_name': 'Method 2'})
+            self.assertIn(b'Recipe count: 1', response.data)
+            self.assertIn(b'Test Recipe Name 2', response.data)
+            # check misspelt words still match
+            response = self.app.post('/recipe_search', data={'recipe_name': 'Recipe Descripton 2'})
+            self.assertIn(b'Recipe count: 1', response.data)
+            self.assertIn(b'Test Recipe Name 2', response.data)
+            # check the index follows renamed recipes
+            recipe = Recipe.query.filter_by(recipe_name='Garden Salad').first()
+            recipe.recipe_name = 'Green Salad'
+            recipe.recipe_description = 'Crunchy'
+            db.session.commit()
+            response = self.app.post('/recipe_search', data={'recipe_name': 'lemon'})
+            self.assertIn(b'Recipe count: 1', response.data)
+            response = self.app.post('/recipe_search', data={'recipe_name': 'green'})
+            self.assertIn(b'Green Salad', response.data)
+
+    @query_budget(login=0, recipe_search=3, register=2)
+    def test_recipe_search_pagination(self):
+        self.add_test_data()
+        self.add_more_recipes(10)
+        response = self.app.post('/recipe_search', data={'recipe_name': 'Recipe'})
+        self.assertIn(b'Recipe count: 12', response.data)
+        self.assertNotIn(b'Previous page of recipes', response.data)
+        next_url = re.search(b'href="([^"]+)">Next page of recipes', response.data).group(1).decode()
+        response = self.app.get(next_url.replace('&amp;', '&'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Recipe count: 12', response.data)
+        self.assertEqual(response.data.count(b'collapsible-header'), 2)
+        self.assertIn(b'Previous page of recipes', response.data)
+
+    @query_budget(ingredient_search=1, login=0, register=2)
     def test_ingredient_search(self):
         self.add_test_data()
         # check for partial match only one result
@@ -392,6 +719,72 @@ class TestCase(unittest.TestCase):
         self.assertNotIn(b'Test Recipe Name 1', response.data)
         self.assertNotIn(b'Test Recipe Name 2', response.data)
 
+    @query_budget(ingredient_search=1, login=0, register=2)
+    def test_ingredient_search_pagination(self):
+        self.add_test_data()
+        self.add_more_recipes(10)
+        with app.app_context():
+            ingredient = Ingredient.query.filter_by(ingredient_name='Test Ingredient 1').first()
+            measurement = Measurement.query.first()
+            for recipe in Recipe.query.filter(Recipe.recipe_name.like('Paged Recipe %')):
+                db.session.add(Quantity(1, recipe, ingredient, measurement))
+            db.session.commit()
+        # a full page of matches runs as many statements as a single one
+        response = self.app.post('/ingredient_search', data={'ingredient_name': 'Test Ingredient 1', 'match': 'pantry'})
+        self.assertIn(b'Recipe count: 11', response.data)
+        self.assertEqual(response.data.count(b'collapsible-header'), 10)
+        next_url = re.search(b'href="([^"]+)">Next page of recipes', response.data).group(1).decode()
+        response = self.app.get(next_url.replace('&amp;', '&'))
+        self.assertEqual(response.data.count(b'collapsible-header'), 1)
+
+    @query_budget(ingredient_search=1, login=0, register=2)
+    def test_ingredient_search_sets(self):
+        with app.app_context():
+            self.add_test_data()
+            # recipe 1 uses ingredients 1 and 2, recipe 2 only ingredient 2
+            recipe = Recipe.query.filter_by(recipe_name='Test Recipe Name 1').first()
+            ingredient = Ingredient.query.filter_by(ingredient_name='Test Ingredient 2').first()
+            measurement = Measurement.query.first()
+            db.session.add(Quantity(3, recipe, ingredient, measurement))
+            db.session.commit()
+            # all of the ingredients
+            response = self.app.post('/ingredient_search', data={'ingredient_name': 'Ingredient 1, Ingredient 2', 'match': 'all'})
+            self.assertIn(b'Recipe count: 1', response.data)
+            self.assertIn(b'Test Recipe Name 1', response.data)
+            # any of the ingredients
+            response = self.app.post('/ingredient_search', data={'ingredient_name': 'Ingredient 1, Ingredient 2', 'match': 'any'})
+            self.assertIn(b'Recipe count: 2', response.data)
+            # leaving an ingredient out
+            response = self.app.post('/ingredient_search', data={'ingredient_name': 'Ingredient 2, -Ingredient 1'})
+            self.assertIn(b'Recipe count: 1', response.data)
+            self.assertIn(b'Test Recipe Name 2', response.data)
+            self.assertNotIn(b'Test Recipe Name 1', response.data)
+            # pantry mode puts the recipe missing fewest ingredients first
+            response = self.app.post('/ingredient_search', data={'ingredient_name': 'Ingredient 2', 'match': 'pantry'})
+            self.assertIn(b'Recipe count: 2', response.data)
+            self.assertLess(response.data.index(b'Test Recipe Name 2'), response.data.index(b'Test Recipe Name 1'))
+            self.assertIn(b'1 missing', response.data)
+            self.assertIn(b'0 missing', response.data)
+
+    @query_budget(ingredient_search=1, login=0, register=2)
+    def test_ingredient_search_whole_words(self):
+        with app.app_context():
+            self.add_test_data()
+            recipe = Recipe.query.filter_by(recipe_name='Test Recipe Name 2').first()
+            measurement = Measurement.query.first()
+            for name in ('Unsalted Butter', 'Flour', 'Eggplant'):
+                db.session.add(Quantity(1, recipe, Ingredient(name), measurement))
+            db.session.commit()
+            # names that only contain a pantry ingredient are still missing
+            response = self.app.post('/ingredient_search', data={'ingredient_name': 'salt, flour, egg', 'match': 'pantry'})
+            self.assertIn(b'Recipe count: 1', response.data)
+            self.assertIn(b'3 missing', response.data)
+            response = self.app.post('/ingredient_search', data={'ingredient_name': 'egg', 'match': 'all'})
+            self.assertIn(b'Recipe count: 0', response.data)
+            response = self.app.post('/ingredient_search', data={'ingredient_name': 'butter, -salt', 'match': 'all'})
+            self.assertIn(b'Recipe count: 1', response.data)
+
+    @query_budget(login=0, recipe_list_filtered=6, register=2)
     def test_recipe_list_filtered(self):
         with app.app_context():
             self.add_test_data()
@@ -466,8 +859,112 @@ class TestCase(unittest.TestCase):
             self.assertIn(b'Recipe count: 1', response.data)
             self.assertIn(b'Test Recipe Name 1', response.data)
             self.assertNotIn(b'Test Recipe Name 2', response.data)
-            
+
+    @query_budget(login=0, recipe_list_filtered=6, register=2)
+    def test_recipe_list_facets(self):
+        with app.app_context():
+            self.add_test_data()
+            category = Category.query.filter_by(category_name='Test Category 1').first()
+            # check each option shows the number of recipes it matches
+            response = self.app.get('/recipe_list_filtered')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'Recipe count: 2', response.data)
+            self.assertIn(b'Test Category 1 (1)</option>', response.data)
+            self.assertIn(b'Test Author 2 (1)</option>', response.data)
+            # check the chosen facet keeps its other options, while the other facets drop those matching nothing
+            response = self.app.get('/recipe_list_filtered?recipe_category=%d' % category.id)
+            self.assertIn(b'Recipe count: 1', response.data)
+            self.assertIn(b'selected>Test Category 1 (1)</option>', response.data)
+            self.assertIn(b'Test Category 2 (1)</option>', response.data)
+            self.assertIn(b'Test Course 1 (1)</option>', response.data)
+            self.assertNotIn(b'Test Course 2', response.data)
+            # check the counts follow new recipes and further pages keep the filters
+            self.add_more_recipes(12)
+            category = Category.query.first()
+            response = self.app.get('/recipe_list_filtered?recipe_category=%d' % category.id)
+            self.assertIn(b'Recipe count: 13', response.data)
+            self.assertIn(b'%s (13)</option>' % category.category_name.encode(), response.data)
+            next_url = re.search(r'href="([^"]*cursor=[^"]*)">Next page', response.data.decode()).group(1)
+            self.assertIn('recipe_category=%d' % category.id, next_url)
+            response = self.app.get(next_url.replace('&amp;', '&'))
+            self.assertIn(b'Recipe count: 13', response.data)
+            self.assertEqual(response.data.count(b'<div class="collapsible-header">'), 3)
+
+    @query_budget(get_recipes_json=1, login=0, register=2)
+    def test_get_recipes_json(self):
+        self.add_test_data()
+        response = self.app.get('/get_recipes')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+        recipes = json.loads(response.data)
+        self.assertEqual(len(recipes), 2)
+        self.assertIn({'recipe_name': 'Test Recipe Name 1',
+                        'recipe_description': 'Test Recipe Description 1',
+                        'category': 'Test Category 1',
+                        'cuisine': 'Test Cuisine 1',
+                        'course': 'Test Course 1',
+                        'author': 'Test Author 1'}, recipes)
+
+    @query_budget(get_recipes_json=1, login=0, register=2)
+    def test_get_recipes_json_batches(self):
+        self.add_test_data()
+        # rows are written in several chunks but still make up a single JSON document
+        app.config['RECIPE_STREAM_BATCH_SIZE'] = 1
+        try:
+            response = self.app.get('/get_recipes')
+            recipes = json.loads(response.data)
+            self.assertEqual([r['recipe_name'] for r in recipes], ['Test Recipe Name 1', 'Test Recipe Name 2'])
+            response = self.app.get('/get_recipes?format=ndjson')
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            lines = response.data.decode().splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(json.loads(lines[1])['author'], 'Test Author 2')
+        finally:
+            app.config['RECIPE_STREAM_BATCH_SIZE'] = 500
+
+    @query_budget(add_category=1, get_recipes_json=5, login=0, register=2)
+    def test_get_recipes_columnar(self):
+        self.add_test_data()
+        response = self.app.get('/get_recipes?format=columnar')
+        self.assertEqual(response.status_code, 200)
+        columns = json.loads(response.data)
+        self.assertEqual(columns['dimensions']['category'], ['Test Category 1', 'Test Category 2'])
+        self.assertEqual(columns['category'], [0, 1])
+        # check the free text the charts never read is left out
+        self.assertNotIn('recipe_name', columns)
+        self.assertNotIn(b'Test Recipe Description 1', response.data)
+        self.assertEqual(columns['dimensions']['author'][columns['author'][1]], 'Test Author 2')
+        # check an unchanged payload is revalidated without a body
+        etag = response.headers['ETag']
+        response = self.app.get('/get_recipes?format=columnar', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        # check the ETag moves on once the data changes
+        self.app.post('/add_category', data={'category': 'Test Category A'})
+        response = self.app.get('/get_recipes?format=columnar', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    @query_budget(get_recipe_stats_json=4, login=0, register=2)
+    def test_get_recipe_stats(self):
+        with app.app_context():
+            self.add_test_data()
+            response = self.app.get('/get_recipe_stats')
+            self.assertEqual(response.status_code, 200)
+            stats = json.loads(response.data)
+            self.assertEqual(stats['category'], [{'key': 'Test Category 1', 'value': 1}, {'key': 'Test Category 2', 'value': 1}])
+            self.assertEqual(stats['author'], [{'key': 'Test Author 1', 'value': 1}, {'key': 'Test Author 2', 'value': 1}])
+            # check the cached counts are refreshed once a recipe changes
+            course = Course.query.filter_by(course_name='Test Course 2').first()
+            recipe = Recipe.query.filter_by(recipe_name='Test Recipe Name 1').first()
+            recipe.course = course
+            db.session.commit()
+            response = self.app.get('/get_recipe_stats')
+            stats = json.loads(response.data)
+            self.assertEqual(stats['course'], [{'key': 'Test Course 2', 'value': 2}])
+
     '''Recipe'''
+    @query_budget(add_recipe=1, index=7, login=1, register=2)
     def test_add_recipe(self):
         with app.app_context():
             self.add_static_data()
@@ -493,6 +990,7 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'Test Recipe Name A', response.data)
 
+    @query_budget(edit_recipe=2, index=7, login=1, logout=0, register=2)
     def test_edit_recipe(self):
         self.add_test_data()
         self.login_user()
@@ -513,6 +1011,7 @@ class TestCase(unittest.TestCase):
         response = self.app.get('/edit_recipe/1', follow_redirects=True)
         self.assertIn(b'You do not have permission to edit this recipe', response.data)
 
+    @query_budget(index=6, login=1, recipe_detail=3, register=2, update_recipe=3)
     def test_update_recipe(self):
         with app.app_context():
             self.add_test_data()
@@ -545,6 +1044,166 @@ class TestCase(unittest.TestCase):
             self.assertIn(b'26 Minutes', response.data)
             self.assertIn(b'5', response.data)
 
+    def post_recipe_image(self, name, data=b'image data'):
+        return self.app.post('/update_recipe/1',
+                            buffered=True,
+                            content_type='multipart/form-data',
+                            data={'recipe_name': 'Test Recipe Name 1',
+                                    'recipe_description': 'Test Recipe Description 1',
+                                    'preparation_time': 15,
+                                    'cooking_time': 25,
+                                    'servings': 4,
+                                    'recipe_category': 1,
+                                    'recipe_course': 1,
+                                    'recipe_cuisine': 1,
+                                    'recipe_author' : 1,
+                                    'recipe_image': (io.BytesIO(data), name)
+                                    }, follow_redirects=True)
+
+    @query_budget(image_file=0, index=7, login=1, recipe_detail=2, register=2, update_recipe=3)
+    def test_recipe_image_upload(self):
+        self.add_test_data()
+        self.login_user()
+        bucket = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bucket)
+        self.addCleanup(setattr, image_uploads, 'storage', image_uploads.storage)
+        image_uploads.storage = LocalStorage(bucket, '/images/')
+        response = self.post_recipe_image('pie.jpg')
+        self.assertEqual(response.status_code, 200)
+        image_uploads.wait()
+        with app.app_context():
+            recipe = Recipe.query.get(1)
+            self.assertEqual(recipe.image_status, 'ready')
+            self.assertTrue(recipe.image_filename.endswith('-pie.jpg'))
+            self.assertEqual(recipe.image_url, '/images/' + recipe.image_filename)
+            with open(os.path.join(bucket, recipe.image_filename), 'rb') as f:
+                self.assertEqual(f.read(), b'image data')
+        self.assertFalse(os.path.exists(os.path.join(app.config['IMAGE_SPOOL_DIR'], recipe.image_filename)))
+        response = self.app.get('/recipe_detail/1')
+        self.assertIn(recipe.image_url.encode('utf-8'), response.data)
+        # local images are served with long lived cache headers and byte ranges
+        response = self.app.get(recipe.image_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'image data')
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response.close()
+        response = self.app.get(recipe.image_url, headers={'Range': 'bytes=6-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b'data')
+        response.close()
+        response = self.app.get('/images/../tests.py')
+        self.assertEqual(response.status_code, 404)
+
+    @query_budget(index=7, login=1, recipe_detail=2, register=2, update_recipe=3)
+    def test_recipe_image_derivatives(self):
+        self.add_test_data()
+        self.login_user()
+        bucket = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bucket)
+        self.addCleanup(setattr, image_uploads, 'storage', image_uploads.storage)
+        image_uploads.storage = LocalStorage(bucket, '/images/')
+        photo = io.BytesIO()
+        Image.new('RGB', (2000, 1000), 'orange').save(photo, 'PNG')
+        self.post_recipe_image('pie.png', photo.getvalue())
+        image_uploads.wait()
+        with app.app_context():
+            recipe = Recipe.query.get(1)
+            self.assertEqual(sorted(recipe.image_variants), ['jpeg', 'webp'])
+            self.assertEqual([width for width, url in recipe.image_variants['webp']], [320, 640, 1280])
+            width, url = recipe.image_variants['jpeg'][0]
+            with Image.open(os.path.join(bucket, url.rsplit('/', 1)[1])) as derivative:
+                self.assertEqual((derivative.format, derivative.size), ('JPEG', (320, 160)))
+            srcset = recipe.image_srcset('webp')
+        response = self.app.get('/recipe_detail/1')
+        self.assertIn(b'<source type="image/webp" srcset="' + srcset.encode('utf-8'), response.data)
+        self.assertIn(b'320w', response.data)
+
+    @query_budget(index=7, login=1, recipe_detail=2, register=2, update_recipe=3)
+    def test_recipe_image_upload_retries(self):
+        self.add_test_data()
+        self.login_user()
+        bucket = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bucket)
+        attempts = []
+        class FlakyStorage(LocalStorage):
+            def save(self, path, key, content_type):
+                attempts.append(key)
+                if len(attempts) < 3:
+                    raise IOError('connection reset')
+                return LocalStorage.save(self, path, key, content_type)
+        self.addCleanup(setattr, image_uploads, 'storage', image_uploads.storage)
+        self.addCleanup(app.config.update, IMAGE_UPLOAD_BACKOFF=app.config['IMAGE_UPLOAD_BACKOFF'])
+        app.config['IMAGE_UPLOAD_BACKOFF'] = 0
+        image_uploads.storage = FlakyStorage(bucket, '/images/')
+        self.post_recipe_image('pie.jpg')
+        image_uploads.wait()
+        self.assertEqual(len(attempts), 3)
+        with app.app_context():
+            self.assertEqual(Recipe.query.get(1).image_status, 'ready')
+        # once the retries run out the image is marked as failed rather than given a broken url
+        del attempts[:]
+        self.addCleanup(app.config.update, IMAGE_UPLOAD_RETRIES=app.config['IMAGE_UPLOAD_RETRIES'])
+        app.config['IMAGE_UPLOAD_RETRIES'] = 0
+        self.post_recipe_image('tart.jpg')
+        image_uploads.wait()
+        with app.app_context():
+            recipe = Recipe.query.get(1)
+            self.assertEqual(recipe.image_status, 'failed')
+            self.assertTrue(recipe.image_url.endswith('-pie.jpg'))
+        response = self.app.get('/recipe_detail/1')
+        self.assertIn(b'The image could not be uploaded', response.data)
+
+    def test_recover_uploads(self):
+        self.add_test_data()
+        bucket = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bucket)
+        self.addCleanup(setattr, image_uploads, 'storage', image_uploads.storage)
+        image_uploads.storage = LocalStorage(bucket, '/images/')
+        # both recipes were left pending by a worker that stopped, the first with its file still spooled
+        with app.app_context():
+            for recipe_id, key in ((1, 'stale-pie.jpg'), (2, 'lost-tart.jpg')):
+                recipe = Recipe.query.get(recipe_id)
+                recipe.image_filename = key
+                recipe.image_status = 'pending'
+            db.session.commit()
+        # a spool directory of its own, so that files left by other runs are not taken for this one's
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        self.addCleanup(app.config.__setitem__, 'IMAGE_SPOOL_DIR', app.config['IMAGE_SPOOL_DIR'])
+        app.config['IMAGE_SPOOL_DIR'] = spool_dir
+        path = os.path.join(spool_dir, 'stale-pie.jpg')
+        with open(path, 'wb') as f:
+            f.write(b'image data')
+        # a file spooled moments ago is probably still being uploaded, a missing one never will be
+        self.assertEqual(image_uploads.recover(), (0, 1))
+        stale = time.time() - app.config['IMAGE_UPLOAD_STALE_AFTER'] - 1
+        os.utime(path, (stale, stale))
+        # the worker taking it up claims it first, so another running recover at the same time leaves it alone
+        with mock.patch.object(image_uploads, 'submit'):
+            self.assertEqual(image_uploads.recover(), (1, 0))
+        self.assertEqual(image_uploads.recover(), (0, 0))
+        with app.app_context():
+            self.assertEqual(Recipe.query.get(1).image_status, 'pending')
+        # a claim not uploaded in time was left by a worker that stopped as well
+        claimed, = glob.glob(path + '.*')
+        os.utime(claimed, (stale, stale))
+        self.assertEqual(image_uploads.recover(), (1, 0))
+        image_uploads.wait()
+        with app.app_context():
+            self.assertEqual(Recipe.query.get(1).image_status, 'ready')
+            self.assertEqual(Recipe.query.get(1).image_url, '/images/stale-pie.jpg')
+            self.assertEqual(Recipe.query.get(2).image_status, 'failed')
+        self.assertFalse([name for name in os.listdir(spool_dir) if name.startswith('stale-pie')])
+        self.assertEqual(image_uploads.recover(), (0, 0))
+        # errors in an upload nobody waits on are logged
+        future = Future()
+        future.set_exception(RuntimeError('database gone'))
+        with self.assertLogs('uploads', 'ERROR') as logs:
+            image_uploads._done(future)
+        self.assertIn('database gone', logs.output[0])
+
+    @query_budget(delete_recipe=7, index=6, login=1, register=2)
     def test_delete_recipe(self):
         with app.app_context():
             self.add_test_data()
@@ -556,6 +1215,7 @@ class TestCase(unittest.TestCase):
             self.assertIn(b'You do not have permission to delete this recipe', response.data)
 
     '''Quantity'''
+    @query_budget(add_quantity=6, index=6, login=1, recipe_detail=3, register=2)
     def test_add_quantity(self):
         with app.app_context():
             self.add_test_data()
@@ -575,6 +1235,7 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'You do not have permission to add ingredients to this recipe', response.data)
 
+    @query_budget(edit_quantity=4, index=7, login=1, register=2)
     def test_edit_quantity(self):
         self.add_test_data()
         self.login_user()
@@ -589,6 +1250,7 @@ class TestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'You do not have permission to edit this ingredient', response.data)
     
+    @query_budget(index=6, login=1, recipe_detail=3, register=2, update_quantity=10)
     def test_update_quantity(self):
         with app.app_context():
             self.add_test_data()
@@ -604,6 +1266,81 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'2.0 Test Measurement 2 Test Ingredient 1 Updated', response.data)
 
+    @query_budget(add_quantity=6, index=7, login=1, recipe_detail=2, register=2, update_quantity=8)
+    def test_ingredient_identity(self):
+        self.add_test_data()
+        self.login_user()
+        # differently spelled names of an ingredient share one row
+        for name in ('Tomato', ' tomato ', 'TOMATO', 'test  ingredient 2'):
+            self.app.post('/add_quantity/1', data={'quantity': 1, 'quantity_ingredient': name, 'quantity_measurement': 1})
+        with app.app_context():
+            self.assertEqual(Ingredient.query.count(), 3)
+            self.assertEqual(Ingredient.query.filter_by(normalized_name='tomato').one().ingredient_name, 'Tomato')
+            self.assertEqual(Quantity.query.filter_by(recipe_id=1, ingredient_id=2).count(), 1)
+        # editing a quantity points it at another ingredient rather than renaming the shared one
+        response = self.app.post('/update_quantity/1', data={'quantity': 2, 'quantity_ingredient': 'Test Ingredient 2', 'quantity_measurement': 2}, follow_redirects=True)
+        self.assertIn(b'2.0 Test Measurement 2 Test Ingredient 2', response.data)
+        with app.app_context():
+            self.assertEqual(Ingredient.query.get(1).ingredient_name, 'Test Ingredient 1')
+            self.assertEqual(Quantity.query.get(1).ingredient_id, 2)
+            self.assertEqual(Ingredient.query.count(), 3)
+
+    @query_budget(edit_recipe_items=12, index=7, login=1, recipe_detail=2, register=2)
+    def test_edit_recipe_items(self):
+        self.add_test_data()
+        self.login_user()
+        response = self.app.get('/edit_recipe_items/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'value="Test Ingredient 1"', response.data)
+        self.assertIn(b'value="Test Method 1"', response.data)
+        # one form post replaces the whole list: the first step is reworded and moved last, the ingredient is
+        # dropped and two new ingredients and a step are added
+        response = self.app.post('/edit_recipe_items/1', data={
+            'quantity_id': ['1', '', '', ''],
+            'quantity': ['1', '2', '0.5', ''],
+            'quantity_measurement': ['1', '1', '2', ''],
+            'quantity_ingredient': ['', 'Flour', 'test ingredient 2', ''],
+            'method_id': ['1', '', ''],
+            'method_position': ['2', '1', ''],
+            'method': ['Test Method 1 Updated', 'Preheat the oven', '']})
+        self.assertEqual(response.status_code, 302)
+        response = self.app.get('/recipe_detail/1')
+        self.assertNotIn(b'Test Ingredient 1', response.data)
+        self.assertIn(b'2.0 Test Measurement 1 Flour', response.data)
+        self.assertIn(b'0.5 Test Measurement 2 Test Ingredient 2', response.data)
+        self.assertLess(response.data.index(b'Preheat the oven'), response.data.index(b'Test Method 1 Updated'))
+        with app.app_context():
+            self.assertEqual(Ingredient.query.filter_by(normalized_name='test ingredient 2').count(), 1)
+            self.assertEqual(Method.query.get(1).position, 1)
+        # the same as JSON, and a bad row leaves everything as it was
+        response = self.app.post('/edit_recipe_items/1', json={
+            'quantities': [{'quantity': 3, 'measurement': 99, 'ingredient': 'Sugar'}], 'methods': ['Stir']})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['error'], 'Choose a measurement for Sugar')
+        response = self.app.post('/edit_recipe_items/1', json={
+            'quantities': [{'quantity': 3, 'measurement': 2, 'ingredient': 'Sugar'}], 'methods': [{'id': 1, 'method': 'Stir'}]})
+        self.assertEqual(response.get_json(), {'quantities': 1, 'methods': 1})
+        response = self.app.get('/recipe_detail/1')
+        self.assertIn(b'3.0 Test Measurement 2 Sugar', response.data)
+        self.assertNotIn(b'Flour', response.data)
+        self.assertNotIn(b'Preheat', response.data)
+        # check blank ingredients and steps in a JSON body are rejected rather than saved
+        response = self.app.post('/edit_recipe_items/1', json={
+            'quantities': [{'quantity': 1, 'measurement': 1, 'ingredient': '   '}], 'methods': ['Stir']})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['error'], 'Enter a name for every ingredient')
+        response = self.app.post('/edit_recipe_items/1', json={
+            'quantities': [{'quantity': 1, 'measurement': 1, 'ingredient': ' Salt '}], 'methods': ['  ']})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['error'], 'Enter a description for every step of the method')
+        with app.app_context():
+            self.assertEqual(Ingredient.query.filter(Ingredient.normalized_name.in_(['', 'salt'])).count(), 0)
+            self.assertEqual(Method.query.filter_by(recipe_id=1).one().method_description, 'Stir')
+        # check user access
+        response = self.app.post('/edit_recipe_items/2', json={'quantities': [], 'methods': []})
+        self.assertEqual(response.status_code, 403)
+
+    @query_budget(delete_quantity=4, index=6, login=1, recipe_detail=3, register=2)
     def test_delete_quantity(self):
         with app.app_context():
             self.add_test_data()
@@ -617,6 +1354,7 @@ class TestCase(unittest.TestCase):
             self.assertIn(b'You do not have permission to delete this ingredient', response.data)
 
     '''Method'''
+    @query_budget(add_method=2, index=6, login=1, recipe_detail=3, register=2)
     def test_add_method(self):
         with app.app_context():
             self.add_test_data()
@@ -632,6 +1370,7 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'You do not have permission to add methods to this recipe', response.data)
 
+    @query_budget(edit_method=3, index=7, login=1, register=2)
     def test_edit_method(self):
         self.add_test_data()
         self.login_user()
@@ -644,6 +1383,7 @@ class TestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'You do not have permission to edit this method', response.data)
     
+    @query_budget(index=6, login=1, recipe_detail=3, register=2, update_method=5)
     def test_update_method(self):
         with app.app_context():
             self.add_test_data()
@@ -655,6 +1395,7 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'Test Method B', response.data)
 
+    @query_budget(delete_method=4, index=6, login=1, recipe_detail=3, register=2)
     def test_delete_method(self):
         with app.app_context():
             self.add_test_data()
@@ -667,7 +1408,36 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'You do not have permission to delete this method', response.data)
 
+    '''Static Data: cached reference tables'''
+    @query_budget(index=7, login=1, manage_static_data=5, register=2, update_country=2, update_recipe=3)
+    def test_reference_data_cache(self):
+        self.add_test_data()
+        self.login_user()
+        self.app.get('/manage_static_data')
+        with self.record_queries() as statements:
+            response = self.app.get('/manage_static_data')
+        self.assertIn(b'Test Author 1, Test Country 1', response.data)
+        for table in ('category', 'course', 'cuisine', 'country', 'author', 'measurement'):
+            self.assertFalse([s for s in statements if 'FROM %s' % table in s], table)
+        # check submitted ids are resolved from the cache as well
+        with self.record_queries() as statements:
+            self.app.post('/update_recipe/1', data={'recipe_name': 'Test Recipe Name 1',
+                                                    'recipe_description': 'Test Recipe Description 1',
+                                                    'preparation_time': 15,
+                                                    'cooking_time': 25,
+                                                    'servings': 4,
+                                                    'recipe_category': 2,
+                                                    'recipe_course': 2,
+                                                    'recipe_cuisine': 2,
+                                                    'recipe_author': 2})
+        self.assertFalse([s for s in statements if 'FROM category' in s])
+        # check the cache is refreshed once the reference data changes
+        self.app.post('/update_country/1', data={'country': 'Test Country B'})
+        response = self.app.get('/manage_static_data')
+        self.assertIn(b'Test Author 1, Test Country B', response.data)
+
     '''Static Data: Category'''
+    @query_budget(add_category=1, index=6, login=1, manage_static_data=3, register=2)
     def test_add_category(self):
         with app.app_context():
             self.add_test_data()
@@ -679,6 +1449,7 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'Test Category A', response.data)
     
+    @query_budget(index=6, login=1, manage_static_data=3, register=2, update_category=2)
     def test_update_category(self):
         with app.app_context():
             self.add_test_data()
@@ -691,6 +1462,7 @@ class TestCase(unittest.TestCase):
             self.assertIn(b'Test Category B', response.data)
 
     '''Static Data: Course'''
+    @query_budget(add_course=1, index=6, login=1, manage_static_data=3, register=2)
     def test_add_course(self):
         with app.app_context():
             self.add_test_data()
@@ -702,6 +1474,7 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'Test Course A', response.data)
     
+    @query_budget(index=6, login=1, manage_static_data=3, register=2, update_course=2)
     def test_update_course(self):
         with app.app_context():
             self.add_test_data()
@@ -714,6 +1487,7 @@ class TestCase(unittest.TestCase):
             self.assertIn(b'Test Course B', response.data)
 
     '''Static Data: Cuisine'''
+    @query_budget(add_cuisine=1, index=6, login=1, manage_static_data=3, register=2)
     def test_add_cuisine(self):
         with app.app_context():
             self.add_test_data()
@@ -725,6 +1499,7 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'Test Cuisine A', response.data)
     
+    @query_budget(index=6, login=1, manage_static_data=3, register=2, update_cuisine=2)
     def test_update_cuisine(self):
         with app.app_context():
             self.add_test_data()
@@ -737,6 +1512,7 @@ class TestCase(unittest.TestCase):
             self.assertIn(b'Test Cuisine B', response.data)
 
     '''Static Data: Country'''
+    @query_budget(add_country=1, index=6, login=1, manage_static_data=3, register=2)
     def test_add_country(self):
         with app.app_context():
             self.add_test_data()
@@ -748,6 +1524,7 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'Test Country A', response.data)
     
+    @query_budget(index=6, login=1, manage_static_data=3, register=2, update_country=2)
     def test_update_country(self):
         with app.app_context():
             self.add_test_data()
@@ -760,6 +1537,7 @@ class TestCase(unittest.TestCase):
             self.assertIn(b'Test Country B', response.data)
 
     '''Static Data: Author'''
+    @query_budget(add_author=2, index=6, login=1, manage_static_data=3, register=2)
     def test_add_author(self):
         with app.app_context():
             self.add_test_data()
@@ -774,6 +1552,7 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'Test Author A, Test Country 1', response.data)
     
+    @query_budget(index=6, login=1, manage_static_data=3, register=2, update_author=3)
     def test_update_author(self):
         with app.app_context():
             self.add_test_data()
@@ -789,6 +1568,7 @@ class TestCase(unittest.TestCase):
             self.assertIn(b'Test Author B, Test Country 2', response.data)
 
     '''Static Data: Measurement'''
+    @query_budget(add_measurement=1, index=6, login=1, manage_static_data=2, register=2)
     def test_add_measurement(self):
         with app.app_context():
             self.add_test_data()
@@ -800,6 +1580,7 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'Test Measurement A', response.data)
     
+    @query_budget(index=6, login=1, manage_static_data=2, register=2, update_measurement=2)
     def test_update_measurement(self):
         with app.app_context():
             self.add_test_data()
@@ -811,6 +1592,400 @@ class TestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'Test Measurement B', response.data)
 
+    '''Bulk import'''
+    def write_import_file(self, extension, content):
+        handle, path = tempfile.mkstemp(suffix='.' + extension)
+        with os.fdopen(handle, 'w') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    @query_budget(login=0, recipe_search=3, register=2)
+    def test_import_recipes(self):
+        self.add_test_data()
+        records = [{'recipe_name': 'Imported Recipe %d' % i,
+                    'recipe_description': 'Imported Description %d' % i,
+                    'preparation_time': 10, 'cooking_time': 20, 'servings': 2,
+                    'category': 'Test Category 1', 'course': 'Imported Course', 'cuisine': 'Test Cuisine 2',
+                    'author': 'Imported Author', 'author_country': 'Test Country 2', 'username': 'user@email.com',
+                    'ingredients': [{'quantity': 2, 'measurement': 'Test Measurement 1', 'ingredient': 'Test Ingredient 1'},
+                                    {'quantity': 0.5, 'measurement': 'Cup', 'ingredient': 'Imported Ingredient'}],
+                    'methods': ['Imported step one', 'Imported step two']} for i in range(5)]
+        records.append({'recipe_name': 'Test Recipe Name 1', 'category': 'Test Category 1'})
+        records.append({'recipe_name': 'Imported Recipe Without Author', 'category': 'Test Category 1',
+                        'course': 'Test Course 1', 'cuisine': 'Test Cuisine 1'})
+        path = self.write_import_file('json', json.dumps(records, indent=2))
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['import-recipes', path, '--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Done: 5 recipes imported, 1 skipped, 1 invalid', result.output)
+        self.assertIn('rows/s', result.output)
+        with app.app_context():
+            recipe = Recipe.query.filter_by(recipe_name='Imported Recipe 3').first()
+            self.assertEqual(recipe.user.username, 'user@email.com')
+            self.assertEqual(recipe.category.category_name, 'Test Category 1')
+            self.assertEqual(recipe.author.country.country_name, 'Test Country 2')
+            self.assertEqual(sorted(m.method_description for m in recipe.methods), ['Imported step one', 'Imported step two'])
+            self.assertEqual(sorted((q.quantity, q.ingredient.ingredient_name) for q in recipe.quantities),
+                             [(0.5, 'Imported Ingredient'), (2.0, 'Test Ingredient 1')])
+            # reference rows are shared rather than added once per recipe
+            self.assertEqual(Course.query.filter_by(course_name='Imported Course').count(), 1)
+            self.assertEqual(Ingredient.query.filter_by(ingredient_name='Imported Ingredient').count(), 1)
+            self.assertEqual(Ingredient.query.filter_by(ingredient_name='Test Ingredient 1').count(), 1)
+        # the imported recipes show up straight away in cached pages and searches
+        response = self.app.get('/recipe_search?recipe_name=Imported')
+        self.assertIn(b'Imported Recipe 4', response.data)
+        # check an import that is run again adds nothing
+        result = runner.invoke(args=['import-recipes', path])
+        self.assertIn('Done: 0 recipes imported, 6 skipped, 1 invalid', result.output)
+        with app.app_context():
+            self.assertEqual(Recipe.query.count(), 7)
+
+    @query_budget(login=0, register=2)
+    def test_import_recipes_formats(self):
+        self.add_test_data()
+        record = {'recipe_name': 'Imported NDJSON Recipe', 'category': 'Test Category 1', 'course': 'Test Course 1',
+                  'cuisine': 'Test Cuisine 1', 'author': 'Test Author 1', 'methods': ['Stir']}
+        path = self.write_import_file('ndjson', json.dumps(record) + '\n\n')
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['import-recipes', path])
+        self.assertIn('Done: 1 recipes imported', result.output)
+        path = self.write_import_file('csv', 'recipe_name,servings,category,course,cuisine,author,ingredients,methods\n'
+            'Imported CSV Recipe,3,Test Category 2,Test Course 2,Test Cuisine 2,Test Author 2,'
+            '"[{""quantity"": 1, ""measurement"": ""Test Measurement 2"", ""ingredient"": ""Salt""}]","[""Season""]"\n')
+        result = runner.invoke(args=['import-recipes', path])
+        self.assertIn('Done: 1 recipes imported', result.output)
+        with app.app_context():
+            recipe = Recipe.query.filter_by(recipe_name='Imported CSV Recipe').first()
+            self.assertEqual(recipe.servings, 3)
+            self.assertEqual(recipe.quantities[0].ingredient.ingredient_name, 'Salt')
+            self.assertEqual(recipe.methods[0].method_description, 'Season')
+            self.assertEqual(Recipe.query.filter_by(recipe_name='Imported NDJSON Recipe').first().methods[0].method_description, 'Stir')
+        result = runner.invoke(args=['import-recipes', path, '--format', 'xml'])
+        self.assertNotEqual(result.exit_code, 0)
+
+    '''Export'''
+    @query_budget(export_recipes_file=7, index=7, login=1, register=2)
+    def test_export_recipes(self):
+        self.add_test_data()
+        response = self.app.get('/export')
+        self.assertEqual(response.status_code, 302)
+        self.login_user()
+        response = self.app.get('/export')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers['Content-Disposition'], 'attachment; filename=recipes.ndjson')
+        records = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        self.assertEqual([r['recipe_name'] for r in records], ['Test Recipe Name 1', 'Test Recipe Name 2'])
+        self.assertEqual(records[0]['author_country'], 'Test Country 1')
+        self.assertEqual(records[0]['username'], 'user@email.com')
+        self.assertEqual(records[0]['ingredients'], [{'quantity': 1.0, 'measurement': 'Test Measurement 1', 'ingredient': 'Test Ingredient 1'}])
+        self.assertEqual(records[1]['methods'], ['Test Method 2'])
+        # check csv and gzip, read in batches of one recipe
+        self.addCleanup(app.config.update, RECIPE_STREAM_BATCH_SIZE=app.config['RECIPE_STREAM_BATCH_SIZE'])
+        app.config['RECIPE_STREAM_BATCH_SIZE'] = 1
+        response = self.app.get('/export?format=csv&gzip=1')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(response.data).decode('utf-8'))))
+        self.assertEqual([r['recipe_name'] for r in rows], ['Test Recipe Name 1', 'Test Recipe Name 2'])
+        self.assertEqual(json.loads(rows[1]['ingredients'])[0]['ingredient'], 'Test Ingredient 2')
+        self.assertEqual(self.app.get('/export?format=xml').status_code, 404)
+
+    @query_budget(login=0, register=2)
+    def test_export_recipes_command(self):
+        self.add_test_data()
+        path = self.write_import_file('ndjson.gz', '')
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['export-recipes', path, '--batch-size', '1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        with gzip.open(path, 'rt') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['recipe_name'] for r in records], ['Test Recipe Name 1', 'Test Recipe Name 2'])
+        # an export can be imported again as it is
+        with app.app_context():
+            db.session.delete(Recipe.query.filter_by(recipe_name='Test Recipe Name 2').first())
+            db.session.commit()
+        with gzip.open(path, 'rt') as f:
+            ndjson = self.write_import_file('ndjson', f.read())
+        result = runner.invoke(args=['import-recipes', ndjson])
+        self.assertIn('Done: 1 recipes imported, 1 skipped', result.output)
+        with app.app_context():
+            recipe = Recipe.query.filter_by(recipe_name='Test Recipe Name 2').first()
+            self.assertEqual(recipe.methods[0].method_description, 'Test Method 2')
+            self.assertEqual(recipe.quantities[0].quantity, 2)
+
+    @query_budget(index=6)
+    def test_create_app(self):
+        other = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'IMAGE_STORAGE': 's3',
+                            'S3_BUCKET': 'bucket', 'S3_LOCATION': 'https://bucket/'})
+        self.assertEqual(other.config['RECIPES_PER_PAGE'], 10)
+        self.assertEqual(sorted(other.view_functions), sorted(app.view_functions))
+        self.assertIn('import-recipes', other.cli.commands)
+        # the S3 client is only made when the first image is saved
+        storage = other.extensions['image_uploads'].storage
+        self.assertIsNone(storage._client)
+        self.assertEqual(storage.url('key'), 'https://bucket/key')
+        with other.app_context():
+            db.create_all()
+            self.assertEqual(other.test_client().get('/').status_code, 200)
+        # check the apps keep their own uploads and cached pages
+        self.assertIsNot(image_uploads, other.extensions['image_uploads'])
+        self.assertIsInstance(image_uploads.storage, LocalStorage)
+        self.assertIsNot(app.extensions['data_caches']['page'], other.extensions['data_caches']['page'])
+        self.assertEqual(other.extensions['data_caches']['page'].ttl, other.config['DATA_CACHE_TTL'])
+        self.assertIn('create_app', startup.timings)
+
+    @query_budget(get_recipe_stats_json=0, login=0, register=2)
+    def test_warm_up(self):
+        self.add_test_data()
+        warm_up(app)
+        self.assertIn('warm_up', startup.timings)
+        # the dashboard stats are served from the warmed up cache
+        with self.record_queries() as statements:
+            response = self.app.get('/get_recipe_stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(statements, [])
+        result = app.test_cli_runner().invoke(args=['startup-report'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        for step in ('import', 'create_app', 'warm_up'):
+            self.assertIn(step, result.output)
+
+    @query_budget(healthz=0, readyz=13)
+    def test_health_checks(self):
+        self.assertEqual(self.app.get('/healthz').status_code, 200)
+        # a worker that has not warmed up does so when asked whether it is ready
+        self.addCleanup(setattr, startup, '_ready_pid', startup._ready_pid)
+        startup._ready_pid = None
+        response = self.app.get('/readyz')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['status'], 'ready')
+        self.assertTrue(startup.is_ready())
+
+    def test_gunicorn_config(self):
+        path = os.path.join(BASEDIR, 'gunicorn.conf.py')
+        with mock.patch.object(sys, 'argv', ['gunicorn', 'wsgi:app']):
+            config = runpy.run_path(path)
+        self.assertTrue(config['preload_app'])
+        self.assertEqual(config['worker_class'], 'gthread')
+        self.assertGreater(config['workers'], 1)
+        self.assertTrue(callable(config['post_fork']))
+        # a worker class given on the command line decides the worker count as well
+        with mock.patch.object(sys, 'argv', ['gunicorn', '-k', 'sync', 'wsgi:app']):
+            config = runpy.run_path(path)
+        self.assertEqual(config['worker_class'], 'sync')
+        self.assertEqual(config['workers'], config['cpus'] * 2 + 1)
+
+    def test_compile_templates(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.addCleanup(setattr, app.jinja_env, 'bytecode_cache', app.jinja_env.bytecode_cache)
+        app.jinja_env.bytecode_cache = TemplateBytecodeCache(cache_dir)
+        result = app.test_cli_runner().invoke(args=['compile-templates'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(len(os.listdir(cache_dir)), len(app.jinja_env.list_templates()))
+        # a new worker's environment loads the compiled templates without compiling their source
+        env = app.create_jinja_environment()
+        env.bytecode_cache = TemplateBytecodeCache(cache_dir)
+        env.compile = lambda *args, **kwargs: self.fail('template compiled again')
+        env.get_template('index.html')
+
+    @query_budget(login=0, metrics_text=0, recipe_detail=1, register=2)
+    def test_metrics(self):
+        self.add_test_data()
+
+        def metric(name):
+            text = self.app.get('/metrics').data.decode('utf-8')
+            match = re.search('^%s (.*)$' % re.escape(name), text, re.M)
+            return float(match.group(1)) if match else 0
+
+        requests = metric('http_request_duration_seconds_count{endpoint="recipe_detail",method="GET"}')
+        statements = metric('http_request_sql_statements_sum{endpoint="recipe_detail"}')
+        renders = metric('template_render_duration_seconds_count{template="recipe_detail.html"}')
+        with self.record_queries() as recorded:
+            self.assertEqual(self.app.get('/recipe_detail/1').status_code, 200)
+        self.assertEqual(metric('http_request_duration_seconds_count{endpoint="recipe_detail",method="GET"}'), requests + 1)
+        self.assertEqual(metric('http_request_sql_statements_sum{endpoint="recipe_detail"}'), statements + len(recorded))
+        self.assertEqual(metric('template_render_duration_seconds_count{template="recipe_detail.html"}'), renders + 1)
+        self.assertGreaterEqual(metric('http_requests_total{endpoint="recipe_detail",method="GET",status="200"}'), 1)
+        response = self.app.get('/metrics')
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn('# TYPE http_request_duration_seconds histogram', response.data.decode('utf-8'))
+
+    def test_query_budget(self):
+        self.add_test_data()
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with query_budget(recipe_detail=0):
+                self.app.get('/recipe_detail/1')
+        self.assertIn('recipe_detail ran 1 statements, its budget is 0', str(raised.exception))
+        # every endpoint a request reaches needs a budget
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with query_budget(recipe_detail=1):
+                self.app.get('/healthz')
+        self.assertIn('healthz ran 0 statements, its budget is None', str(raised.exception))
+
+    def test_generate_data(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['generate-data', '--recipes', '50', '--users', '3', '--saved', '2', '--batch-size', '20'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Done: 50 recipes generated', result.output)
+        with app.app_context():
+            self.assertEqual(Recipe.query.count(), 50)
+            self.assertEqual(User.query.count(), 3)
+            self.assertEqual(SavedRecipe.query.count(), 6)
+            recipe = Recipe.query.first()
+            self.assertGreaterEqual(len(recipe.quantities), 3)
+            self.assertGreaterEqual(len(recipe.methods), 3)
+        # running again adds further recipes rather than repeating them
+        result = runner.invoke(args=['generate-data', '--recipes', '10', '--users', '3'])
+        self.assertIn('Done: 10 recipes generated, 0 skipped', result.output)
+        with app.app_context():
+            self.assertEqual(Recipe.query.count(), 60)
+            self.assertEqual(SavedRecipe.query.count(), 6)
+
+    def test_benchmark(self):
+        # check the command offers every route the load generator drives, while web workers import neither generator
+        self.assertEqual(tuple(name for name, _ in loadgen.ROUTES), ROUTE_NAMES)
+        imported = subprocess.run([sys.executable, '-c', 'import sys, app\n'
+                                   'print("benchmarks.loadgen" in sys.modules, "benchmarks.datagen" in sys.modules)'],
+                                  cwd=BASEDIR, capture_output=True, text=True, check=True)
+        self.assertEqual(imported.stdout.split(), ['False', 'False'])
+        runner = app.test_cli_runner()
+        runner.invoke(args=['generate-data', '--recipes', '20', '--users', '2'])
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        output = self.write_import_file('json', '')
+        args = ['benchmark', '--url', 'http://127.0.0.1:%d' % server.server_port, '--requests', '10', '--concurrency', '2',
+                '--route', 'index', '--route', 'recipe_detail', '--route', 'recipe_search']
+        result = runner.invoke(args=args + ['--output', output])
+        self.assertEqual(result.exit_code, 0, result.output)
+        with open(output) as f:
+            results = json.load(f)
+        self.assertEqual(results['dataset']['recipe'], 20)
+        self.assertEqual(sorted(results['routes']), ['index', 'recipe_detail', 'recipe_search'])
+        for route in results['routes'].values():
+            self.assertEqual(route['requests'], 10)
+            self.assertEqual(route['errors'], 0)
+            self.assertEqual(route['sessions'], 1)
+            self.assertLessEqual(route['p50'], route['p95'])
+            self.assertLessEqual(route['p95'], route['p99'])
+        # check deeper pages are requested, and that pages the server could not serve count as errors
+        result = runner.invoke(args=args[:-4] + ['--follow', '1', '--bypass-page-cache', '--output', output])
+        self.assertEqual(result.exit_code, 0, result.output)
+        with open(output) as f:
+            self.assertGreater(json.load(f)['routes']['index']['followed'], 0)
+        with app.app_context(), db.engine.connect() as connection:
+            samples = loadgen.Samples(connection)
+        missing = loadgen.drive('http://127.0.0.1:%d' % server.server_port, lambda samples: ('GET', '/recipe_detail/0', None),
+                                samples, 4, 2)
+        self.assertEqual(missing['errors'], 4)
+        # compared with a far faster baseline, every route has regressed
+        baseline = self.write_import_file('json', json.dumps({'routes': dict(
+            (name, dict(route, p95=route['p95'] / 1000, throughput=route['throughput'] * 1000))
+            for name, route in results['routes'].items())}))
+        result = runner.invoke(args=args + ['--baseline', baseline])
+        self.assertEqual(result.exit_code, 1)
+        for name in results['routes']:
+            self.assertIn('Regression: %s: p95' % name, result.output)
+
+    @contextmanager
+    def record_statements(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not executemany:
+                statements.append((statement, parameters))
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+    @query_budget(delete_recipe=2, index=7, ingredient_search=1, login=1, my_recipes=2, my_saved_recipes=3, recipe_detail=2, recipe_list_filtered=2, register=2, save_recipe=3)
+    def test_query_plans(self):
+        self.add_test_data()
+        self.login_user()
+        self.app.get('/save_recipe/1')
+        with self.record_statements() as statements:
+            self.app.get('/')
+            self.app.get('/recipe_detail/1')
+            self.app.get('/my_recipes')
+            self.app.get('/my_saved_recipes')
+            self.app.post('/recipe_list_filtered', data=dict(recipe_category='1', recipe_cuisine='1'))
+            self.app.get('/ingredient_search?ingredient_name=Test Ingredient 1')
+            self.app.get('/delete_recipe/2')
+        self.assertGreater(len(statements), 10)
+        scans = []
+        with app.app_context(), db.engine.connect() as connection:
+            for statement, parameters in statements:
+                if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                    continue
+                # a page of recipes walks the primary key and stops at the limit
+                if ' WHERE ' not in statement and re.search(r'ORDER BY recipe\.id( DESC)?\s+LIMIT', statement):
+                    continue
+                for table in query_plan_scans(connection, statement, parameters):
+                    if table in ('recipe', 'quantity', 'method', 'saved_recipe'):
+                        scans.append('%s: %s' % (table, statement))
+        self.assertEqual(scans, [])
+
+    @query_budget(login=0, register=2)
+    def test_saved_recipe_unique(self):
+        self.add_test_data()
+        with app.app_context():
+            user, recipe = User.query.first(), Recipe.query.first()
+            db.session.add(SavedRecipe(user, recipe))
+            db.session.commit()
+            db.session.add(SavedRecipe(user, recipe))
+            self.assertRaises(IntegrityError, db.session.commit)
+            db.session.rollback()
+
+    @query_budget(login=0, register=2)
+    def test_create_indexes(self):
+        self.add_test_data()
+        with app.app_context():
+            db.session.execute('DROP INDEX ix_quantity_recipe_id')
+            db.session.execute('DROP INDEX savedrecipe_user_recipe_uc')
+            for _ in range(2):
+                db.session.execute('INSERT INTO saved_recipe (user_id, recipe_id) VALUES (1, 1)')
+            db.session.commit()
+        result = app.test_cli_runner().invoke(args=['create-indexes'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Created 2 indexes: ix_quantity_recipe_id, savedrecipe_user_recipe_uc', result.output)
+        with app.app_context():
+            self.assertEqual(SavedRecipe.query.count(), 1)
+        result = app.test_cli_runner().invoke(args=['create-indexes'])
+        self.assertIn('Created 0 indexes', result.output)
+
+    def test_upgrade_schema(self):
+        # a database from before ingredients were normalized, recipe images were processed and steps were ordered
+        dropped = (('ingredient', 'normalized_name'), ('recipe', 'image_status'), ('recipe', 'image_variants'),
+                   ('method', 'position'))
+        metadata = MetaData()
+        for table in db.Model.metadata.sorted_tables:
+            Table(table.name, metadata, *[column.copy() for column in table.columns if (table.name, column.name) not in dropped])
+        engine = create_engine('sqlite://')
+        metadata.create_all(engine)
+        engine.execute("INSERT INTO ingredient (id, ingredient_name) VALUES (1, 'Tomato'), (2, ' tomato  '), (3, 'Basil')")
+        engine.execute("INSERT INTO quantity (quantity, recipe_id, ingredient_id, measurement_id) VALUES (1, 1, 2, 1), (2, 1, 3, 1)")
+        with engine.begin() as connection:
+            changes = upgrade_schema(connection, db.Model.metadata)
+        self.assertIn('Added column ingredient.normalized_name', changes)
+        self.assertIn('Added column recipe.image_variants', changes)
+        self.assertIn('Added column method.position', changes)
+        self.assertIn('Merged 1 duplicate ingredients', changes)
+        self.assertIn('Created index ix_ingredient_normalized_name', changes)
+        self.assertEqual(engine.execute('SELECT id, normalized_name FROM ingredient ORDER BY id').fetchall(),
+                         [(1, 'tomato'), (3, 'basil')])
+        self.assertEqual(engine.execute('SELECT ingredient_id FROM quantity ORDER BY id').fetchall(), [(1,), (3,)])
+        with self.assertRaises(IntegrityError):
+            engine.execute("INSERT INTO ingredient (ingredient_name, normalized_name) VALUES ('TOMATO', 'tomato')")
+        with engine.begin() as connection:
+            self.assertEqual(upgrade_schema(connection, db.Model.metadata), [])
+        # a database created from the current models needs nothing
+        result = app.test_cli_runner().invoke(args=['upgrade-db'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output, 'Nothing to upgrade\n')
+
  
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Background upload of recipe images. A request only spools the uploaded file to local disk and saves the recipe with
+a pending image; a small pool of worker threads then has the resized derivatives made in a separate process, saves
+the original and its derivatives to the image storage, retrying with backoff, and fills in the recipe's image urls once they are
+there. Jobs are only held in memory, so images left pending by a process that stopped are taken up again by recover."""
+import glob
+import logging
+import mimetypes
+import os
+import threading
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+from werkzeug.utils import secure_filename
+
+from extensions import db
+from images import make_derivatives
+from models import Recipe
+
+log = logging.getLogger(__name__)
+
+IMAGE_PENDING = 'pending'
+IMAGE_READY = 'ready'
+IMAGE_FAILED = 'failed'
+
+
+class UploadQueue(object):
+    """
+    Uploads spooled images on a pool of IMAGE_UPLOAD_WORKERS threads. Each upload is tried IMAGE_UPLOAD_RETRIES more
+    times after a failure, waiting IMAGE_UPLOAD_BACKOFF seconds and twice as long after each further attempt.
+    Derivatives are resized on a pool of IMAGE_PROCESS_WORKERS processes, or in the uploading thread when that is 0.
+    """
+
+    def __init__(self, app=None, storage=None):
+        self.app = None
+        self.storage = None
+        self._executor = None
+        self._processes = None
+        self._pid = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, storage)
+
+    def init_app(self, app, storage):
+        # no threads or processes are started here, only on the first upload of each process
+        self.app = app
+        self.storage = storage
+        app.extensions['image_uploads'] = self
+
+    def _pool(self):
+        # threads do not survive a fork, so each worker process starts its own pool on first use
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.app.config['IMAGE_UPLOAD_WORKERS'])
+                self._processes = None
+                self._pid = os.getpid()
+                self._pending = set()
+            return self._executor
+
+    def spool(self, file):
+        """Save an uploaded file to the spool directory and return the key it will be stored under and its local path."""
+        key = '{}-{}'.format(uuid.uuid4().hex, secure_filename(file.filename) or 'image')
+        spool_dir = self.app.config['IMAGE_SPOOL_DIR']
+        os.makedirs(spool_dir, exist_ok=True)
+        path = os.path.join(spool_dir, key)
+        file.save(path)
+        return key, path
+
+    def submit(self, recipe_id, key, path, content_type):
+        """Queue a spooled file for upload as the image of a committed recipe."""
+        future = self._pool().submit(self._upload, recipe_id, key, path, content_type)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        # nothing waits on the result, so an error would otherwise go unseen
+        if not future.cancelled() and future.exception() is not None:
+            log.error("Uploading an image failed", exc_info=future.exception())
+
+    def recover(self):
+        """
+        Take up the images left pending by a process that stopped before uploading them. Those whose spooled file has
+        not changed for IMAGE_UPLOAD_STALE_AFTER seconds are queued again, and those whose file is gone are marked
+        failed. Returns how many were queued again and how many marked failed. Every worker may run this at once:
+        a spooled file is claimed by renaming it to end in the process id before it is queued again, so only one of
+        them takes it up, and a claim left for as long by a process that stopped in turn is taken up again.
+        """
+        spool_dir = self.app.config['IMAGE_SPOOL_DIR']
+        stale_after = self.app.config['IMAGE_UPLOAD_STALE_AFTER']
+        jobs, failed = [], 0
+        with self.app.app_context():
+            pending = db.session.query(Recipe.id, Recipe.image_filename).filter(Recipe.image_status == IMAGE_PENDING).all()
+            for recipe_id, key in pending:
+                spooled = path = os.path.join(spool_dir, key) if key else None
+                try:
+                    age = time.time() - os.path.getmtime(path)
+                except (TypeError, OSError):
+                    # looked for only once the file itself is gone, so that one claimed in between is still found
+                    claims = glob.glob(glob.escape(spooled) + '.*') if key else []
+                    if not claims:
+                        # spooled files are only removed once the upload has finished, so the status is changed
+                        # only if that did not happen in the meantime
+                        failed += Recipe.query.filter_by(id=recipe_id, image_filename=key, image_status=IMAGE_PENDING) \
+                            .update({'image_status': IMAGE_FAILED}, synchronize_session=False)
+                        continue
+                    path = claims[0]
+                    try:
+                        age = time.time() - os.path.getmtime(path)
+                    except OSError:
+                        continue
+                if age < stale_after:
+                    # probably still being uploaded by a running process
+                    continue
+                claimed = '{}.{}'.format(spooled, os.getpid())
+                try:
+                    os.rename(path, claimed)
+                    # from now on the file's time is that of the claim
+                    os.utime(claimed)
+                except OSError:
+                    continue
+                jobs.append((recipe_id, key, claimed, mimetypes.guess_type(key)[0] or 'application/octet-stream'))
+            db.session.commit()
+        for job in jobs:
+            self.submit(*job)
+        if jobs or failed:
+            log.warning("Queued %d pending images again, marked %d as failed", len(jobs), failed)
+        return len(jobs), failed
+
+    def wait(self, timeout=None):
+        """Block until every queued upload has finished."""
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending, timeout=timeout)
+
+    def _derive(self, path, key):
+        workers = self.app.config['IMAGE_PROCESS_WORKERS']
+        if not workers:
+            return make_derivatives(path, key)
+        with self._lock:
+            if self._processes is None:
+                # resizing holds the GIL, so it runs in processes of its own; they are spawned rather than forked
+                # because this process already runs threads
+                self._processes = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            processes = self._processes
+        return processes.submit(make_derivatives, path, key).result()
+
+    def _put(self, key, path, content_type):
+        # returns the url of the uploaded file, or None once every attempt has failed
+        retries = self.app.config['IMAGE_UPLOAD_RETRIES']
+        backoff = self.app.config['IMAGE_UPLOAD_BACKOFF']
+        for attempt in range(retries + 1):
+            try:
+                return self.storage.save(path, key, content_type)
+            except Exception as e:
+                log.warning("Uploading %s failed (attempt %d of %d): %s", key, attempt + 1, retries + 1, e)
+                if attempt < retries:
+                    time.sleep(backoff * 2 ** attempt)
+        return None
+
+    def _upload(self, recipe_id, key, path, content_type):
+        derivatives = []
+        try:
+            url = self._put(key, path, content_type)
+            variants = None
+            if url is not None:
+                try:
+                    derivatives = self._derive(path, key)
+                except Exception as e:
+                    log.warning("Resizing %s failed: %s", key, e)
+                # the original is still shown if any derivative is missing
+                variants = {}
+                for name, width, derivative_key, derivative_path, derivative_type in derivatives:
+                    derivative_url = self._put(derivative_key, derivative_path, derivative_type)
+                    if derivative_url is None:
+                        variants = {}
+                        break
+                    variants.setdefault(name, []).append([width, derivative_url])
+            self._finish(recipe_id, key, url, variants or None)
+        finally:
+            for spooled in [path] + [derivative[3] for derivative in derivatives]:
+                os.remove(spooled)
+
+    def _finish(self, recipe_id, key, url, variants):
+        with self.app.app_context():
+            recipe = Recipe.query.get(recipe_id)
+            # a newer image may have been chosen for the recipe while this one was uploading
+            if recipe is None or recipe.image_filename != key:
+                return
+            if url is not None:
+                recipe.image_url = url
+                recipe.image_variants = variants
+                recipe.image_status = IMAGE_READY
+            else:
+                recipe.image_status = IMAGE_FAILED
+            db.session.commit()
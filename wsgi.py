@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""WSGI entry point for production servers: gunicorn --config gunicorn.conf.py wsgi:app"""
+from app import create_app
+
+app = create_app()